@@ -18,6 +18,241 @@ import time
 import httplib
 from urlparse import urlsplit
 import socket
+import select
+import threading
+import asyncore
+import zlib
+from StringIO import StringIO
+
+from errors import DocumentTooLarge
+
+# size of the blocks in which response bodies are read and decoded
+_CHUNK_SIZE = 65536
+
+
+class _ContentDecoder(object):
+    """
+    Incremental decoder of a response body according to its content-encoding.
+    Supports gzip and deflate (both zlib-wrapped and raw, as sent by some
+    servers); identity and unknown encodings are passed through unchanged.
+    The decoded data are the same bytes the server would send uncompressed.
+    """
+
+    def __init__(self, encoding):
+        """
+        @param encoding: value of the content-encoding header (or None)
+        @type encoding: str
+        """
+        encoding = (encoding or 'identity').strip().lower()
+        self._first = True
+        if encoding in ('gzip', 'x-gzip'):
+            self._z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._z = zlib.decompressobj()
+        else:
+            self._z = None
+        self._deflate = encoding == 'deflate'
+
+    def decode(self, data):
+        """
+        Decode next block of the body.
+
+        @raises: zlib.error if the body is corrupted
+        """
+        if self._z is None or not data:
+            return data
+        try:
+            decoded = self._z.decompress(data)
+        except zlib.error:
+            if not (self._deflate and self._first):
+                raise
+            # deflate without the zlib header
+            self._z = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self._z.decompress(data)
+        self._first = False
+        return decoded
+
+    def flush(self):
+        """
+        Decode the rest of the body (call after the last block).
+        """
+        if self._z is None:
+            return ''
+        return self._z.flush()
+
+    def describe(self, headers, length):
+        """
+        Make headers of the response describe the decoded body, as if the
+        server sent it uncompressed: content-encoding (and content-md5, the
+        digest of the encoded body) is dropped and content-length is set to
+        the decoded length. Headers of responses, whose body was not decoded
+        (identity, HEAD), are kept.
+
+        @param headers: retrieved headers (changed in place)
+        @type headers: dict
+        @param length: length of the decoded body
+        @type length: int
+        """
+        if self._z is None or self._first:
+            return
+        headers.pop('content-encoding', None)
+        headers.pop('content-md5', None)
+        headers['content-length'] = str(length)
+
+
+def _request_path(splitted_url):
+    """
+    Build a path identifying a file on the server from the splitted URL.
+    """
+    req_url = splitted_url.path
+    if splitted_url.query:
+        req_url += '?' + splitted_url.query
+    return req_url
+
+
+def _declared_too_large(headers, max_size):
+    """
+    Check the content-length of the response against the size limit. Only
+    responses without content-encoding are checked, because the length of
+    an encoded body says nothing exact about the size of the document.
+
+    @returns: True if the declared size of the document exceeds max_size
+    @rtype: bool
+    """
+    if max_size is None or headers is None:
+        return False
+    if headers.get('content-encoding', 'identity').strip().lower() != 'identity':
+        return False
+    try:
+        return int(headers['content-length']) > max_size
+    except (KeyError, ValueError):
+        return False
+
+
+def _too_large(status, headers, url, max_size):
+    """
+    Create DocumentTooLarge exception carrying the response (status, headers,
+    None, url) in its `response` attribute, so that the outcome can be recorded.
+    """
+    e = DocumentTooLarge("Document '%s' is larger than %d bytes." % (url, max_size))
+    e.response = (status, headers, None, url)
+    return e
+
+
+def _redirect_location(status, headers, num_redirects, max_redirects):
+    """
+    Decide whether the response is a redirect, which has to be followed.
+
+    @returns: URL to be requested next or None if the response is final
+    @rtype: str or None
+    """
+    if status in [301,302,303]:
+        if 'location' in headers and num_redirects < max_redirects:
+            return headers['location']
+    return None
+
+
+class _HTTPConnectionPool(object):
+    """
+    Pool of persistent (keep-alive) HTTP connections grouped by net location.
+
+    Connections are checked out exclusively by acquire() and returned by
+    release() after the whole response has been read. Idle connections are
+    kept per host up to max_per_host, dropped after idle_timeout seconds and
+    health-checked before they are handed out again, so that a connection
+    closed by the server is never reused. The pool is thread-safe and is meant
+    to be shared by all resolvers of one Monitor.
+    """
+
+    default_max_per_host = 4
+
+    default_idle_timeout = 30
+
+    def __init__(self, max_per_host=default_max_per_host, idle_timeout=default_idle_timeout):
+        """
+        @param max_per_host: maximum number of idle connections kept for one host
+        @type max_per_host: int
+        @param idle_timeout: seconds after which an idle connection is closed
+        @type idle_timeout: number
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        # netloc -> list of (connection, time of release)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, netloc, timeout=None):
+        """
+        Get a connection to the net location, reusing an idle one if possible.
+
+        @param netloc: net location (host[:port]) of the server
+        @type netloc: str
+        @param timeout: socket timeout of the connection (None for default)
+        @type timeout: number
+        @returns: 2-tuple of (connection) and (True if it was reused)
+        @rtype: tuple
+        """
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(netloc, [])
+            while idle:
+                c, released = idle.pop()
+                if now - released <= self.idle_timeout and self._is_alive(c):
+                    conn = c
+                    break
+                stale.append(c)
+        for c in stale:
+            c.close()
+        if conn is not None:
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            return (conn, True)
+        if timeout is not None:
+            return (httplib.HTTPConnection(netloc, timeout=timeout), False)
+        return (httplib.HTTPConnection(netloc), False)
+
+    def release(self, netloc, conn):
+        """
+        Return the connection into the pool. The response must be fully read.
+
+        @param netloc: net location the connection was acquired for
+        @type netloc: str
+        @param conn: connection to be returned
+        @type conn: httplib.HTTPConnection
+        """
+        if conn.sock is None:
+            return
+        with self._lock:
+            idle = self._idle.setdefault(netloc, [])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for c, _ in conns:
+                c.close()
+
+    @staticmethod
+    def _is_alive(conn):
+        # an idle keep-alive socket must not be readable: if it is, the server
+        # either closed it (EOF) or sent garbage we cannot pair with a request
+        if conn.sock is None:
+            return False
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
 
 class _HTTPConnectionProxy(object):
     """
@@ -41,32 +276,99 @@ class _HTTPConnectionProxy(object):
 
     # pretending a proper web browser
     # 1-1 copy of headers sent by Google Chrome run on Ubuntu Linux
-    # only 'accept-encoding' was changed in order not to be bothered with decompression
+    # compressed bodies are decoded by _ContentDecoder while being read
     default_header = {
             "connection":"keep-alive",
             "cache-control":"max-age=0",
             "user-agent":"Mozilla/5.0 (X11; Linux x86_64; rv:12.0) Gecko/20100101 Firefox/12.0",
             "accept":"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "accept-encoding":"identity",
+            "accept-encoding":"gzip, deflate",
             "accept-language":"en-US,en;q=0.8",
             "accept-charset":"ISO-8859-1;q=0.7,*;0.3"
         }
 
     default_max_redirects = 10
 
-    def __init__(self,url,timeout=None):
+    def __init__(self,url,timeout=None,pool=None):
         """
         @param url: requested URL (only server name is taken in account now)
         @type url: basestring
         @param timeout: timeout applied to requests in this connection (None sets default from httplib/socket)
         @type timeout: number
+        @param pool: pool of keep-alive connections (None opens a new connection for every request)
+        @type pool: _HTTPConnectionPool
         """
         self.netloc = urlsplit(url).netloc
         self.timeout = timeout
-
-
-
-    def send_request(self, method, url, headers=default_header, max_redirects=default_max_redirects):
+        self.pool = pool
+
+    def _connect(self, netloc):
+        if self.pool is not None:
+            return self.pool.acquire(netloc, self.timeout)
+        return (self._connect_fresh(netloc), False)
+
+    def _finish(self, netloc, conn, response):
+        # the body has been read, so the connection can serve another request
+        if self.pool is not None and not response.will_close:
+            self.pool.release(netloc, conn)
+        else:
+            conn.close()
+
+    def _read_body(self, response, sink=None, max_size=None, headers=None):
+        # read the body in blocks and decode them on the fly; the decoded
+        # blocks are either written into the sink or joined into a string.
+        # Reading is aborted as soon as the decoded size exceeds max_size.
+        # The headers (if given) are made to describe the decoded body.
+        decoder = _ContentDecoder(response.getheader('content-encoding'))
+        if sink is None:
+            chunks = []
+            write = chunks.append
+        else:
+            write = sink.write
+        size = 0
+        while True:
+            data = response.read(_CHUNK_SIZE)
+            if not data:
+                break
+            data = decoder.decode(data)
+            size += len(data)
+            if max_size is not None and size > max_size:
+                raise DocumentTooLarge()
+            write(data)
+        data = decoder.flush()
+        write(data)
+        if headers is not None:
+            decoder.describe(headers, size + len(data))
+        if sink is None:
+            return ''.join(chunks)
+        return sink
+
+    def _exchange(self, netloc, method, req_url, headers):
+        conn, reused = self._connect(netloc)
+        try:
+            conn.request(method, req_url, headers=headers)
+            return (conn, conn.getresponse())
+        except socket.timeout:
+            conn.close()
+            raise
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+        # the server closed the kept-alive connection meanwhile, try a fresh one
+        conn = self._connect_fresh(netloc)
+        conn.request(method, req_url, headers=headers)
+        return (conn, conn.getresponse())
+
+    def _connect_fresh(self, netloc):
+        if self.timeout != None:
+            return httplib.HTTPConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc)
+
+
+
+    def send_request(self, method, url, headers=default_header, max_redirects=default_max_redirects,
+                     sink=None, max_size=None):
         """
         @param method: HTTP method (GET/HEAD...)
         @type method: str
@@ -76,10 +378,20 @@ class _HTTPConnectionProxy(object):
         @type headers: dict
         @param max_redirects: sets the maximum number of redirects to be followed
         @type max_redirects: number (only non-negative integers make sense here)
+        @param sink: if given, the (decoded) body of the final response is
+                     streamed into sink.write() block by block instead of
+                     being returned as a string
+        @type sink: file-like object
+        @param max_size: maximal size of the (decoded) body of the final response
+                         in bytes, None for no limit
+        @type max_size: int
+        @raises: DocumentTooLarge if the body exceeds max_size; the download
+                 is aborted and the exception carries (response code, headers,
+                 None, final URL) in its `response` attribute
         @returns: 4-tuple of (response code recieved from the (last in case\
 of redirection) server) and (dictionary of retrieved headers or None if none\
 arrived) and (string containing body of the response -- empty for HEAD\
-requests) and (final URL).
+requests -- or the sink) and (final URL).
         """
         actual_url = url
         num_redirects = 0
@@ -92,53 +404,297 @@ requests) and (final URL).
             if num_redirects == 0 and splitted_url.netloc != self.netloc:
                 raise ValueError("Net location of the query doesn't match the one this connection was established with")
 
-            # we are making connection for every single request to avoid
-            # problems with reuse. Actually it is neccessary for following
-            # redirects.
-            if self.timeout != None:
-                conn = httplib.HTTPConnection(splitted_url.netloc, timeout=self.timeout)
-            else:
-                conn = httplib.HTTPConnection(splitted_url.netloc)
+            # connections are taken from the pool (if any), so that HEAD and GET
+            # and the whole redirect chain on one host share a single socket.
+            # Redirects to another host simply use a connection to that host.
+            netloc = splitted_url.netloc
 
-            # build a path identifying a file on the server
-            req_url = splitted_url.path
-            if splitted_url.query:
-                req_url += '?' + splitted_url.query
+            req_url = _request_path(splitted_url)
 
             try:
-                conn.request(method, req_url, headers=headers)
+                conn, response = self._exchange(netloc, method, req_url, headers)
             except socket.timeout as e:
 #?                print "Timeout (%s)" % (e)
                 return None
             except socket.error as e:
 #?                print "A socket error(%s)" % (e)
                 return None
-            response = conn.getresponse()
 
             # get headers from response and build a dict from them
             retrieved_headers = {}
             for header_tuple in response.getheaders():
                 retrieved_headers[header_tuple[0]] = header_tuple[1]
 
-            if response.status >= 400:
-                return (response.status, retrieved_headers, response.read(), actual_url)
+            # following redirections
+            location = _redirect_location(response.status, retrieved_headers,
+                                          num_redirects, max_redirects)
 
+            if location is None and _declared_too_large(retrieved_headers, max_size):
+                conn.close()
+                raise _too_large(response.status, retrieved_headers, actual_url, max_size)
 
-            # following redirections
-            if response.status in [301,302,303]:
-                if 'location' in retrieved_headers and num_redirects < max_redirects:
-                    actual_url = retrieved_headers['location']
-                    num_redirects += 1
-                    continue
+            # the body has to be read whole before the connection can be reused
+            # (body of a redirect is read and thrown away)
+            try:
+                if location is None:
+                    body = self._read_body(response, sink, max_size, retrieved_headers)
                 else:
-                    return (response.status, retrieved_headers, response.read(), actual_url)
+                    body = self._read_body(response)
+            except DocumentTooLarge:
+                conn.close()
+                raise _too_large(response.status, retrieved_headers, actual_url, max_size)
+            except zlib.error:
+                # corrupted compressed body
+                conn.close()
+                return None
+            except socket.error:
+                conn.close()
+                return None
+            self._finish(netloc, conn, response)
+
+            if location is not None:
+                actual_url = location
+                num_redirects += 1
+                continue
+
+            # final response (successful, error or an unknown response code)
+            return (response.status, retrieved_headers, body, actual_url)
+
+
+# cache of resolved host names used by the non-blocking requests
+_host_addresses = {}
+
+
+def _resolve_host(host):
+    """
+    Resolve the host name (cached). Name resolution is the only blocking
+    operation of _AsyncHTTPRequest, the cache makes it once-per-host.
+    """
+    try:
+        return _host_addresses[host]
+    except KeyError:
+        addr = _host_addresses[host] = socket.gethostbyname(host)
+        return addr
+
+
+class _AsyncHTTPExchange(asyncore.dispatcher):
+    """
+    One non-blocking HTTP request/response exchange on its own socket, driven
+    by the asyncore loop over *map*. The request is sent as HTTP/1.0, so the
+    body ends either by content-length or by closing the connection. The body
+    is decoded (gzip/deflate) as it arrives.
+
+    When finished, calls callback with 3-tuple (response code, dictionary of
+    headers, body) or with None in case of a socket error or timeout. If sink
+    is given and is_final(status, headers) is true for the response, the body
+    is streamed into the sink and the sink is passed instead of the string;
+    if such body exceeds max_size, the exchange is aborted and the callback
+    gets the DocumentTooLarge exception.
+    """
 
-            # only "succesful" exit point of the loop and thus of the whole method
-            if response.status == 200:
-                return (response.status, retrieved_headers, response.read(), actual_url)
+    def __init__(self, netloc, method, req_url, headers, callback, timeout, map,
+                 sink=None, is_final=None, max_size=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self._method = method
+        self._callback = callback
+        self._sink = sink
+        self._is_final = is_final
+        self._max_size = max_size
+        self._decoded = 0
+        self._done = False
+        self._out = self._build_request(netloc, method, req_url, headers)
+        self._in = []
+        self._head = None
+        self._length = None
+        self._received = 0
+        self.deadline = time.time() + timeout if timeout is not None else None
+        host, _, port = netloc.partition(':')
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect((_resolve_host(host), int(port or httplib.HTTP_PORT)))
+        except (socket.error, ValueError):
+            self._finish(None)
+
+    @staticmethod
+    def _build_request(netloc, method, req_url, headers):
+        lines = ["%s %s HTTP/1.0" % (method, req_url or '/'), "host: %s" % netloc]
+        for name, value in headers.iteritems():
+            if name.lower() not in ('host', 'connection'):
+                lines.append("%s: %s" % (name, value))
+        lines.append("connection: close")
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    @staticmethod
+    def expire(map):
+        """
+        Fail all exchanges in the map, which exceeded their timeout.
+        """
+        now = time.time()
+        for d in map.values():
+            if isinstance(d, _AsyncHTTPExchange) and d.deadline is not None \
+                    and d.deadline < now:
+                d._finish(None)
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(_CHUNK_SIZE)
+        if data:
+            self._feed(data)
+
+    def handle_close(self):
+        if self._head is None:
+            self._finish(None)
+        else:
+            self._finish_response()
+
+    def handle_error(self):
+        self._finish(None)
+
+    def _feed(self, data):
+        if self._head is None:
+            self._in.append(data)
+            buf = ''.join(self._in)
+            end = buf.find("\r\n\r\n")
+            if end < 0:
+                return
+            self._head = self._parse_head(buf[:end + 2])
+            self._in = []
+            status, headers = self._head
+            self._decoder = _ContentDecoder(headers.get('content-encoding'))
+            if self._sink is not None and not self._is_final(status, headers):
+                self._sink = None
+            if self._sink is None:
+                self._max_size = None
+            elif _declared_too_large(headers, self._max_size):
+                self._abort_too_large()
+                return
+            if self._method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+                self._length = 0
+            elif 'content-length' in headers:
+                try:
+                    self._length = int(headers['content-length'])
+                except ValueError:
+                    pass
+            data = buf[end + 4:]
+        if self._length is not None:
+            data = data[:self._length - self._received]
+        self._received += len(data)
+        try:
+            data = self._decoder.decode(data)
+        except zlib.error:
+            # corrupted compressed body
+            self._finish(None)
+            return
+        self._decoded += len(data)
+        if self._max_size is not None and self._decoded > self._max_size:
+            self._abort_too_large()
+            return
+        self._write(data)
+        if self._length is not None and self._received >= self._length:
+            self._finish_response()
+
+    @staticmethod
+    def _parse_head(raw):
+        status_line, _, rest = raw.partition("\r\n")
+        status = int(status_line.split(None, 2)[1])
+        message = httplib.HTTPMessage(StringIO(rest), 0)
+        # the same shape as the dictionary built from HTTPResponse.getheaders()
+        return (status, dict(message.items()))
+
+    def _finish_response(self):
+        status, headers = self._head
+        try:
+            data = self._decoder.flush()
+        except zlib.error:
+            self._finish(None)
+            return
+        self._write(data)
+        self._decoder.describe(headers, self._decoded + len(data))
+        if self._sink is not None:
+            self._finish((status, headers, self._sink))
+        else:
+            self._finish((status, headers, ''.join(self._in)))
+
+    def _abort_too_large(self):
+        status, headers = self._head
+        self._finish(_too_large(status, headers, None, self._max_size))
+
+    def _write(self, data):
+        if self._sink is not None:
+            self._sink.write(data)
+        else:
+            self._in.append(data)
+
+    def _finish(self, result):
+        if self._done:
+            return
+        self._done = True
+        self.close()
+        self._callback(result)
+
+
+class _AsyncHTTPRequest(object):
+    """
+    Non-blocking counterpart of _HTTPConnectionProxy.send_request. Follows the
+    redirects in the same way and calls callback with the same 4-tuple
+    (response code, headers, body or sink, final URL) or None on timeout/socket
+    error. If the body exceeds max_size, the callback gets DocumentTooLarge
+    exception (see send_request) instead.
+    The requests are driven by asyncore loop over *map*, so one thread can have
+    thousands of them in flight.
+    """
 
-            # an unknown response code
-            return (response.status, retrieved_headers, response.read(), actual_url)
+    def __init__(self, method, url, callback, headers=_HTTPConnectionProxy.default_header,
+                 max_redirects=_HTTPConnectionProxy.default_max_redirects,
+                 timeout=None, map=None, sink=None, max_size=None):
+        self.method = method
+        self.actual_url = url
+        self.num_redirects = 0
+        self._callback = callback
+        self._headers = headers
+        self._max_redirects = max_redirects
+        self._timeout = timeout
+        self._map = map
+        self._sink = sink
+        self._max_size = max_size
+        self._send()
+
+    def _send(self):
+        splitted_url = urlsplit(self.actual_url)
+        _AsyncHTTPExchange(splitted_url.netloc, self.method, _request_path(splitted_url),
+                           self._headers, self._on_response, self._timeout, self._map,
+                           self._sink, self._is_final, self._max_size)
+
+    def _is_final(self, status, headers):
+        return _redirect_location(status, headers, self.num_redirects,
+                                  self._max_redirects) is None
+
+    def _on_response(self, result):
+        if result is None:
+            self._callback(None)
+            return
+        if isinstance(result, DocumentTooLarge):
+            result.response = result.response[:3] + (self.actual_url,)
+            self._callback(result)
+            return
+        status, headers, body = result
+        location = _redirect_location(status, headers, self.num_redirects,
+                                      self._max_redirects)
+        if location is not None:
+            self.actual_url = location
+            self.num_redirects += 1
+            self._send()
+            return
+        self._callback((status, headers, body, self.actual_url))
 
 
 class HTTPDateTime(object):
@@ -0,0 +1,804 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Backends for changemonitor storage -- persistence of contents, headers and
+schedules behind model.Storage.
+
+MongoBackend keeps everything in MongoDB (headers in collections, contents
+in GridFS). SQLiteBackend needs no database server: metadata are kept in
+an SQLite database and contents in a sharded directory of files, which are
+read through mmap.
+"""
+
+__modulename__ = "backend"
+__date__ = "$16.10.2026 19:12:47$"
+
+import os
+import mmap
+import json
+import time
+import uuid
+import sqlite3
+import datetime
+import threading
+
+import pymongo
+
+from pymongo import Connection, ASCENDING
+from gridfs import GridFS
+from gridfs.errors import NoFile
+
+from bson.binary import Binary
+
+from model import HttpHeaderMeta, UrlStateMeta, ScheduleMeta, \
+                  _ensure_indexes, _missing_indexes, DIFF_CACHE_TTL
+
+
+class Backend(object):
+    """
+    Interface of storage backends.
+
+    A backend provides models of one user (headers(), schedule()) with the
+    interface of HttpHeaderMeta and ScheduleMeta, and a filesystem of
+    contents with the interface of the used subset of GridFS:
+        put(data, **metadata) -> file id
+        new_file(**metadata) -> writable file (write(), close(), _id;
+                                metadata can be set as attributes)
+        get(file_id) -> readable file (read(), seek(), tell(), length,
+                        content_type, upload_date, _id and the metadata
+                        as attributes)
+        get_version(filename, version) -> readable file
+        exists(filename) -> bool
+        delete(file_id)
+    Both get methods raise gridfs.errors.NoFile if there is no such file.
+
+    Contents addressed by SHA-1 (blobs) are reference counted by the
+    blob methods; blob records are {_id: sha1, file_id: ..., refs: n}.
+    """
+    filesystem = None
+
+    def headers(self, uid):
+        """
+        @returns: model of http headers of the user
+        @rtype: HttpHeaderMeta
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def schedule(self, uid):
+        """
+        @returns: model of re-check schedule of the user
+        @rtype: ScheduleMeta
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def acquire_blob(self, sha1):
+        """
+        Add reference to the blob.
+        @returns: file id of the blob or None if there is no such blob
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def register_blob(self, sha1, file_id):
+        """
+        Create blob with one reference.
+        @returns: False if the blob already exists
+        @rtype: bool
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def release_blob(self, sha1):
+        """
+        Remove reference to the blob.
+        @returns: the blob after the change or None if there is no such blob
+        @rtype: dict
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def remove_blob(self, sha1):
+        """
+        Remove the blob record if it has no references.
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def find_blob(self, file_id):
+        """
+        @returns: blob stored in the file or None
+        @rtype: dict
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def has_delta_dependents(self, file_id):
+        """
+        @returns: True if a content is stored as a delta against the file
+        @rtype: bool
+        """
+        raise NotImplementedError("Interface Backend needs to be implemented")
+
+    def get_diff(self, key):
+        """
+        @returns: diff encoded by model.DiffCache or None if there is no
+                  such diff (backends, which do not cache diffs, have none)
+        @rtype: str
+        """
+        return None
+
+    def put_diff(self, key, data):
+        """
+        Store diff encoded by model.DiffCache (replaces a diff of the key).
+        """
+        pass
+
+    def ensure_indexes(self):
+        """
+        Create indexes needed by the storage, which do not exist yet.
+        """
+        pass
+
+    def check_indexes(self):
+        """
+        @returns: missing indexes as "collection.index_name" strings
+        @rtype: list
+        """
+        return []
+
+
+class MongoBackend(Backend):
+    """
+    Backend storing everything into one MongoDB database.
+    """
+    # indexes of GridFS files collection (versions of a file by upload date)
+    CONTENT_INDEXES = [
+        ("filename_uploadDate", [("filename", ASCENDING), ("uploadDate", ASCENDING)], {}),
+        # versions stored as deltas against a version
+        ("delta_base", [("delta_base", ASCENDING)], {"sparse": True}),
+        # contents by SHA-1 (deduplication of older contents)
+        ("sha1", [("sha1", ASCENDING)], {"sparse": True}),
+    ]
+    BLOB_INDEXES = [
+        ("file_id", [("file_id", ASCENDING)], {"unique": True}),
+    ]
+    DIFF_INDEXES = [
+        # cached diffs are removed by the server when they expire
+        ("created", [("created", ASCENDING)], {"expireAfterSeconds": DIFF_CACHE_TTL}),
+    ]
+
+    def __init__(self, connection, database="webarchive"):
+        """
+        @param connection: database connection
+        @type connection: pymongo.Connection
+        @param database: name of the database
+        @type database: str
+        """
+        if not isinstance(connection, Connection):
+            raise TypeError("connection must be instance of pymongo.Connection.")
+        self.connection = connection
+        self.database = database
+        # filesystem interface
+        self.filesystem = GridFS(connection[database], "content")
+        # files collection of the filesystem
+        self.files = connection[database]["content.files"]
+        # contents addressed by SHA-1:
+        # {_id: sha1, file_id: id of the file in the filesystem, refs: 3}
+        self.blobs = connection[database].blob
+        # diffs of contents: {_id: key, data: encoded diff, created: datetime}
+        self.diffs = connection[database].diffs
+
+    def headers(self, uid):
+        return HttpHeaderMeta(self.connection, uid, self.database)
+
+    def schedule(self, uid):
+        return ScheduleMeta(self.connection, uid, self.database)
+
+    def acquire_blob(self, sha1):
+        blob = self.blobs.find_and_modify({"_id": sha1}, {"$inc": {"refs": 1}}, new=True)
+        return blob["file_id"] if blob is not None else None
+
+    def register_blob(self, sha1, file_id):
+        try:
+            self.blobs.insert({"_id": sha1, "file_id": file_id, "refs": 1}, safe=True)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    def release_blob(self, sha1):
+        return self.blobs.find_and_modify({"_id": sha1}, {"$inc": {"refs": -1}}, new=True)
+
+    def remove_blob(self, sha1):
+        self.blobs.remove({"_id": sha1, "refs": {"$lte": 0}})
+
+    def find_blob(self, file_id):
+        return self.blobs.find_one({"file_id": file_id})
+
+    def has_delta_dependents(self, file_id):
+        return self.files.find_one({"delta_base": file_id}, ["_id"]) is not None
+
+    def get_diff(self, key):
+        record = self.diffs.find_one({"_id": key}, ["data"])
+        return str(record["data"]) if record is not None else None
+
+    def put_diff(self, key, data):
+        self.diffs.save({"_id": key, "data": Binary(data),
+                         "created": datetime.datetime.utcnow()})
+
+    def _models(self):
+        # indexes do not depend on the user
+        return (self.headers(None), self.schedule(None))
+
+    def ensure_indexes(self):
+        try:
+            for m in self._models():
+                m.ensure_indexes()
+            _ensure_indexes(self.files, self.CONTENT_INDEXES)
+            _ensure_indexes(self.blobs, self.BLOB_INDEXES)
+            _ensure_indexes(self.diffs, self.DIFF_INDEXES)
+        except pymongo.errors.OperationFailure:
+            # e.g. insufficient privileges; reported by check_indexes()
+            pass
+
+    def check_indexes(self):
+        missing = []
+        for m in self._models():
+            missing.extend(m.missing_indexes())
+        return missing + _missing_indexes(self.files, self.CONTENT_INDEXES) + \
+               _missing_indexes(self.blobs, self.BLOB_INDEXES) + \
+               _missing_indexes(self.diffs, self.DIFF_INDEXES)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    uid TEXT,
+    timestamp REAL NOT NULL,
+    response_code INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    error TEXT,
+    content TEXT,
+    version INTEGER,
+    changed INTEGER,
+    md5 TEXT,
+    sha1 TEXT
+);
+CREATE TABLE IF NOT EXISTS url_state (
+    url TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (url, uid)
+);
+CREATE TABLE IF NOT EXISTS schedule (
+    url TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    next_check REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (url, uid)
+);
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    upload_date REAL NOT NULL,
+    delta_base TEXT,
+    metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha1 TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL UNIQUE,
+    refs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS diffs (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+# columns added to the tables since their creation: (table, column, type)
+_SQLITE_COLUMNS = [
+    ("headers", "changed", "INTEGER"),
+    ("headers", "md5", "TEXT"),
+    ("headers", "sha1", "TEXT"),
+]
+
+# name -> definition of the indexes of the SQLite backend
+_SQLITE_INDEXES = [
+    ("headers_url_uid_timestamp", "headers (url, uid, timestamp)"),
+    ("headers_url_uid_version", "headers (url, uid, version)"),
+    ("schedule_uid_next_check", "schedule (uid, next_check)"),
+    ("files_filename_upload_date", "files (filename, upload_date)"),
+    ("files_delta_base", "files (delta_base)"),
+    ("diffs_created", "diffs (created)"),
+]
+
+
+def _uid_key(uid):
+    # primary keys cannot hold NULL (global-view mode)
+    return uid if uid is not None else ""
+
+
+class _MappedFile(object):
+    """
+    Content file of SQLiteBackend read through mmap (the pages are shared
+    with the OS page cache, nothing is copied until read). Metadata of the
+    file are its attributes.
+    """
+    def __init__(self, path, file_id, upload_date, metadata):
+        self._map = None
+        self.__dict__.update(metadata)
+        self._id = file_id
+        self.upload_date = datetime.datetime.utcfromtimestamp(upload_date)
+        with open(path, "rb") as f:
+            self.length = os.fstat(f.fileno()).st_size
+            if self.length:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # empty file cannot be mapped
+                self._map = None
+        self._pos = 0
+
+    def read(self, size=-1):
+        if self._map is None:
+            return ""
+        end = self.length if size is None or size < 0 else min(self.length, self._pos + size)
+        data = self._map[self._pos:end]
+        self._pos = max(self._pos, end)
+        return data
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.length
+        self._pos = max(0, pos)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __del__(self):
+        # files dropped without close() (e.g. contents too large to cache)
+        self.close()
+
+
+class _FileWriter(object):
+    """
+    New content file of SQLiteBackend. Data are written into a temporary
+    file, which is moved into place and registered on close().
+    """
+    def __init__(self, filesystem, metadata):
+        self.__dict__['_filesystem'] = filesystem
+        self.__dict__['_metadata'] = dict(metadata)
+        self.__dict__['_id'] = uuid.uuid4().hex
+        path = filesystem._path(self._id)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # created concurrently
+                pass
+        self.__dict__['_tmp'] = path + ".tmp"
+        self.__dict__['_file'] = open(self._tmp, "wb")
+
+    def __setattr__(self, name, value):
+        self._metadata[name] = value
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.rename(self._tmp, self._filesystem._path(self._id))
+        self._filesystem._register(self._id, self._metadata)
+
+
+class _ShardedFilesystem(object):
+    """
+    Content files of SQLiteBackend stored as root/ab/cd/abcd... (by id).
+    """
+    _CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, backend, root):
+        self._backend = backend
+        self._root = root
+
+    def _path(self, file_id):
+        return os.path.join(self._root, file_id[:2], file_id[2:4], file_id)
+
+    def _register(self, file_id, metadata):
+        self._backend._execute(
+            "INSERT INTO files (id, filename, upload_date, delta_base, metadata) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (file_id, metadata.get("filename"), time.time(), metadata.get("delta_base"),
+             json.dumps(metadata)))
+
+    def put(self, data, **metadata):
+        f = self.new_file(**metadata)
+        try:
+            if isinstance(data, basestring):
+                f.write(data)
+            else:
+                while True:
+                    chunk = data.read(self._CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        finally:
+            f.close()
+        return f._id
+
+    def new_file(self, **metadata):
+        return _FileWriter(self, metadata)
+
+    def _open(self, row):
+        if row is None:
+            raise NoFile("No such file in the storage.")
+        file_id, upload_date, metadata = row
+        try:
+            return _MappedFile(self._path(file_id), file_id, upload_date, json.loads(metadata))
+        except (IOError, OSError):
+            raise NoFile("File %s is missing in the storage." % file_id)
+
+    def get(self, file_id):
+        return self._open(self._backend._query_one(
+            "SELECT id, upload_date, metadata FROM files WHERE id = ?", (file_id,)))
+
+    def get_version(self, filename, version=-1):
+        if version >= 0:
+            order, skip = "ASC", version
+        else:
+            order, skip = "DESC", -version - 1
+        return self._open(self._backend._query_one(
+            "SELECT id, upload_date, metadata FROM files WHERE filename = ? "
+            "ORDER BY upload_date %s LIMIT 1 OFFSET ?" % order, (filename, skip)))
+
+    def exists(self, filename):
+        return self._backend._query_one(
+            "SELECT 1 FROM files WHERE filename = ? LIMIT 1", (filename,)) is not None
+
+    def delete(self, file_id):
+        self._backend._execute("DELETE FROM files WHERE id = ?", (file_id,))
+        try:
+            os.unlink(self._path(file_id))
+        except OSError:
+            pass
+
+
+class _SQLiteHeaderMeta(HttpHeaderMeta):
+    """
+    Model for HTTP header metadata (and latest states) kept by SQLiteBackend.
+    Records have the same form as records of HttpHeaderMeta.
+    """
+    _COLUMNS = "id, url, uid, timestamp, response_code, etag, last_modified, error, content, " \
+               "version, changed, md5, sha1"
+
+    def __init__(self, backend, uid):
+        self._backend = backend
+        self.uid = uid
+        self._queue = None
+
+    def _record(self, row):
+        if row is None:
+            return None
+        h = {"_id": row[0], "url": row[1], "uid": row[2], "timestamp": row[3],
+             "response_code": row[4]}
+        for name, value in zip(("etag", "last_modified", "error", "content", "version",
+                                "changed", "md5", "sha1"), row[5:]):
+            if value is not None:
+                if name == "content":
+                    value = json.loads(value)
+                elif name == "changed":
+                    value = bool(value)
+                h[name] = value
+        return h
+
+    def _where(self, url, last_available):
+        where, args = ["url = ?"], [url]
+        if self.uid is not None:
+            where.append("uid = ?")
+            args.append(self.uid)
+        if last_available:
+            where.append("response_code < 400 AND content IS NOT NULL")
+        return where, args
+
+    def get_by_time(self, url, timestamp, last_available=False):
+        self._sync(url)
+        where, args = self._where(url, last_available)
+        where.append("timestamp < ?")
+        args.append(timestamp)
+        return self._record(self._backend._query_one(
+            "SELECT %s FROM headers WHERE %s ORDER BY timestamp DESC LIMIT 1" % \
+            (self._COLUMNS, " AND ".join(where)), args))
+
+    def get_by_version(self, url, version, last_available=False):
+        self._sync(url)
+        where, args = self._where(url, last_available)
+        if last_available and self.uid is not None:
+            # available contents are always numbered
+            if version >= 0:
+                sql, extra = "AND version = ? LIMIT 1", [version]
+            else:
+                sql, extra = "ORDER BY version DESC LIMIT 1 OFFSET ?", [-version - 1]
+        elif version >= 0:
+            sql, extra = "ORDER BY timestamp ASC LIMIT 1 OFFSET ?", [version]
+        else:
+            sql, extra = "ORDER BY timestamp DESC LIMIT 1 OFFSET ?", [-version - 1]
+        return self._record(self._backend._query_one(
+            "SELECT %s FROM headers WHERE %s %s" % (self._COLUMNS, " AND ".join(where), sql),
+            args + extra))
+
+    def save_header(self, url, response_code, fields, content_id, error=None,
+                    changed=False, md5=None, sha1=None):
+        """
+        @returns: id of the header (None if it is queued, see write_behind())
+        """
+        h = self._make_header(url, response_code, fields, content_id, error,
+                              changed, md5, sha1)
+        if self._queue is not None:
+            # versions are allocated, when the batch is written
+            self._queue.add(url, h)
+            return None
+        self._write_headers([h])
+        return h['_id']
+
+    def _write_headers(self, headers):
+        # one transaction (one sync to disk) for the whole batch
+        with self._backend._transaction() as db:
+            for h in headers:
+                self._insert(db, h)
+
+    def _insert(self, db, h):
+        url = h['url']
+        if self._is_available(h):
+            row = db.execute("SELECT MAX(version) FROM headers WHERE url = ? AND uid IS ?",
+                             (url, self.uid)).fetchone()
+            h['version'] = row[0] + 1 if row[0] is not None else 0
+        cursor = db.execute(
+            "INSERT INTO headers (url, uid, timestamp, response_code, etag, last_modified, "
+            "error, content, version, changed, md5, sha1) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, self.uid, h['timestamp'], h['response_code'], h.get('etag'),
+             h.get('last_modified'), h.get('error'),
+             json.dumps(h['content']) if 'content' in h else None, h.get('version'),
+             h.get('changed'), h.get('md5'), h.get('sha1')))
+        h['_id'] = cursor.lastrowid
+        if self.uid is not None:
+            # the state is updated in the same transaction
+            row = db.execute("SELECT state FROM url_state WHERE url = ? AND uid = ?",
+                             (url, self.uid)).fetchone()
+            state = json.loads(row[0]) if row is not None else {"url": url, "uid": self.uid}
+            state.update(UrlStateMeta.state_fields(h))
+            if 'version' in h:
+                state["changes"] = (state.get("changes", []) + [h['timestamp']])[-2:]
+            db.execute("INSERT OR REPLACE INTO url_state (url, uid, state) VALUES (?, ?, ?)",
+                       (url, self.uid, json.dumps(state)))
+
+    def get_state(self, url):
+        if self.uid is None:
+            return None
+        self._sync(url)
+        row = self._backend._query_one("SELECT state FROM url_state WHERE url = ? AND uid = ?",
+                                       (url, self.uid))
+        return json.loads(row[0]) if row is not None else None
+
+    def get_checks(self, url):
+        self._sync(url)
+        where, args = self._where(url, False)
+        return [(timestamp, None if code is None else bool(has_content))
+                for timestamp, code, has_content in self._backend._query(
+                    "SELECT timestamp, response_code, content IS NOT NULL FROM headers "
+                    "WHERE %s ORDER BY timestamp ASC" % " AND ".join(where), args)]
+
+    def get_urls(self):
+        self._sync()
+        if self.uid is None:
+            rows = self._backend._query("SELECT DISTINCT url FROM headers", ())
+        else:
+            rows = self._backend._query("SELECT DISTINCT url FROM headers WHERE uid = ?",
+                                        (self.uid,))
+        return [row[0] for row in rows]
+
+    def check_uid(self):
+        assert self.uid is not None
+        self._sync()
+        return self._backend._query_one("SELECT 1 FROM headers WHERE uid = ? LIMIT 1",
+                                        (self.uid,)) is not None
+
+    def ensure_indexes(self):
+        self._backend.ensure_indexes()
+
+    def missing_indexes(self):
+        return self._backend.check_indexes()
+
+
+class _SQLiteScheduleMeta(ScheduleMeta):
+    """
+    Model for re-check schedule kept by SQLiteBackend.
+    """
+    def __init__(self, backend, uid):
+        self._backend = backend
+        self.uid = uid
+
+    def _record(self, url, data):
+        record = json.loads(data)
+        record.update({"url": url, "uid": self.uid})
+        return record
+
+    def get(self, url):
+        row = self._backend._query_one("SELECT data FROM schedule WHERE url = ? AND uid = ?",
+                                       (url, _uid_key(self.uid)))
+        return self._record(url, row[0]) if row is not None else None
+
+    def save(self, url, fields):
+        self.save_many([(url, fields)])
+
+    def save_many(self, updates):
+        # one transaction for all the updates
+        with self._backend._transaction() as db:
+            for url, fields in updates:
+                row = db.execute("SELECT data FROM schedule WHERE url = ? AND uid = ?",
+                                 (url, _uid_key(self.uid))).fetchone()
+                data = json.loads(row[0]) if row is not None else {}
+                data.update(fields)
+                db.execute("INSERT OR REPLACE INTO schedule (url, uid, next_check, data) "
+                           "VALUES (?, ?, ?, ?)",
+                           (url, _uid_key(self.uid), data.get("next_check"), json.dumps(data)))
+
+    def get_all(self):
+        return [self._record(url, data) for url, data in self._backend._query(
+            "SELECT url, data FROM schedule WHERE uid = ?", (_uid_key(self.uid),))]
+
+    def get_due(self, timestamp, limit=None):
+        return [self._record(url, data) for url, data in self._backend._query(
+            "SELECT url, data FROM schedule WHERE uid = ? AND next_check <= ? "
+            "ORDER BY next_check ASC LIMIT ?",
+            (_uid_key(self.uid), timestamp, limit if limit is not None else -1))]
+
+    def ensure_indexes(self):
+        self._backend.ensure_indexes()
+
+    def missing_indexes(self):
+        return self._backend.check_indexes()
+
+
+class SQLiteBackend(Backend):
+    """
+    Embedded backend for deployments without MongoDB server: metadata in
+    SQLite database root/metadata.sqlite, contents in files under
+    root/content (sharded by file id) read through mmap.
+
+    Usage:
+        >>> from backend import SQLiteBackend
+        >>> from changemonitor import Monitor
+        >>> monitor = Monitor("rrs_university", backend=SQLiteBackend("/var/lib/monitor"))
+    """
+    def __init__(self, root):
+        """
+        @param root: directory of the storage (created if it does not exist)
+        @type root: str
+        """
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.root = root
+        self._db = sqlite3.connect(os.path.join(root, "metadata.sqlite"),
+                                   check_same_thread=False)
+        # one connection shared by all threads
+        self._lock = threading.RLock()
+        with self._transaction() as db:
+            db.executescript(_SCHEMA)
+            # databases created before the columns
+            for table, column, type_ in _SQLITE_COLUMNS:
+                if column not in [row[1] for row in db.execute("PRAGMA table_info(%s)" % table)]:
+                    db.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, type_))
+        self.ensure_indexes()
+        self.filesystem = _ShardedFilesystem(self, os.path.join(root, "content"))
+
+    def _transaction(self):
+        backend = self
+        class _Transaction(object):
+            def __enter__(self):
+                backend._lock.acquire()
+                return backend._db
+            def __exit__(self, type, value, traceback):
+                try:
+                    if type is None:
+                        backend._db.commit()
+                    else:
+                        backend._db.rollback()
+                finally:
+                    backend._lock.release()
+                return False
+        return _Transaction()
+
+    def _execute(self, sql, args):
+        with self._transaction() as db:
+            return db.execute(sql, args).rowcount
+
+    def _query(self, sql, args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _query_one(self, sql, args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchone()
+
+    def headers(self, uid):
+        return _SQLiteHeaderMeta(self, uid)
+
+    def schedule(self, uid):
+        return _SQLiteScheduleMeta(self, uid)
+
+    def acquire_blob(self, sha1):
+        with self._transaction() as db:
+            if not db.execute("UPDATE blobs SET refs = refs + 1 WHERE sha1 = ?", (sha1,)).rowcount:
+                return None
+            return db.execute("SELECT file_id FROM blobs WHERE sha1 = ?", (sha1,)).fetchone()[0]
+
+    def register_blob(self, sha1, file_id):
+        try:
+            self._execute("INSERT INTO blobs (sha1, file_id, refs) VALUES (?, ?, 1)",
+                          (sha1, file_id))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def _blob(self, row):
+        if row is None:
+            return None
+        return {"_id": row[0], "file_id": row[1], "refs": row[2]}
+
+    def release_blob(self, sha1):
+        with self._transaction() as db:
+            db.execute("UPDATE blobs SET refs = refs - 1 WHERE sha1 = ?", (sha1,))
+            return self._blob(db.execute("SELECT sha1, file_id, refs FROM blobs WHERE sha1 = ?",
+                                         (sha1,)).fetchone())
+
+    def remove_blob(self, sha1):
+        self._execute("DELETE FROM blobs WHERE sha1 = ? AND refs <= 0", (sha1,))
+
+    def find_blob(self, file_id):
+        return self._blob(self._query_one("SELECT sha1, file_id, refs FROM blobs WHERE file_id = ?",
+                                          (file_id,)))
+
+    def has_delta_dependents(self, file_id):
+        return self._query_one("SELECT 1 FROM files WHERE delta_base = ? LIMIT 1",
+                               (file_id,)) is not None
+
+    def get_diff(self, key):
+        row = self._query_one("SELECT data FROM diffs WHERE key = ? AND created >= ?",
+                              (key, time.time() - DIFF_CACHE_TTL))
+        return str(row[0]) if row is not None else None
+
+    def put_diff(self, key, data):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO diffs (key, data, created) VALUES (?, ?, ?)",
+                       (key, sqlite3.Binary(data), now))
+            # expired diffs
+            db.execute("DELETE FROM diffs WHERE created < ?", (now - DIFF_CACHE_TTL,))
+
+    def ensure_indexes(self):
+        with self._transaction() as db:
+            for name, definition in _SQLITE_INDEXES:
+                db.execute("CREATE INDEX IF NOT EXISTS %s ON %s" % (name, definition))
+
+    def check_indexes(self):
+        existing = set(row[0] for row in self._query(
+            "SELECT name FROM sqlite_master WHERE type = 'index'", ()))
+        return ["%s.%s" % (definition.split()[0], name)
+                for name, definition in _SQLITE_INDEXES if name not in existing]
+
+    def __repr__(self):
+        return "SQLiteBackend('%s')" % self.root
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
@@ -21,10 +21,15 @@ class TimeException():
 def init_monitor(args):
     """
     initialize Monitor object
-    set uid, db name and port
+    set uid, db name and port (or SQLite storage)
     @return Monitor object
     """
-    return Monitor(user_id=args.uid, db_port=args.port, db_name=args.db)    
+    backend = None
+    if args.sqlite is not None:
+        from backend import SQLiteBackend
+        backend = SQLiteBackend(args.sqlite)
+    return Monitor(user_id=args.uid, db_port=args.port, db_name=args.db,
+                   recheck_budget=args.budget, backend=backend)
 
 def parse_time(timestr):
     """
@@ -51,26 +56,37 @@ def url_check(args,monitor):
     """
     check functionality
     """
+    if args.tree:
+        monitor.use_tree_diff()
     if args.url is not None:
         r = monitor.get(args.url)
         print "----------"
         print "Checking ",args.url,"\nForced check: ",args.force
         print "Changed since last check: ",r.check(force=args.force)
-    elif args.list is not None:
-        try:
-            f_in = open(args.list)
-            for u in f_in:
-                if "\r\n" in u:  # CRLF line ending
-                    i = -2
-                else:            # CR only or LF only line ending
-                    i = -1
-                r = monitor.get(u[:i])
-                print "----------"
-                print "Checking ",u[:i],"\nForced check: ",args.force
-                print "Changed since last check: ",r.check(force=args.force)
-        except Exception:
-            print "Cannot open file\n"
-            exit(10)           
+    elif args.list is not None or args.due:
+        if args.due:
+            if args.budget is None:
+                print "Re-check budget not specified (--budget)"
+                exit(2)
+            urls = monitor.due_urls()
+        else:
+            try:
+                f_in = open(args.list)
+                urls = [u.rstrip("\r\n") for u in f_in if u.strip()]
+                f_in.close()
+            except IOError:
+                print "Cannot open file\n"
+                exit(10)
+        # headers of the batch are written by bulk inserts
+        monitor.write_behind()
+        for res in monitor.check_multi(urls, workers=args.workers, force=args.force):
+            print "----------"
+            print "Checking ",res.url,"\nForced check: ",args.force
+            if res.error is not None:
+                print "Check failed: ",res.error
+            else:
+                print "Changed since last check: ",res.changed
+        monitor.close()
     else:
         print "Bad parameters, no url specified"
         exit(2) 
@@ -84,13 +100,13 @@ def url_diff(args,monitor):
         try:
             if (args.v is not None) and (len(args.v)==2): # versions specified
                 c1 = r.get_version(args.v[0])
-                d = r.get_diff(args.v[0],args.v[1])
+                d = r.get_diff(args.v[0],args.v[1],tree=args.tree)
             elif (args.t is not None) and (len(args.t)==2): # times specified
                 try:
                     t0 = parse_time(args.t[0])
                     t1 = parse_time(args.t[1])
                     c1 = r.get_version(t0)
-                    d = r.get_diff(t0,t1)
+                    d = r.get_diff(t0,t1,tree=args.tree)
                 except TimeException:
                     exit(3)                
             else:
@@ -171,6 +187,38 @@ def url_available(args,monitor):
         print "Error: url not specified"
         exit(2)
 
+def dedup(args,monitor):
+    """
+    deduplicate contents stored in the database
+    """
+    stats = monitor.deduplicate()
+    print "Files scanned: ",stats['files']
+    print "Headers linked to their contents: ",stats['linked']
+    print "Duplicates removed: ",stats['duplicates']," (",stats['bytes']," bytes)"
+
+def number(args,monitor):
+    """
+    number versions of histories stored before the numbering
+    """
+    stats = monitor.number_versions()
+    print "Histories numbered: ",stats['urls']," (",stats['versions']," versions)"
+    print "Histories postponed: ",stats['postponed']
+
+def compact(args,monitor):
+    """
+    compact history stored in the database by retention policy
+    """
+    import maintenance
+    tiers = [(args.keep_all * maintenance.DAY, None),
+             (args.keep_daily * maintenance.DAY, maintenance.DAY),
+             (None, maintenance.WEEK)]
+    policy = maintenance.RetentionPolicy(tiers, thin_headers=not args.keep_headers)
+    stats = monitor.compact(policy, pause=args.pause)
+    print "Urls compacted: ",stats['urls']
+    print "Versions removed: ",stats['versions']," (",stats['contents']," contents deleted)"
+    print "Headers removed: ",stats['headers']
+    print "Orphaned contents removed: ",stats['orphans']
+
 def parse_args():
     """
     parse command line arguments
@@ -185,11 +233,17 @@ def parse_args():
     parser.add_argument("--db",default="webarchive",help="name of database")
     parser.add_argument("--port",default=27017,type=int,
         help="port of database server")
+    parser.add_argument("--budget",default=None,type=int,
+        help="number of checks per day for adaptive re-check scheduling")
+    parser.add_argument("--sqlite",default=None,metavar="DIR",
+        help="keep the data in SQLite storage in DIR instead of MongoDB")
 
     # specify url(s) to perform action on
-    url_list = parser.add_mutually_exclusive_group(required=True)
+    url_list = parser.add_mutually_exclusive_group()
     url_list.add_argument("--url",help="specify a single url")
     url_list.add_argument("--list",help="specify a file with urls to check")
+    url_list.add_argument("--due",action="store_true",
+        help="check urls, which are due according to re-check schedule")
 
     #subparsers for individual actions
     subparsers = parser.add_subparsers(title="subcommands",dest="action")
@@ -199,6 +253,10 @@ def parse_args():
         help="check documents at specified url(s)")
     parser_check.add_argument("--force",action="store_true",
         help="force download of content")
+    parser_check.add_argument("--workers",default=8,type=int,
+        help="number of concurrently checked urls (with --list/--due)")
+    parser_check.add_argument("--tree",action="store_true",
+        help="compare html by element trees (markup-only changes do not count)")
     parser_check.set_defaults(func=url_check)
 
     # find differences between versions A and B of the same document
@@ -208,6 +266,8 @@ def parse_args():
     parser_diff_v_or_t.add_argument("-v",nargs=2,type=int,
         help="version by version numbers")
     parser_diff_v_or_t.add_argument("-t",nargs=2,help="version by timestamps")
+    parser_diff.add_argument("--tree",action="store_true",
+        help="diff html by element trees (chunks positioned by XPath)")
     parser_diff.set_defaults(func=url_diff)
 
     # print out the contents of document saved in database
@@ -224,6 +284,29 @@ def parse_args():
     parser_available.add_argument("-t",help="specify time")    
     parser_available.set_defaults(func=url_available)
 
+    # deduplicate contents of the whole database (no url needed)
+    parser_dedup = subparsers.add_parser("dedup",
+        help="deduplicate identical contents stored in the database")
+    parser_dedup.set_defaults(func=dedup)
+
+    # number versions of old histories of the whole database (no url needed)
+    parser_number = subparsers.add_parser("number",
+        help="number versions of histories stored before the numbering")
+    parser_number.set_defaults(func=number)
+
+    # compact history of the whole database (no url needed)
+    parser_compact = subparsers.add_parser("compact",
+        help="remove old versions and headers by retention policy")
+    parser_compact.add_argument("--keep-all",default=30,type=int,metavar="DAYS",
+        help="keep all versions younger than DAYS")
+    parser_compact.add_argument("--keep-daily",default=365,type=int,metavar="DAYS",
+        help="keep a version per day of versions younger than DAYS, then per week")
+    parser_compact.add_argument("--keep-headers",action="store_true",
+        help="do not remove headers of checks, which did not change anything")
+    parser_compact.add_argument("--pause",default=0.0,type=float,
+        help="seconds to sleep between batches of urls")
+    parser_compact.set_defaults(func=compact)
+
     return parser.parse_args()
 
 def main():
@@ -26,24 +26,112 @@ __email__ = "xhelle03@stud.fit.vutbr.cz"
 __date__  = "$21.6.2012 16:08:11$"
 
 import string
+import time
+import heapq
+import itertools
+import threading
+import Queue
+import asyncore
 import diff
+import maintenance
 
+from collections import deque, namedtuple
 from urlparse import urlparse
 
 from gridfs.errors import NoFile
 from pymongo import Connection
 
-from model import HttpHeaderMeta, Content, Storage, File
-from resolver import Resolver
-from _http import HTTPDateTime
+from model import HttpHeaderMeta, Content, Storage, File, DELTA_KEYFRAME_INTERVAL, \
+                  DEFAULT_CODEC, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY
+from resolver import Resolver, AsyncResolver
+from _http import HTTPDateTime, _HTTPConnectionPool, _AsyncHTTPExchange
+from scheduler import RecheckScheduler
 from errors import *
 
-__all__ = ["Monitor", "MonitoredResource", "HTTPDateTime"]
+__all__ = ["Monitor", "AsyncMonitor", "MonitoredResource", "HTTPDateTime", "CheckResult"]
 
 # constant defining the size of file, which is supposed to be "large"
 # for more info see Monitor.allow_large_docuements.__doc__
 LARGE_DOCUMENT_SIZE = 4096
 
+# default number of worker threads of Monitor.check_multi
+CHECK_MULTI_WORKERS = 8
+
+# default maximum of concurrent checks of one host in Monitor.check_multi
+CHECK_MULTI_PER_HOST = 2
+
+# result of checking one URL within Monitor.check_multi: *resource* and
+# *changed* are None if the check failed with exception *error*
+CheckResult = namedtuple('CheckResult', 'url, resource, changed, error')
+
+# default maximum of checks in flight in AsyncMonitor.check_multi
+ASYNC_MAX_IN_FLIGHT = 1000
+
+# default number of database worker threads of AsyncMonitor.check_multi
+ASYNC_DB_WORKERS = 4
+
+# how long (seconds) the event loop of AsyncMonitor waits for socket events
+_ASYNC_POLL_INTERVAL = 0.05
+
+
+class _HostQueue(object):
+    """
+    Queue of URLs waiting to be checked, grouped by host (net location).
+    pop() returns URLs round-robin over hosts and skips hosts which already
+    have *per_host* URLs in progress or which are not ready according to the
+    politeness scheduler; done() frees the slot of the host.
+    """
+    def __init__(self, urls, per_host, scheduler=None):
+        self._per_host = per_host
+        self._scheduler = scheduler
+        self._waiting = {}
+        self._running = {}
+        self._hosts = deque()
+        for url in urls:
+            netloc = urlparse(url).netloc
+            if netloc not in self._waiting:
+                self._waiting[netloc] = deque()
+                self._running[netloc] = 0
+                self._hosts.append(netloc)
+            self._waiting[netloc].append(url)
+
+    def pop(self):
+        """
+        @returns: URL to be checked next or None if there is no URL waiting
+                  or all hosts with waiting URLs are busy
+        @rtype: str or None
+        """
+        for _ in xrange(len(self._hosts)):
+            netloc = self._hosts[0]
+            self._hosts.rotate(-1)
+            if self._running[netloc] < self._per_host and self._delay(netloc) <= 0:
+                url = self._waiting[netloc].popleft()
+                self._running[netloc] += 1
+                if not self._waiting[netloc]:
+                    self._hosts.remove(netloc)
+                return url
+        return None
+
+    def done(self, url):
+        self._running[urlparse(url).netloc] -= 1
+
+    def ready_in(self):
+        """
+        @returns: seconds until pop() can return an URL (0 if it can now) or
+                  None if no waiting URL has a free slot of its host
+        @rtype: float or None
+        """
+        delays = [self._delay(netloc) for netloc in self._hosts
+                  if self._running[netloc] < self._per_host]
+        if not delays:
+            return None
+        return max(0.0, min(delays))
+
+    def _delay(self, netloc):
+        if self._scheduler is None:
+            return 0.0
+        return self._scheduler.delay(self._waiting[netloc][0])
+
 
 class MonitoredResource(object):
     """
@@ -105,7 +193,7 @@ class MonitoredResource(object):
         >>> resource.last_checked()
         HTTPDateTime(Thu, 01 Jan 1970 00:00:00 GMT)
     """
-    def __init__(self, url, uid, storage):
+    def __init__(self, url, uid, storage, resolver_options=None, diff_options=None):
         """
         @param url: monitored URL
         @type url:  basestring (str or unicode)
@@ -114,17 +202,26 @@ class MonitoredResource(object):
         @type uid: str
         @param storage: storage of monitored-resource data
         @type storage: model.Storage
+        @param resolver_options: keyword arguments passed to the Resolver
+                                 (shared HTTP connection pool etc.)
+        @type resolver_options: dict
+        @param diff_options: default keyword arguments of get_diff() (used
+                             by check() too)
+        @type diff_options: dict
         """
         # resource data
         self.url = url
         self.uid = uid
+        self.diff_options = diff_options if diff_options is not None else {}
 
         # models
         self.storage = storage
         self.headers = storage._headermeta
 
         # resolver
-        self.resolver = Resolver(storage)
+        if resolver_options is None:
+            resolver_options = {}
+        self.resolver = Resolver(storage, **resolver_options)
         self._checked = False
         # file
         try:
@@ -151,9 +248,15 @@ class MonitoredResource(object):
             if force=False, doesn't try to download new content if called more than once
         @type force: Bool
 
-        @raises: DocumentTooLargeException
+        @raises: DocumentTooLarge if the document exceeds LARGE_DOCUMENT_SIZE
+                 and large documents are not allowed (the check is recorded,
+                 but the content is not downloaded)
         @raises: DocumentNotAvailable
-        @returns: True if the document has changed since last check.
+        @returns: True if the document has changed since last check. The
+                  change is read from the state of the url saved by the
+                  check; contents are diffed only in the tree diff mode
+                  (see Monitor.use_tree_diff()) or for histories saved
+                  without the change flags.
         """
         # bude vyuzivat resolveru pro checknuti URL a ziskani informace o tom,
         # jestli byl dokument zmenen. Mozna bude take dobre nahrat rovnou do
@@ -174,9 +277,21 @@ class MonitoredResource(object):
                 raise DocumentNotAvailable("Resource '%s' is not available." % self.url)
         
         # and determine return value
+        state = self.headers.get_state(self.url)
+        if state is not None and 'changed' in state:
+            # the resolver records with every check, whether it found new
+            # content (by its hashes); only the tree diff may tell, that the
+            # new html is the same document
+            if not state['changed'] or not self.diff_options.get('tree'):
+                return state['changed']
+        # times of the last two contents are kept in the state of the url
+        changes = state.get('changes', []) if state is not None else []
         try:
         # time of last check
-            _now = self.headers.get_by_version(self.url,-1,True)['timestamp'] 
+            if changes:
+                _now = changes[-1]
+            else:
+                _now = self.headers.get_by_version(self.url,-1,True)['timestamp'] 
             _now = HTTPDateTime().from_timestamp(_now+1) 
             # header and content are saved at the same time
             # we need to find content inserted before _now, that's why (_now+1)
@@ -184,8 +299,11 @@ class MonitoredResource(object):
             raise DocumentNotAvailable("Check failed. Cannot get header information of '%s'." % self.url)
         try:
         # time of previous check
-            _prev = self.headers.get_by_version(self.url,-2,True)
-            _prev = HTTPDateTime().from_timestamp(_prev['timestamp']+1)
+            if len(changes) == 2:
+                _prev = HTTPDateTime().from_timestamp(changes[0]+1)
+            else:
+                _prev = self.headers.get_by_version(self.url,-2,True)
+                _prev = HTTPDateTime().from_timestamp(_prev['timestamp']+1)
         except TypeError: # this is first time document is checked
             if self._checked: return False  # if already checked, and have no v=-2 header, there was no change
             else:             return True   # this is the first-time check
@@ -260,12 +378,16 @@ class MonitoredResource(object):
             raise TypeError("Version time has to be type HTTPDateTime or GridFS version (int).")
 
 
-    def get_diff(self, start, end):
+    def get_diff(self, start, end, tree=None):
         """
         @param start: start time or version to be diffed
         @type start: HTTPDateTime or int
         @param end: end time or version to be diffed
         @type end: HTTPDateTime or int
+        @param tree: diff html structurally (see diff.HtmlTreeDiff); None
+                     for the default of the monitor (see
+                     Monitor.use_tree_diff())
+        @type tree: bool
         @returns: either textual or binary diff of the file (if available).
                   If contents are equal (document did not change within this
                   time range) returns None.
@@ -277,7 +399,10 @@ class MonitoredResource(object):
         content_end = self.get_version(end)
         if content_start == content_end:
             return None
-        return content_start.diff_to(content_end)
+        options = dict(self.diff_options)
+        if tree is not None:
+            options['tree'] = tree
+        return content_start.diff_to(content_end, cache=self.storage.diff_cache, **options)
 
 
     def available(self, httptime=None):
@@ -334,10 +459,12 @@ class Monitor(object):
         >>> if resource.check():
         >>>     print res.get_diff(start='last', end='now')
     """
-    def __init__(self, user_id, db_host="localhost", db_port=27017, db_name="webarchive", http_proxy=None):
+    def __init__(self, user_id, db_host="localhost", db_port=27017, db_name="webarchive",
+                 http_proxy=None, revalidate=False, scheduler=None,
+                 recheck_budget=None, backend=None):
         """
         Create a new monitor connected to MongoDB at *db_host:db_port* using
-        database db_name.
+        database db_name, or keeping the data in another storage backend.
 
         @param user_id: identification string of user/module who uses monitor.
                         If user_id is given None, the monitor switches to
@@ -363,6 +490,22 @@ class Monitor(object):
         @type db_name: str
         @param http_proxy: (FUTURE USE) proxy server where to send requests
         @type http_proxy: unknown
+        @param revalidate: revalidation mode -- check resources by one
+                           conditional GET (If-None-Match/If-Modified-Since
+                           with the stored etag and last-modified) instead of
+                           HEAD followed by GET. 304 Not Modified stores only
+                           the header.
+        @type revalidate: bool
+        @param scheduler: politeness scheduler limiting the requests sent to
+                          each host (None for no limits)
+        @type scheduler: scheduler.HostScheduler
+        @param recheck_budget: number of checks per day for adaptive re-check
+                               scheduling (see due_urls()); None disables it
+        @type recheck_budget: int
+        @param backend: storage backend used instead of MongoDB at
+                        db_host:db_port (e.g. backend.SQLiteBackend, which
+                        needs no database server)
+        @type backend: backend.Backend
         """
         if not isinstance(user_id, basestring) and user_id is not None:
             raise TypeError("User ID has to be type str or None.")
@@ -372,12 +515,30 @@ class Monitor(object):
         if http_proxy is not None:
             raise NotImplementedError("HTTP proxy not supported yet.")
         # initialize models
-        self._init_models(db_host, db_port, db_name, user_id)
-
-
-    def _init_models(self, host, port, db, uid):
-        self._conn = Connection(host, port)
-        self._storage = Storage(self._conn, uid, db)
+        self._init_models(db_host, db_port, db_name, user_id, backend)
+        # keep-alive connections shared by resolvers of all resources
+        self._http_pool = _HTTPConnectionPool()
+        self._scheduler = scheduler
+        if recheck_budget is not None:
+            self._recheck = RecheckScheduler(self._storage, recheck_budget)
+        else:
+            self._recheck = None
+        self._resolver_options = {'http_pool': self._http_pool,
+                                  'revalidate': revalidate,
+                                  'max_size': LARGE_DOCUMENT_SIZE * 1024,
+                                  'scheduler': scheduler,
+                                  'recheck': self._recheck}
+        # default options of diffs of the resources
+        self._diff_options = {}
+
+
+    def _init_models(self, host, port, db, uid, backend=None):
+        if backend is None:
+            self._conn = Connection(host, port)
+            self._storage = Storage(self._conn, uid, db)
+        else:
+            self._conn = None
+            self._storage = Storage(backend, uid)
         self._dbname = db
         self._dbport = port
         self._dbhost = host
@@ -395,14 +556,25 @@ class Monitor(object):
         
         Design pattern: factory method.
         """
-        # test the url validity
+        # return monitored resource object
+        return MonitoredResource(self._parse_url(url), self._user_id, self._storage,
+                                 self._resolver_options, self._diff_options)
+
+
+    def _parse_url(self, url):
+        """
+        Test the url validity.
+
+        @returns: normalized URL
+        @rtype: str
+        @raises: ValueError if the URL is not valid
+        """
         parse_result = urlparse(url)
         if parse_result.netloc == '':
             raise ValueError("URL '%s' is not properly formatted: missing netloc." % url)
         if parse_result.scheme == '':
             raise ValueError("URL '%s' is not properly formatted: missing scheme." % url)
-        # return monitored resource object
-        return MonitoredResource(parse_result.geturl(), self._user_id, self._storage)
+        return parse_result.geturl()
 
 
     def allow_large_documents(self):
@@ -411,6 +583,9 @@ class Monitor(object):
         defined as file larger than 4096KB. Tis constant is defined in this
         module named as LARGE_DOCUMENT_SIZE representing size of the file
         in kilobytes.
+
+        Unless allowed, download of a large document is aborted as soon as
+        its size is known to exceed the limit and DocumentTooLarge is raised.
         """
         try:
             # just delegate to storage model
@@ -419,6 +594,142 @@ class Monitor(object):
             raise RuntimeError("Models arent initialized. Something went to hell...")
         
 
+    def store_deltas(self, keyframe_interval=DELTA_KEYFRAME_INTERVAL):
+        """
+        Store new versions of documents as binary deltas against their
+        previous versions, with a whole version (keyframe) every
+        *keyframe_interval* versions. Reading the versions is transparent.
+        Useful for archives of pages, which change only a little.
+
+        @param keyframe_interval: maximal number of versions between two
+                                  keyframes (None stores all versions whole)
+        @type keyframe_interval: int
+        """
+        self._storage.store_deltas(keyframe_interval)
+
+
+    def write_behind(self, max_size=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY):
+        """
+        Write headers of the checks in batches of *max_size* headers (or of
+        the headers saved within *max_delay* seconds) instead of one by one.
+        Useful for large batches of checks (see check_multi()). The monitor
+        reads its own writes; the rest is written by flush(), close() and
+        at exit.
+
+        @param max_size: headers per batch (None switches the batches off)
+        @type max_size: int
+        @param max_delay: maximal time (seconds) a header waits for its batch
+        @type max_delay: float
+        """
+        self._storage.write_behind(max_size, max_delay)
+
+
+    def flush(self):
+        """
+        Write all queued headers (see write_behind()).
+        """
+        self._storage.flush()
+
+
+    def use_tree_diff(self, enabled=True):
+        """
+        Diff html documents structurally: their element trees are compared
+        instead of lines, so changes of markup only (order of attributes,
+        whitespace, line wrapping) are not reported and check() does not
+        count them as changes (see diff.HtmlTreeDiff).
+
+        @param enabled: True for the tree diff, False for the line diff
+        @type enabled: bool
+        """
+        self._diff_options['tree'] = enabled
+
+
+    def use_codec(self, codec=DEFAULT_CODEC):
+        """
+        Set codec compressing contents stored from now on ("zlib" by default,
+        "zstd" if python-zstandard is installed, None for no compression).
+        Stored contents are decompressed transparently.
+
+        @param codec: name of the codec
+        @type codec: str or None
+        """
+        self._storage.use_codec(codec)
+
+
+    def deduplicate(self):
+        """
+        Deduplicate contents stored in the whole database by their SHA-1 (see
+        maintenance.deduplicate()). Contents stored from now on are
+        deduplicated when they are stored.
+
+        @returns: statistics of the deduplication
+        @rtype: dict
+        """
+        return maintenance.deduplicate(self._storage)
+
+
+    def number_versions(self):
+        """
+        Number versions of histories stored in the whole database before
+        the versions were numbered (see maintenance.number_versions()).
+        Numbered versions are found by an index instead of counting.
+
+        @returns: statistics of the numbering
+        @rtype: dict
+        """
+        return maintenance.number_versions(self._storage)
+
+
+    def compact(self, policy=None, pause=0.0):
+        """
+        Compact history stored in the whole database according to the
+        retention policy: remove old versions and headers of checks, which
+        did not change anything (see maintenance.Compaction). For a long
+        running compaction in the background use maintenance.Compaction
+        directly.
+
+        @param policy: retention policy (maintenance.RetentionPolicy() by
+                       default: all versions for 30 days, then one a day for
+                       a year, then one a week)
+        @type policy: maintenance.RetentionPolicy
+        @param pause: time (seconds) to sleep between the batches
+        @type pause: float
+        @returns: statistics of the compaction
+        @rtype: dict
+        """
+        return maintenance.Compaction(self._storage, policy).run(pause)
+
+
+    def due_urls(self, limit=None):
+        """
+        Get URLs, which are due to be checked according to their estimated
+        change rates and the re-check budget (see scheduler.RecheckScheduler).
+        The result can be passed directly to check_multi(). Resources checked
+        before the scheduling was enabled are scheduled by rebuild_schedule().
+
+        @param limit: maximal number of URLs (None for all)
+        @type limit: int
+        @returns: URLs to be checked, the most overdue first
+        @rtype: list
+        @raises: RuntimeError if the monitor has no re-check budget
+        """
+        if self._recheck is None:
+            raise RuntimeError("Re-check scheduling is disabled, set recheck_budget.")
+        return self._recheck.due(limit)
+
+
+    def rebuild_schedule(self):
+        """
+        Estimate change rates of all checked resources from their history and
+        schedule their next checks.
+
+        @raises: RuntimeError if the monitor has no re-check budget
+        """
+        if self._recheck is None:
+            raise RuntimeError("Re-check scheduling is disabled, set recheck_budget.")
+        self._recheck.rebuild()
+
+
     def check_uid(self):
         """
         Check if user id given in constructor is a valid user id within
@@ -435,19 +746,120 @@ class Monitor(object):
         return self._storage.check_uid()
 
 
-    def check_multi(self, urls=[]):
+    def check_indexes(self):
+        """
+        Check that the storage has all indexes needed by the monitor. Missing
+        indexes are created when the monitor starts; this reports indexes,
+        which could not be created.
+
+        @returns: missing indexes as "collection.index_name" strings
+        @rtype: list
+        """
+        return self._storage.check_indexes()
+
+
+    def check_multi(self, urls=[], workers=CHECK_MULTI_WORKERS,
+                    per_host=CHECK_MULTI_PER_HOST, force=False):
         """
-        Check list of urls, start new thread for each one.
-        @param urls:
+        Check list of urls concurrently by a pool of worker threads. Every
+        worker creates the MonitoredResource and calls its check() method.
+        URLs are dispatched round-robin over hosts, so that at most *per_host*
+        checks of one host run at the same time while the other workers keep
+        checking other hosts.
+
+        Failure of one URL does not stop the batch, the exception is returned
+        in the result instead.
+
+        Usage:
+            >>> for r in monitor.check_multi(urls):
+            >>>     if r.error is None and r.changed:
+            >>>         print r.url, "has changed"
+
+        @param urls: URLs to be checked
         @type urls: list
-        @returns: list of MonitoredResource objects, each with actual data
-        @rtype: list<MonitoredResource>
+        @param workers: number of worker threads
+        @type workers: int
+        @param per_host: maximum of concurrent checks of one host (net location)
+        @type per_host: int
+        @param force: passed to MonitoredResource.check()
+        @type force: bool
+        @returns: generator of results in the order the checks complete
+        @rtype: generator of CheckResult
+        """
+        if workers < 1 or per_host < 1:
+            raise ValueError("workers and per_host have to be positive integers.")
+        queue = _HostQueue(urls, per_host, self._scheduler)
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        threads = []
+        for _ in xrange(min(workers, len(urls))):
+            t = threading.Thread(target=self._check_worker, args=(tasks, results, force))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        in_flight = 0
+        try:
+            while True:
+                # fill free workers
+                while in_flight < len(threads):
+                    url = queue.pop()
+                    if url is None:
+                        break
+                    tasks.put(url)
+                    in_flight += 1
+                # how long until another host is ready (None = wait for a result)
+                wait = queue.ready_in()
+                if in_flight == 0:
+                    if wait is None:
+                        break
+                    time.sleep(wait)
+                    continue
+                if in_flight >= len(threads) or wait is None:
+                    result = results.get()
+                else:
+                    try:
+                        result = results.get(True, wait)
+                    except Queue.Empty:
+                        continue
+                queue.done(result.url)
+                in_flight -= 1
+                yield result
+        finally:
+            # stop the workers (also when the caller did not consume everything)
+            for _ in threads:
+                tasks.put(None)
+
+
+    def _check_worker(self, tasks, results, force):
+        """
+        Body of the worker thread of check_multi().
         """
-        # TODO: zkontrolovat, jestli vsechny prvky v urls jsou validni URL adresy
-        raise NotSupportedYet()
+        while True:
+            url = tasks.get()
+            if url is None:
+                return
+            resource = changed = error = None
+            try:
+                resource = self.get(url)
+                changed = resource.check(force=force)
+            except Exception as e:
+                error = e
+            results.put(CheckResult(url, resource, changed, error))
+
+
+    def close(self):
+        """
+        Write queued headers and release resources held by the monitor
+        (idle HTTP connections).
+        """
+        self._storage.flush()
+        self._http_pool.close()
 
 
     def __repr__(self):
+        if self._conn is None:
+            return "Monitor(backend=%r, uid='%s')" % (self._storage._backend, self._user_id)
         return "Monitor(conn=%s, dbname='%s', uid='%s')" % \
             (self._conn.connection, self._dbname, self._user_id)
 
@@ -455,6 +867,160 @@ class Monitor(object):
     __str__ = __repr__
 
 
+
+class AsyncMonitor(Monitor):
+    """
+    Monitor, which checks batches of URLs by non-blocking sockets in a single
+    event loop (asyncore), so one process can keep thousands of checks in
+    flight. The loop only sends HTTP requests and makes the store decisions,
+    reading and writing the storage is done by a few worker threads.
+
+    Usage:
+        >>> from rrslib.web.changemonitor import AsyncMonitor
+        >>> monitor = AsyncMonitor(user_id="rrs_university")
+        >>> for r in monitor.check_multi(urls, max_in_flight=5000):
+        >>>     print r.url, r.changed, r.error
+
+    The number of checks in flight is limited by the number of open file
+    descriptors of the process (one socket per check), see `ulimit -n`.
+    """
+
+    def check_multi(self, urls=[], max_in_flight=ASYNC_MAX_IN_FLIGHT,
+                    per_host=CHECK_MULTI_PER_HOST, db_workers=ASYNC_DB_WORKERS):
+        """
+        Check list of urls in the event loop. Every URL is always resolved
+        (the same as MonitoredResource.check(force=True)); the document has
+        changed, if the resolver stored a new content and it is not the first
+        content of the url.
+
+        Failure of one URL does not stop the batch, the exception is returned
+        in the result instead.
+
+        @param urls: URLs to be checked
+        @type urls: list
+        @param max_in_flight: maximum of checks in progress at the same time
+        @type max_in_flight: int
+        @param per_host: maximum of concurrent checks of one host (net location)
+        @type per_host: int
+        @param db_workers: number of threads working with the storage
+        @type db_workers: int
+        @returns: generator of results in the order the checks complete
+        @rtype: generator of CheckResult
+        """
+        if max_in_flight < 1 or per_host < 1 or db_workers < 1:
+            raise ValueError("max_in_flight, per_host and db_workers have to be positive integers.")
+        queue = _HostQueue(urls, per_host, self._scheduler)
+        # asyncore socket map of this batch
+        sockets = {}
+        # requests postponed by the politeness scheduler: (time, seq, function)
+        timers = []
+        seq = itertools.count()
+        def defer(delay, function):
+            heapq.heappush(timers, (time.time() + delay, next(seq), function))
+        # tasks for the database workers and events for the loop
+        db_tasks = Queue.Queue()
+        events = Queue.Queue()
+        threads = []
+        for _ in xrange(db_workers):
+            t = threading.Thread(target=self._async_db_worker, args=(db_tasks, events))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        in_flight = 0
+        try:
+            while True:
+                while in_flight < max_in_flight:
+                    url = queue.pop()
+                    if url is None:
+                        break
+                    in_flight += 1
+                    try:
+                        resolver = AsyncResolver(self._storage, **self._resolver_options)
+                        db_tasks.put(('prepare', url, self._parse_url(url), resolver, None))
+                    except ValueError as e:
+                        events.put(('done', url, CheckResult(url, None, None, e)))
+                if in_flight == 0:
+                    wait = queue.ready_in()
+                    if wait is None:
+                        break
+                    time.sleep(wait)
+                    continue
+                while timers and timers[0][0] <= time.time():
+                    heapq.heappop(timers)[2]()
+                if sockets:
+                    asyncore.loop(timeout=_ASYNC_POLL_INTERVAL, use_poll=True,
+                                  map=sockets, count=1)
+                    _AsyncHTTPExchange.expire(sockets)
+                if sockets:
+                    # the sockets were just polled
+                    block, timeout = False, None
+                elif timers:
+                    # wait for the workers until the next postponed request
+                    block = True
+                    timeout = max(0, min(timers[0][0] - time.time(), _ASYNC_POLL_INTERVAL))
+                else:
+                    block, timeout = True, _ASYNC_POLL_INTERVAL
+                try:
+                    event = events.get(block, timeout)
+                    while True:
+                        if event[0] == 'prepared':
+                            _, url, (normalized, resolver) = event
+                            self._async_start(url, normalized, resolver, sockets,
+                                              defer, db_tasks, events)
+                        else:
+                            _, url, result = event
+                            queue.done(url)
+                            in_flight -= 1
+                            yield result
+                        event = events.get_nowait()
+                except Queue.Empty:
+                    pass
+        finally:
+            for _ in threads:
+                db_tasks.put(None)
+            for d in sockets.values():
+                d.close()
+
+
+    def _async_start(self, url, normalized, resolver, sockets, defer, db_tasks, events):
+        """
+        Start resolving of the url in the event loop.
+        """
+        def on_decision(decision, error):
+            if error is not None:
+                events.put(('done', url, CheckResult(url, None, None, error)))
+            else:
+                db_tasks.put(('store', url, normalized, resolver, decision))
+        resolver.start(normalized, on_decision, sockets, defer)
+
+
+    def _async_db_worker(self, tasks, events):
+        """
+        Body of the database worker thread of AsyncMonitor.check_multi().
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            step, url, normalized, resolver, decision = task
+            try:
+                if step == 'prepare':
+                    resolver.prepare(normalized)
+                    events.put(('prepared', url, (normalized, resolver)))
+                    continue
+                resolver.store(normalized, decision)
+                if decision[0] == 3:
+                    raise DocumentNotAvailable("Resource '%s' is not available." % normalized)
+                resource = MonitoredResource(normalized, self._user_id, self._storage,
+                                             self._resolver_options, self._diff_options)
+                resource._checked = True
+                result = CheckResult(url, resource, bool(resolver.changed), None)
+            except Exception as e:
+                result = CheckResult(url, None, None, e)
+            events.put(('done', url, result))
+
+
 if __name__ == "__main__":
     m = Monitor(user_id='rrs',db_port=27017) # db_port=27017 is default
 #    print m
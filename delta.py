@@ -0,0 +1,152 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Delta -- in-process binary delta encoding of document versions
+
+Encodes a version of a document as a list of instructions, which rebuild
+it from the previous version: COPY (offset and length of a block of the
+previous version) and INSERT (literal data). Matches are found through an
+index of fixed-size blocks of the source, so the encoding runs in linear
+time and near-duplicate versions (e.g. only a date in the footer changed)
+shrink to a few bytes.
+
+Format of the delta:
+    magic "CMD1", length of the source and of the target (varints), then
+    instructions: 'C' offset length | 'I' length data (varints)
+"""
+
+__modulename__ = "delta"
+__date__ = "$16.10.2026 16:05:12$"
+
+from cStringIO import StringIO
+
+_MAGIC = "CMD1"
+# length of the indexed blocks of the source (shorter matches are not used)
+BLOCK_SIZE = 32
+
+_COPY = "C"
+_INSERT = "I"
+
+
+class DeltaError(ValueError):
+    """
+    Delta is corrupted or does not belong to the source.
+    """
+    pass
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.write(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.write(chr(n))
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        try:
+            b = ord(data[pos])
+        except IndexError:
+            raise DeltaError("Unexpected end of delta.")
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def encode(source, target, block_size=BLOCK_SIZE):
+    """
+    Compute delta, which rebuilds target from source.
+
+    @param source: previous version
+    @type source: str
+    @param target: new version
+    @type target: str
+    @returns: the delta
+    @rtype: str
+    """
+    out = StringIO()
+    out.write(_MAGIC)
+    _write_varint(out, len(source))
+    _write_varint(out, len(target))
+
+    # first occurence of every aligned block of the source
+    index = {}
+    for offset in xrange(0, len(source) - block_size + 1, block_size):
+        index.setdefault(source[offset:offset + block_size], offset)
+
+    literal_start = 0
+    pos = 0
+    end = len(target) - block_size
+    while pos <= end:
+        offset = index.get(target[pos:pos + block_size])
+        if offset is None:
+            pos += 1
+            continue
+        # extend the match backwards (into the pending literal) and forwards
+        start = pos
+        while start > literal_start and offset > 0 and \
+              source[offset - 1] == target[start - 1]:
+            start -= 1
+            offset -= 1
+        length = pos + block_size - start
+        while start + length < len(target) and offset + length < len(source) and \
+              source[offset + length] == target[start + length]:
+            length += 1
+        if start > literal_start:
+            out.write(_INSERT)
+            _write_varint(out, start - literal_start)
+            out.write(target[literal_start:start])
+        out.write(_COPY)
+        _write_varint(out, offset)
+        _write_varint(out, length)
+        pos = literal_start = start + length
+    if literal_start < len(target):
+        out.write(_INSERT)
+        _write_varint(out, len(target) - literal_start)
+        out.write(target[literal_start:])
+    return out.getvalue()
+
+
+def apply(source, delta):
+    """
+    Rebuild the target from source and the delta computed by encode().
+
+    @param source: previous version
+    @type source: str
+    @param delta: the delta
+    @type delta: str
+    @returns: new version
+    @rtype: str
+    @raises: DeltaError if the delta is corrupted or the source is wrong
+    """
+    if not delta.startswith(_MAGIC):
+        raise DeltaError("Not a delta.")
+    source_length, pos = _read_varint(delta, len(_MAGIC))
+    target_length, pos = _read_varint(delta, pos)
+    if source_length != len(source):
+        raise DeltaError("Delta does not belong to the source.")
+    out = StringIO()
+    while pos < len(delta):
+        op = delta[pos]
+        if op == _COPY:
+            offset, pos = _read_varint(delta, pos + 1)
+            length, pos = _read_varint(delta, pos)
+            if offset + length > len(source):
+                raise DeltaError("Copy out of the source.")
+            out.write(source[offset:offset + length])
+        elif op == _INSERT:
+            length, pos = _read_varint(delta, pos + 1)
+            if pos + length > len(delta):
+                raise DeltaError("Unexpected end of delta.")
+            out.write(delta[pos:pos + length])
+            pos += length
+        else:
+            raise DeltaError("Unknown instruction %r." % op)
+    target = out.getvalue()
+    if len(target) != target_length:
+        raise DeltaError("Length of the rebuilt version does not match.")
+    return target
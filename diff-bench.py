@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of breaking html into lines for the line diff: the bulk split
+(HtmlDiff._preformat_html) against the reference char-by-char FSM
+(HtmlDiff._preformat_html_fsm) on a large generated page. Both include the
+repair of the html by lxml (parse and serialize), which every diff of two
+versions pays as well.
+
+The target is a speedup of 10x for the whole preformatting. It is not
+reached: parsing and serializing by lxml alone take about a tenth of the
+time of the FSM, so they bound the speedup, and the split is only a part of
+the rest. The bound is printed with the results. Walking the parsed tree in
+python instead of serializing it was measured slower than serializing and
+splitting (about 0.5 s against 0.2 s on the default page).
+"""
+
+# speedup of the whole preformatting asked for
+TARGET = 10.0
+
+import sys
+import time
+import argparse
+
+import lxml.html as lh
+
+from diff import HtmlDiff
+
+
+def make_page(rows):
+    """
+    @param rows: number of table rows of the page
+    @type rows: int
+    @returns: html of the page
+    @rtype: str
+    """
+    body = ''.join('<tr class="row">\n  <td><a href="/item/%d">Item %d</a></td>\n'
+                   '  <td>%d</td><td><br/>\n  note</td>\n</tr>\n' % (i, i, i * 7)
+                   for i in xrange(rows))
+    return '<html><head><title>Benchmark</title></head><body>\n<table>\n%s</table>\n' \
+           '</body></html>' % body
+
+
+def best_of(repeat, func, arg):
+    """
+    @returns: the result and the best time of 'repeat' calls of func(arg)
+    @rtype: tuple
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of html preformatting for diffs")
+    parser.add_argument('--rows', type=int, default=12000,
+                        help="number of table rows of the generated page")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of runs, the best one is reported")
+    args = parser.parse_args(argv)
+
+    page = make_page(args.rows)
+    print "page: %d bytes" % len(page)
+    reference, fsm_time = best_of(args.repeat, HtmlDiff._preformat_html_fsm, page)
+    result, split_time = best_of(args.repeat, HtmlDiff._preformat_html, page)
+    if result != reference:
+        print >> sys.stderr, "outputs differ"
+        return 1
+    speedup = fsm_time / split_time
+    print "preformat (lxml parse + serialize + split):"
+    print "  FSM: %.3f s, bulk: %.3f s, speedup %.1fx" % (fsm_time, split_time, speedup)
+    # the lxml round trip alone bounds the speedup of the whole preformatting
+    _, lxml_time = best_of(args.repeat, lambda html: lh.tostring(lh.fromstring(html)), page)
+    print "  lxml parse + serialize: %.3f s, bound of the speedup %.1fx" % \
+          (lxml_time, fsm_time / lxml_time)
+    print "  target %.0fx: %s" % (TARGET, "reached" if speedup >= TARGET else "NOT reached")
+    # the split alone, without the lxml round trip
+    serialized = lh.tostring(lh.fromstring(page))
+    _, fsm_time = best_of(args.repeat, HtmlDiff._split_tags_fsm, serialized)
+    _, split_time = best_of(args.repeat, HtmlDiff._split_tags, serialized)
+    print "split only:"
+    print "  FSM: %.3f s, bulk: %.3f s, speedup %.1fx" % (fsm_time, split_time,
+                                                         fsm_time / split_time)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
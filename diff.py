@@ -8,7 +8,7 @@ __email__ = "xhelle03@stud.fit.vutbr.cz"
 __date__ = "$25.6.2012 12:12:44$"
 
 import sys
-
+import re
 import tempfile
 import random
 import string
@@ -17,11 +17,14 @@ import os
 import subprocess
 import codecs
 import types
+import hashlib
 from StringIO import StringIO
 from collections import namedtuple
 
 import lxml.html as lh
 
+import linediff
+
 # import chardet - character encoding auto-detection system
 try:
     import chardet
@@ -29,6 +32,38 @@ try:
 except ImportError:
     _detector = None
 
+def _to_unicode(obj):
+    """
+    Text to be diffed as unicode: ascii strings are decoded directly, the
+    other strings by the guessed encoding (see HtmlDiff._solve_encoding()).
+    """
+    if isinstance(obj, unicode):
+        return obj
+    try:
+        return obj.decode('ascii')
+    except UnicodeDecodeError:
+        return HtmlDiff._solve_encoding(obj)
+
+
+# tag as read by HtmlDiff._split_tags_fsm(): closing tag or opening tag
+# (slashes inside an opening tag pair up, so "/>" ends it only after an odd
+# run of slashes), ">" terminated or cut by the end of html
+_TAG = re.compile(r'(<(?:/[^>]*>?|(?:[^/]|\Z)[^/>]*(?:/(?:[^>]|\Z)[^/>]*)*(?:/?>)?))')
+# whitespace following a line end
+_LINE_END_WHITESPACE = re.compile(r'(?<=[\n\r])[\n\r\t ]+')
+# "<" inside a tag or in text (comments, scripts)
+_LT_IN_TAG = re.compile(r'<[^>]*<')
+
+
+def _self_closing(tag):
+    # tag ending by "/>": odd run of slashes before ">"
+    return (len(tag) - len(tag[:-1].rstrip('/'))) % 2 == 0
+
+
+# piece of html changed between two versions (output of HtmlDiff)
+HtmlDiffChunk = namedtuple('HtmlDiffChunk', 'position, removed, added')
+
+
 # TODO: fix problems with character encodings
 class _DiffTmpFiles(object):
     """
@@ -40,20 +75,12 @@ class _DiffTmpFiles(object):
         self.fn1 = self.get_unique_tmpfilename()
         self.fn2 = self.get_unique_tmpfilename()
         with codecs.open(self.fn1, encoding='utf-8', mode='wb') as f1:
-            try:
-                f1.write(obj1)
-            except:
-                #f1.write(unicode(obj1,'utf-8'))
-                f1.write(HtmlDiff._solve_encoding(obj1))
-            if obj1[-1] != '\n':
+            f1.write(_to_unicode(obj1))
+            if obj1[-1:] != '\n':
                 f1.write('\n')
         with codecs.open(self.fn2, encoding='utf-8', mode='wb') as f2:
-            try:
-                f2.write(obj2)
-            except:
-                #f2.write(unicode(obj2,'utf-8'))
-                f2.write(HtmlDiff._solve_encoding(obj1))
-            if obj2[-1] != '\n':
+            f2.write(_to_unicode(obj2))
+            if obj2[-1:] != '\n':
                 f2.write('\n')
 
     def __enter__(self):
@@ -108,9 +135,14 @@ class DocumentDiff(object):
 
 class PlainTextDiff(DocumentDiff):
     """
-    This class is a diff wrapper around classical gnu diff. Using this differ
-    we can process every text documents (plaintext, html, css etc.)
+    Line diff of text documents (plaintext, html, css etc.) in the normal
+    format of GNU diff. The diff is computed in-process (see linediff);
+    the classical gnu diff in a subprocess can be used instead by setting
+    use_subprocess.
     """
+    # diff by GNU diff in a subprocess (through temporary files)
+    use_subprocess = False
+
     @classmethod
     def diff(cls, obj1, obj2):
         """
@@ -123,6 +155,15 @@ class PlainTextDiff(DocumentDiff):
         """
         if not isinstance(obj1, basestring) or not isinstance(obj2, basestring):
             raise TypeError("Diffed objects have to be strings or unicode.")
+        if cls.use_subprocess:
+            return cls._subprocess_diff(obj1, obj2)
+        return linediff.normal_diff(_to_unicode(obj1), _to_unicode(obj2))
+
+    @classmethod
+    def _subprocess_diff(cls, obj1, obj2):
+        """
+        Diff by GNU diff.
+        """
         tmp = tempfile.TemporaryFile(suffix='', prefix='tmp')
         devnull = open("/dev/null")
         with _DiffTmpFiles(obj1, obj2) as (fn1, fn2):
@@ -172,7 +213,7 @@ class BinaryDiff(DocumentDiff):
 class HtmlDiff(DocumentDiff):
     """
     Html diff, which shows pieces of code, which was added to the page.
-    Uses output of GNU diff and its interface PlainTextDiff.
+    Uses output (in the format of GNU diff) of PlainTextDiff.
     
     Returns generator object HtmlDiffChunk
     Usage:
@@ -186,6 +227,56 @@ class HtmlDiff(DocumentDiff):
 
     @classmethod
     def _preformat_html(cls, html):
+        """
+        Repair html (by lxml) and break it into lines: every opening tag
+        starts a new line, closing tags end the line; whitespace at the
+        beginnings of lines is dropped.
+
+        @returns: preformatted html
+        @rtype: str
+        """
+        return cls._split_tags(lh.tostring(lh.fromstring(html)))
+
+    @classmethod
+    def _split_tags(cls, serialized):
+        """
+        Break serialized html into lines (see _preformat_html()). Output is
+        the same as of the reference FSM (_split_tags_fsm()), but the html is
+        split to text and tags by a regular expression, line ends are put
+        around the tags and whitespace following line ends is dropped by
+        another one.
+
+        Usual output of lxml (no "<" except of the starts of tags, no "/>")
+        is split by replacing instead: every tag ends by its first ">", so
+        line ends are put before "<" and after the ends of closing tags.
+        """
+        if '<\n' in serialized or '<\r' in serialized:
+            # line end right after "<" belongs to the tag, it is not the end
+            # of the line (lxml never writes that)
+            return cls._split_tags_fsm(serialized)
+        if '/>' not in serialized and '<>' not in serialized and \
+           '\0' not in serialized and _LT_IN_TAG.search(serialized) is None:
+            parts = serialized.split('</')
+            parts[1:] = [part.replace('>', '>\n', 1) for part in parts[1:]]
+            marked = '\0'.join(parts).replace('<', '\n<').replace('\0', '</')
+            return _LINE_END_WHITESPACE.sub('', marked)
+        parts = _TAG.split(serialized)
+        parts[1::2] = [(tag + '\n' if tag[-1:] == '>' else tag) if tag[1:2] == '/'
+                       else ('\n' + tag + '\n' if tag[-2:] == '/>' and _self_closing(tag)
+                             else '\n' + tag)
+                       for tag in parts[1::2]]
+        return _LINE_END_WHITESPACE.sub('', ''.join(parts))
+
+    @classmethod
+    def _preformat_html_fsm(cls, html):
+        """
+        Reference implementation of _preformat_html() reading the html char
+        by char.
+        """
+        return cls._split_tags_fsm(lh.tostring(lh.fromstring(html)))
+
+    @classmethod
+    def _split_tags_fsm(cls, serialized):
         class __Buf(object):
             def __init__(self):
                 self.__buf = ['']
@@ -196,9 +287,7 @@ class HtmlDiff(DocumentDiff):
 
             def flush(self):
                 return ''.join(self.__buf)
-        parsed = lh.fromstring(html)
-        repaired_html = lh.tostring(parsed)
-        s = StringIO(repaired_html)
+        s = StringIO(serialized)
         buf = __Buf()
         state = 2
         # FSM for reading (not parsing!!!) HTML
@@ -269,7 +358,6 @@ class HtmlDiff(DocumentDiff):
 
     @classmethod
     def htmldiff(cls, raw_diff):
-        HtmlDiffChunk = namedtuple('HtmlDiffChunk', 'position, removed, added')
         # chunk = (line, removed, added)
         _chunk = None
         for line in raw_diff.splitlines():
@@ -285,7 +373,8 @@ class HtmlDiff(DocumentDiff):
                 pass
             else:
                 raise RuntimeError("What was there? THIS: %s" % line)
-        yield HtmlDiffChunk(position=_chunk[0], removed=_chunk[1], added=_chunk[2])
+        if _chunk is not None:
+            yield HtmlDiffChunk(position=_chunk[0], removed=_chunk[1], added=_chunk[2])
 
     @classmethod
     def _added_text(cls, chunk):
@@ -309,3 +398,166 @@ class HtmlDiff(DocumentDiff):
         diff = PlainTextDiff.diff(f1, f2)
         return cls.htmldiff(diff)
 
+
+def _normalize_space(text):
+    # whitespace is not significant for the tree diff
+    if not text:
+        return u''
+    return u' '.join(text.split())
+
+
+def _tag(element):
+    tag = element.tag
+    if not isinstance(tag, basestring):
+        # comment, processing instruction or entity
+        tag = '!' + getattr(tag, '__name__', str(tag))
+    return tag
+
+
+def _head(element, tag):
+    # start tag (attributes sorted) and text up to the first child
+    attrib = element.attrib if isinstance(element.tag, basestring) else None
+    if attrib:
+        attrs = u''.join(u' %s="%s"' % item for item in sorted(attrib.items()))
+    else:
+        attrs = u''
+    return u'<%s%s>%s' % (tag, attrs, _normalize_space(element.text))
+
+
+def _subtree_hashes(root):
+    """
+    Hash every subtree of root (with the text following it) bottom-up: from
+    the head and tail of the element and the hashes of its children, so
+    every element is hashed once and two subtrees have the same hash
+    exactly when HtmlTreeDiff finds no change between them.
+
+    @returns: {element: SHA-1 digest}
+    @rtype: dict
+    """
+    hashes = {}
+    # descendants follow their ancestors in the document order
+    for element in reversed(list(root.iter())):
+        h = hashlib.sha1(_head(element, _tag(element)).encode('utf-8'))
+        children = [hashes[child] for child in element]
+        # number of children keeps the fields apart (text holds no NUL)
+        h.update('\0%d\0' % len(children))
+        h.update(''.join(children))
+        h.update(_normalize_space(element.tail).encode('utf-8'))
+        hashes[element] = h.digest()
+    return hashes
+
+
+class _TreeNode(object):
+    """
+    Element of a html tree compared by HtmlTreeDiff. Hashes of all subtrees
+    are computed at once by one pass over the tree (see _subtree_hashes()),
+    the rest is computed only for elements which are descended into.
+    """
+    __slots__ = ('element', 'tag', '_hashes', '_children')
+
+    def __init__(self, element, hashes=None):
+        self.element = element
+        self.tag = _tag(element)
+        # shared by all nodes of the tree (elements are kept alive by it,
+        # so lxml gives the same element objects to the children)
+        self._hashes = hashes if hashes is not None else _subtree_hashes(element)
+        self._children = None
+
+    @property
+    def hash(self):
+        return self._hashes[self.element]
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [_TreeNode(child, self._hashes) for child in self.element]
+        return self._children
+
+    @property
+    def head(self):
+        return _head(self.element, self.tag)
+
+    @property
+    def tail(self):
+        return _normalize_space(self.element.tail)
+
+    def path(self):
+        return self.element.getroottree().getpath(self.element)
+
+
+class HtmlTreeDiff(HtmlDiff):
+    """
+    Structural diff of html: element trees of both versions are compared
+    instead of their lines, so changes of markup which do not change the
+    document (order of attributes, whitespace, line wrapping) are not
+    reported at all and a change is reported at the element where it is.
+
+    Subtrees are compared by their hashes (see _TreeNode) from the root:
+    equal subtrees are skipped as a whole, children of differing elements
+    are aligned by their hashes (see linediff.hunks()) and only differing
+    elements paired with an element of the same tag are descended into.
+    Hashing is linear in the size of the page (one python step per
+    element), the comparison then follows only the paths to the changes.
+
+    Returns generator object HtmlDiffChunk (as HtmlDiff), position is the
+    XPath of the changed element in the old version (of the added element
+    in the new version if nothing was removed), removed and added are the
+    serialized subtrees, or the changed start tag with text, or the changed
+    text after the element (position ".../following-sibling::text()[1]").
+    """
+    @classmethod
+    def diff(cls, obj1, obj2):
+        """
+        @param obj1: the old html
+        @type obj1: str or unicode
+        @param obj2: the new html
+        @type obj2: str or unicode
+        @returns: changed pieces of the html
+        @rtype: generator of HtmlDiffChunk
+        """
+        old = _TreeNode(lh.fromstring(obj1))
+        new = _TreeNode(lh.fromstring(obj2))
+        if old.tag != new.tag:
+            return iter([cls._replaced([old], [new])])
+        return cls._compare(old, new)
+
+    @classmethod
+    def _compare(cls, old, new):
+        # old and new are elements of the same tag at the same place
+        if old.hash == new.hash:
+            return
+        if old.head != new.head:
+            yield HtmlDiffChunk(position=old.path(), removed=old.head, added=new.head)
+        if old.tail != new.tail:
+            yield HtmlDiffChunk(position=old.path() + '/following-sibling::text()[1]',
+                                removed=old.tail, added=new.tail)
+        for i0, i1, j0, j1 in linediff.hunks([c.hash for c in old.children],
+                                            [c.hash for c in new.children]):
+            for chunk in cls._compare_runs(old.children[i0:i1], new.children[j0:j1]):
+                yield chunk
+
+    @classmethod
+    def _compare_runs(cls, removed, added):
+        # runs of differing siblings: elements of the same tag are aligned
+        # and compared inside, the rest is removed or added as a whole
+        k = l = 0
+        for k0, k1, l0, l1 in linediff.hunks([n.tag for n in removed],
+                                            [n.tag for n in added]):
+            for a, b in zip(removed[k:k0], added[l:l0]):
+                for chunk in cls._compare(a, b):
+                    yield chunk
+            yield cls._replaced(removed[k0:k1], added[l0:l1])
+            k, l = k1, l1
+        for a, b in zip(removed[k:], added[l:]):
+            for chunk in cls._compare(a, b):
+                yield chunk
+
+    @classmethod
+    def _replaced(cls, removed, added):
+        return HtmlDiffChunk(position=(removed or added)[0].path(),
+                             removed=u''.join(cls._serialize(n) for n in removed),
+                             added=u''.join(cls._serialize(n) for n in added))
+
+    @classmethod
+    def _serialize(cls, node):
+        return lh.tostring(node.element, encoding=unicode)
@@ -0,0 +1,226 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Linediff -- in-process line diff with output of GNU diff (normal format)
+
+Lines are interned to integers, the common prefix and suffix are stripped
+and the rest is compared by the O(ND) algorithm of E. Myers in linear space
+(recursive halving at the middle snake), so near-identical versions of
+a document cost little more than reading them. Like GNU diff, lines which
+occur in one text only are not compared at all and the search gives up on
+too many differences (unless minimal diff is requested).
+
+Output is the normal format of GNU diff, e.g.:
+    2,3c2
+    < removed line
+    < another one
+    ---
+    > added line
+    5a5
+    > appended line
+"""
+
+__modulename__ = "linediff"
+__date__ = "$16.10.2026 21:26:03$"
+
+
+def split_lines(text):
+    """
+    Split text into lines without line ends. Missing newline at the end of
+    the text is ignored (as if the text ended by one).
+
+    @type text: str or unicode
+    @rtype: list
+    """
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+# the search for the middle snake gives up after this many differences and
+# splits the comparison at the furthest reaching point (see _middle_snake())
+TOO_EXPENSIVE = 256
+
+
+def _middle_snake(a, b, xoff, xlim, yoff, ylim, too_expensive=None):
+    """
+    Find the middle snake of the shortest edit script of a[xoff:xlim] and
+    b[yoff:ylim] (both non-empty).
+
+    @param too_expensive: maximal number of differences searched (None for
+                          no limit); then the sequences are split at the
+                          point reaching furthest (the script is not minimal)
+    @returns: start and end of the snake (x0, y0, x1, y1); the edit scripts
+              of the parts before and after it are shorter
+    @rtype: tuple
+    """
+    n = xlim - xoff
+    m = ylim - yoff
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2 + 1
+    # furthest reaching x on diagonal k (x - y) from the start and the end
+    vf = [0] * (2 * max_d + 3)
+    vb = [0] * (2 * max_d + 3)
+    for d in xrange(max_d + 1):
+        if too_expensive is not None and d > too_expensive:
+            return _furthest_point(vf, vb, d - 1, n, m, xoff, xlim, yoff, ylim)
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and vf[k - 1] < vf[k + 1]):
+                x = vf[k + 1]
+            else:
+                x = vf[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[xoff + x] == b[yoff + y]:
+                x += 1
+                y += 1
+            vf[k] = x
+            if odd and -d < delta - k < d and x + vb[delta - k] >= n:
+                return xoff + x0, yoff + y0, xoff + x, yoff + y
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and vb[k - 1] < vb[k + 1]):
+                x = vb[k + 1]
+            else:
+                x = vb[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[xlim - 1 - x] == b[ylim - 1 - y]:
+                x += 1
+                y += 1
+            vb[k] = x
+            if not odd and -d <= delta - k <= d and x + vf[delta - k] >= n:
+                return xlim - x, ylim - y, xlim - x0, ylim - y0
+    raise AssertionError("Middle snake not found.")
+
+
+def _furthest_point(vf, vb, d, n, m, xoff, xlim, yoff, ylim):
+    """
+    Point inside the compared area, which is the furthest from its corner
+    of all points reached by d differences from the start or the end.
+    """
+    best = None
+    for k in xrange(-d, d + 1, 2):
+        for v, forward in ((vf, True), (vb, False)):
+            x = v[k]
+            y = x - k
+            if 0 <= x <= n and 0 <= y <= m and (best is None or x + y > best[0]):
+                best = (x + y, x, y, forward)
+    _, x, y, forward = best
+    if forward:
+        return xoff + x, yoff + y, xoff + x, yoff + y
+    return xlim - x, ylim - y, xlim - x, ylim - y
+
+
+def _changes(a, b, too_expensive=None):
+    """
+    Compare sequences a and b.
+
+    @returns: flags of deleted items of a and inserted items of b
+    @rtype: tuple of lists
+    """
+    deleted = [False] * len(a)
+    inserted = [False] * len(b)
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        xoff, xlim, yoff, ylim = stack.pop()
+        while xoff < xlim and yoff < ylim and a[xoff] == b[yoff]:
+            xoff += 1
+            yoff += 1
+        while xlim > xoff and ylim > yoff and a[xlim - 1] == b[ylim - 1]:
+            xlim -= 1
+            ylim -= 1
+        if xoff == xlim:
+            inserted[yoff:ylim] = [True] * (ylim - yoff)
+        elif yoff == ylim:
+            deleted[xoff:xlim] = [True] * (xlim - xoff)
+        else:
+            x0, y0, x1, y1 = _middle_snake(a, b, xoff, xlim, yoff, ylim, too_expensive)
+            stack.append((x1, xlim, y1, ylim))
+            stack.append((xoff, x0, yoff, y0))
+    return deleted, inserted
+
+
+def hunks(lines1, lines2, minimal=False):
+    """
+    Compare two lists of lines.
+
+    @param minimal: find the smallest set of changes even if it takes long
+                    (like diff --minimal)
+    @type minimal: bool
+    @returns: list of hunks (i0, i1, j0, j1): lines1[i0:i1] are replaced by
+              lines2[j0:j1] (one of the ranges may be empty)
+    @rtype: list
+    """
+    # intern the lines: integers compare faster than strings
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in lines1]
+    b = [ids.setdefault(line, len(ids)) for line in lines2]
+    # lines, which are not in the other text, are changed anyway: compare
+    # only the rest
+    common = set(a).intersection(b)
+    keep_a = [i for i, x in enumerate(a) if x in common]
+    keep_b = [j for j, x in enumerate(b) if x in common]
+    deleted = [True] * len(a)
+    inserted = [True] * len(b)
+    changes = _changes([a[i] for i in keep_a], [b[j] for j in keep_b],
+                       None if minimal else TOO_EXPENSIVE)
+    for flags, keep, changed in zip((deleted, inserted), (keep_a, keep_b), changes):
+        for i, c in zip(keep, changed):
+            flags[i] = c
+    result = []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if i < len(a) and j < len(b) and not deleted[i] and not inserted[j]:
+            i += 1
+            j += 1
+            continue
+        i0, j0 = i, j
+        while i < len(a) and deleted[i]:
+            i += 1
+        while j < len(b) and inserted[j]:
+            j += 1
+        result.append((i0, i, j0, j))
+    return result
+
+
+def _range(start, end):
+    # 1-based inclusive range of lines [start, end)
+    if end - start == 1:
+        return "%d" % end
+    return "%d,%d" % (start + 1, end)
+
+
+def normal_diff(text1, text2, minimal=False):
+    """
+    Diff two texts in the normal format of GNU diff (the output of
+    `diff file1 file2`).
+
+    @param text1: the old text
+    @type text1: str or unicode
+    @param text2: the new text
+    @type text2: str or unicode
+    @param minimal: find the smallest set of changes (see hunks())
+    @type minimal: bool
+    @returns: the diff (empty if the texts do not differ)
+    @rtype: str or unicode (the type of the texts)
+    """
+    lines1 = split_lines(text1)
+    lines2 = split_lines(text2)
+    out = []
+    for i0, i1, j0, j1 in hunks(lines1, lines2, minimal):
+        if j0 == j1:
+            out.append("%sd%d\n" % (_range(i0, i1), j0))
+        elif i0 == i1:
+            out.append("%da%s\n" % (i0, _range(j0, j1)))
+        else:
+            out.append("%sc%s\n" % (_range(i0, i1), _range(j0, j1)))
+        for line in lines1[i0:i1]:
+            out.append("< %s\n" % line)
+        if i0 != i1 and j0 != j1:
+            out.append("---\n")
+        for line in lines2[j0:j1]:
+            out.append("> %s\n" % line)
+    return (text1[:0] + text2[:0]).join(out)
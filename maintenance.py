@@ -0,0 +1,552 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Maintenance of changemonitor storage -- tools working on the whole database
+(all users): deduplication of contents, numbering of versions and
+compaction of the history by retention policies.
+"""
+
+__modulename__ = "maintenance"
+__date__ = "$16.10.2026 17:40:31$"
+
+import time
+import hashlib
+import calendar
+import threading
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from model import HttpHeaderMeta, ContentCache, _load_content
+from backend import MongoBackend
+
+
+def _upload_timestamp(f):
+    return calendar.timegm(f['uploadDate'].utctimetuple()) + \
+           f['uploadDate'].microsecond / 1e6
+
+
+def _mongo_backend(storage):
+    """
+    @returns: backend of the storage
+    @rtype: backend.MongoBackend
+    @raises: NotImplementedError if the storage is not kept in MongoDB
+    """
+    if not isinstance(storage._backend, MongoBackend):
+        raise NotImplementedError("Maintenance is implemented only for MongoBackend.")
+    return storage._backend
+
+
+def _link_headers(storage):
+    """
+    Point headers stored before they knew the id of their content at the
+    content. Every header is linked to the latest file of its url uploaded
+    before it (the content is always stored before its header).
+
+    @returns: number of linked headers
+    """
+    headers = storage._headermeta.objects
+    contents = _mongo_backend(storage).files
+    linked = 0
+    q = {"content": {"$exists": True}, "content._id": {"$exists": False}}
+    for url in headers.find(q).distinct("url"):
+        files = list(contents.find({"filename": url}, ["uploadDate"])\
+                             .sort('uploadDate', ASCENDING))
+        i = -1
+        q["url"] = url
+        for h in headers.find(q, ["timestamp"]).sort('timestamp', ASCENDING):
+            while i + 1 < len(files) and _upload_timestamp(files[i + 1]) <= h['timestamp']:
+                i += 1
+            if i >= 0:
+                headers.update({"_id": h["_id"]}, {"$set": {"content._id": files[i]["_id"]}})
+                linked += 1
+    return linked
+
+
+def _file_sha1(storage, backend, cache, f):
+    """
+    @param f: record of the file (with its sha1, if it is known)
+    @returns: SHA-1 of the file, which is computed and recorded, if the file
+              was stored without it
+    """
+    sha1 = f.get('sha1')
+    if sha1 is None:
+        content = _load_content(storage.filesystem, cache, f['_id'],
+                                storage.filesystem.get(f['_id']))
+        sha1 = hashlib.sha1(content.read()).hexdigest()
+        backend.files.update({"_id": f["_id"]}, {"$set": {"sha1": sha1}})
+    return sha1
+
+
+def deduplicate(storage):
+    """
+    Deduplicate contents of the storage by SHA-1: keep the oldest file of
+    each content, point headers, states and deltas at it, delete the other
+    copies and rebuild reference counts of the content-addressed blobs (see
+    model.Storage.put_content()).
+
+    Files without headers are kept (with zero references). The whole
+    database is processed, regardless of user id of the storage. Only
+    storages kept in MongoDB (backend.MongoBackend) are supported.
+
+    @param storage: storage to deduplicate
+    @type storage: model.Storage
+    @returns: statistics: files (scanned), linked (headers linked to their
+              files), duplicates (deleted files) and bytes (freed)
+    @rtype: dict
+    """
+    backend = _mongo_backend(storage)
+    storage.flush()
+    stats = {'files': 0, 'linked': _link_headers(storage), 'duplicates': 0, 'bytes': 0}
+    headers = storage._headermeta.objects
+    states = storage._headermeta._state.objects
+    # private cache: do not evict contents of the running monitors
+    cache = ContentCache()
+    canonical = {}
+    for f in backend.files.find({}, ["sha1", "length"]).sort('uploadDate', ASCENDING):
+        stats['files'] += 1
+        sha1 = _file_sha1(storage, backend, cache, f)
+        if sha1 not in canonical:
+            canonical[sha1] = f['_id']
+            continue
+        # duplicate: retarget everything to the canonical file
+        keep = canonical[sha1]
+        headers.update({"content._id": f["_id"]}, {"$set": {"content._id": keep}}, multi=True)
+        states.update({"content_id": f["_id"]},
+                      {"$set": {"content_id": keep, "content._id": keep}}, multi=True)
+        # the contents are equal, so deltas apply to the canonical file too
+        backend.files.update({"delta_base": f["_id"]}, {"$set": {"delta_base": keep}}, multi=True)
+        storage.filesystem.delete(f['_id'])
+        storage.content_cache.discard(f['_id'])
+        stats['duplicates'] += 1
+        stats['bytes'] += f.get('length', 0)
+
+    for sha1, file_id in canonical.iteritems():
+        refs = headers.find({"content._id": file_id}).count()
+        backend.blobs.update({"_id": sha1}, {"$set": {"file_id": file_id, "refs": refs}},
+                             upsert=True)
+    return stats
+
+
+def _renumber_history(headers, history):
+    """
+    Number headers of a history (sorted by time) densely: 0, 1, 2...
+
+    Versions are unique (see model.HttpHeaderMeta.INDEXES), so the headers
+    are moved in an order, in which no number is held twice: the ones
+    moving up from the highest, then the ones moving down and the
+    unnumbered ones from the lowest. A number taken meanwhile by a monitor
+    raises DuplicateKeyError.
+
+    @returns: number of headers, which got a new number
+    @rtype: int
+    """
+    up, down = [], []
+    for version, h in enumerate(history):
+        old = h.get('version')
+        if old is None or old > version:
+            down.append((version, h))
+        elif old < version:
+            up.append((version, h))
+    for version, h in up[::-1] + down:
+        headers.update({"_id": h["_id"]}, {"$set": {"version": version}}, safe=True)
+        h['version'] = version
+    return len(up) + len(down)
+
+
+def _number_history(storage, url, uid):
+    """
+    Number available contents of url (of the user) densely by their time
+    and mark url as numbered, so that monitors number its new contents.
+
+    @returns: number of versions, which got a new number, or None if
+              a monitor saved a version of url meanwhile
+    """
+    headers = storage._headermeta.objects
+    counters = storage._headermeta.counters
+    available = {"url": url, "uid": uid, "response_code": {"$lt": 400},
+                 "content": {"$exists": True}}
+    renumbered = 0
+    while True:
+        history = list(headers.find(available, ["timestamp", "version"])\
+                              .sort('timestamp', ASCENDING))
+        try:
+            renumbered += _renumber_history(headers, history)
+        except DuplicateKeyError:
+            # numbered by a monitor, which saw the mark before the history
+            # was numbered: left for the next run
+            return None
+        try:
+            counters.insert({"url": url, "uid": uid}, safe=True)
+        except DuplicateKeyError:
+            # marked by a previous round (or run)
+            pass
+        if history:
+            storage._headermeta._state.objects.update(
+                {"url": url, "uid": uid, "last_change": history[-1]['timestamp']},
+                {"$set": {"version": len(history) - 1}})
+        # contents saved without number, before the monitors saw the mark
+        available["version"] = {"$exists": False}
+        if headers.find_one(available, ["_id"]) is None:
+            return renumbered
+        del available["version"]
+
+
+def number_versions(storage):
+    """
+    Number versions of histories stored before the versions were numbered
+    (see model.HttpHeaderMeta._number_headers()). Until then new versions of
+    such urls are saved without numbers and they are found by counting the
+    records. Numbering is a maintenance step, so that no check has to
+    number a long history.
+
+    The whole database is processed, regardless of user id of the storage.
+    Only storages kept in MongoDB (backend.MongoBackend) are supported.
+
+    @param storage: storage to number
+    @type storage: model.Storage
+    @returns: statistics: urls (numbered histories of urls and users),
+              versions (versions, which got a new number) and postponed
+              (histories, to which a monitor saved a version meanwhile, left
+              for the next run)
+    @rtype: dict
+    """
+    _mongo_backend(storage)
+    storage.flush()
+    headers = storage._headermeta.objects
+    stats = {'urls': 0, 'versions': 0, 'postponed': 0}
+    q = {"response_code": {"$lt": 400}, "content": {"$exists": True},
+         "version": {"$exists": False}}
+    for url in headers.find(q).distinct("url"):
+        q["url"] = url
+        for uid in headers.find(q).distinct("uid"):
+            renumbered = _number_history(storage, url, uid)
+            if renumbered is None:
+                stats['postponed'] += 1
+            else:
+                stats['urls'] += 1
+                stats['versions'] += renumbered
+        del q["url"]
+    return stats
+
+
+DAY = 86400
+WEEK = 7 * DAY
+# keep every version for 30 days, then one a day for a year, then one a week
+DEFAULT_RETENTION = [(30 * DAY, None), (365 * DAY, DAY), (None, WEEK)]
+# urls compacted (and orphaned blobs swept) by one step of the compaction
+COMPACTION_BATCH_SIZE = 100
+
+
+class RetentionPolicy(object):
+    """
+    Policy of compaction of the history: which versions of documents are
+    kept and which headers of checks are removed.
+
+    Versions are kept according to tiers by their age: a tier (max_age,
+    granularity) keeps the last version of every granularity seconds long
+    interval (all versions if granularity is None) of versions younger than
+    max_age (None for no limit). The last version of a document is always
+    kept.
+
+    Headers older than the first tier, which keeps all versions, are removed
+    unless they point to a kept version, mark a transition of availability
+    (e.g. the first failed check after successful ones) or are the last
+    header of the url.
+    """
+    def __init__(self, tiers=DEFAULT_RETENTION, thin_headers=True):
+        """
+        @param tiers: list of (max_age, granularity) tuples ordered by
+                      max_age, the last one with max_age None
+        @type tiers: list
+        @param thin_headers: remove headers of checks, which did not change
+                             anything
+        @type thin_headers: bool
+        """
+        if not tiers or tiers[-1][0] is not None:
+            raise ValueError("The last tier has to have no age limit.")
+        ages = [age for age, _ in tiers[:-1]]
+        if ages != sorted(ages):
+            raise ValueError("Tiers have to be ordered by age.")
+        self.tiers = list(tiers)
+        self.thin_headers = thin_headers
+
+    @property
+    def full_age(self):
+        """
+        Age, until which all versions (and headers) are kept (None forever).
+        """
+        age, granularity = self.tiers[0]
+        return age if granularity is None else 0
+
+    def bucket(self, age, timestamp):
+        """
+        @returns: interval of the version, in which only the last version is
+                  kept; None if the version is kept anyway
+        @rtype: tuple
+        """
+        for tier, (max_age, granularity) in enumerate(self.tiers):
+            if max_age is None or age < max_age:
+                if granularity is None:
+                    return None
+                return (tier, int(timestamp // granularity))
+
+
+def _release_content(storage, backend, content):
+    """
+    Drop one reference to the content of a removed version.
+    @returns: True if the content was deleted
+    """
+    file_id = content.get('_id')
+    if file_id is None:
+        # not linked to its file (see _link_headers())
+        return False
+    sha1 = content.get('sha1')
+    if sha1 is not None and backend.blobs.find_one({"_id": sha1, "file_id": file_id}) is not None:
+        return storage.release_content(sha1)
+    # stored before deduplication: not reference counted
+    if storage._headermeta.objects.find_one({"content._id": file_id}, ["_id"]) is not None:
+        return False
+    if backend.has_delta_dependents(file_id):
+        return _keep_as_orphan(storage, backend, file_id)
+    storage.filesystem.delete(file_id)
+    storage.content_cache.discard(file_id)
+    return True
+
+
+def _keep_as_orphan(storage, backend, file_id):
+    """
+    Keep content stored before deduplication, which lost all references,
+    but is a base of deltas: record it as a blob without references, so
+    that sweep_orphans() deletes it after the deltas. If an equal content
+    is already counted, the deltas are moved to it and the content is
+    deleted now.
+
+    @returns: True if the content was deleted
+    """
+    f = backend.files.find_one({"_id": file_id}, ["sha1"])
+    if f is None:
+        return False
+    sha1 = _file_sha1(storage, backend, ContentCache(), f)
+    try:
+        backend.blobs.insert({"_id": sha1, "file_id": file_id, "refs": 0}, safe=True)
+        return False
+    except DuplicateKeyError:
+        blob = backend.blobs.find_one({"_id": sha1})
+    if blob is None or blob["file_id"] == file_id:
+        return False
+    # the contents are equal, so the deltas apply to the counted one too
+    backend.files.update({"delta_base": file_id}, {"$set": {"delta_base": blob["file_id"]}},
+                         multi=True)
+    storage.filesystem.delete(file_id)
+    storage.content_cache.discard(file_id)
+    return True
+
+
+def sweep_orphans(storage, limit=None):
+    """
+    Delete contents, which lost all references, but were kept as bases of
+    deltas of other versions, once the other versions are gone.
+
+    @param limit: maximal number of blobs examined
+    @type limit: int
+    @returns: number of deleted contents
+    @rtype: int
+    """
+    backend = _mongo_backend(storage)
+    orphans = backend.blobs.find({"refs": {"$lte": 0}})
+    if limit is not None:
+        orphans = orphans.limit(limit)
+    deleted = 0
+    for blob in list(orphans):
+        if backend.has_delta_dependents(blob["file_id"]):
+            continue
+        backend.remove_blob(blob["_id"])
+        storage.filesystem.delete(blob["file_id"])
+        storage.content_cache.discard(blob["file_id"])
+        deleted += 1
+    return deleted
+
+
+class Compaction(object):
+    """
+    Incremental compaction of the history according to a retention policy
+    (see RetentionPolicy). Every step() compacts the histories of the next
+    batch_size urls (each by short single-document operations, so monitors
+    can run meanwhile) and sweeps orphaned contents (see sweep_orphans()).
+    The position in the database is kept in the database, so the
+    compaction resumes, where the previous step (of any process) stopped.
+
+    Versions of the compacted histories are renumbered to stay dense. If a
+    monitor stores a new version of the url at the same time, the url is
+    renumbered by its next compaction.
+
+    The whole database is processed, regardless of user id of the storage.
+    Only storages kept in MongoDB (backend.MongoBackend) are supported.
+
+    Usage:
+        >>> from maintenance import Compaction, RetentionPolicy, DAY
+        >>> job = Compaction(storage, RetentionPolicy([(7 * DAY, None), (None, DAY)]))
+        >>> job.run(pause=0.5)   # one pass over the database
+        {'urls': 1200, 'versions': 5310, 'headers': 80211, 'contents': 4950, 'orphans': 12}
+    """
+    def __init__(self, storage, policy=None, batch_size=COMPACTION_BATCH_SIZE):
+        """
+        @param storage: storage to compact
+        @type storage: model.Storage
+        @param policy: retention policy (RetentionPolicy() by default)
+        @type policy: RetentionPolicy
+        @param batch_size: number of urls compacted by one step
+        @type batch_size: int
+        """
+        self._storage = storage
+        self._backend = _mongo_backend(storage)
+        self._headers = storage._headermeta.objects
+        self._counters = storage._headermeta.counters
+        self._states = storage._headermeta._state.objects
+        # position of the compaction: {_id: "compaction", url: last url}
+        self._progress = self._backend.connection[self._backend.database].maintenance
+        self.policy = policy if policy is not None else RetentionPolicy()
+        self.batch_size = batch_size
+        self.stats = {'urls': 0, 'versions': 0, 'headers': 0, 'contents': 0, 'orphans': 0}
+        self._stop = threading.Event()
+
+    def step(self, now=None):
+        """
+        Compact histories of the next batch of urls.
+
+        @param now: time the ages are computed to (now by default)
+        @type now: float
+        @returns: False if the pass over the database has finished (the next
+                  step starts a new one)
+        @rtype: bool
+        """
+        if now is None:
+            now = time.time()
+        self._storage.flush()
+        progress = self._progress.find_one({"_id": "compaction"}) or {}
+        url = progress.get("url")
+        for i in xrange(self.batch_size):
+            # next url by the index of headers (no scan of the collection)
+            q = {"url": {"$gt": url}} if url is not None else {}
+            try:
+                url = self._headers.find(q, ["url"]).sort('url', ASCENDING).limit(1)[0]["url"]
+            except IndexError:
+                url = None
+                break
+            self.compact(url, now)
+        self.stats['orphans'] += sweep_orphans(self._storage, self.batch_size)
+        self._progress.update({"_id": "compaction"},
+                              {"$set": {"url": url, "timestamp": now}}, upsert=True)
+        return url is not None
+
+    def run(self, pause=0.0):
+        """
+        Compact the whole database (from the position, where the last step
+        stopped, to the end), sleeping pause seconds between the steps.
+
+        @returns: statistics: urls (compacted), versions (removed), headers
+                  (removed), contents (deleted from the filesystem) and
+                  orphans (swept)
+        @rtype: dict
+        """
+        while self.step() and not self._stop.is_set():
+            self._stop.wait(pause)
+        return self.stats
+
+    def start(self, pause=1.0, interval=DAY):
+        """
+        Run the compaction in a background thread: a pass every interval
+        seconds, until stop() is called.
+
+        @returns: the thread
+        @rtype: threading.Thread
+        """
+        def loop():
+            while not self._stop.is_set():
+                self.run(pause)
+                self._stop.wait(interval)
+        self._stop.clear()
+        thread = threading.Thread(target=loop, name="compaction")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        """
+        Stop the background compaction (after the current step).
+        """
+        self._stop.set()
+
+    def compact(self, url, now=None):
+        """
+        Compact history of url (of all users).
+        """
+        if now is None:
+            now = time.time()
+        histories = {}
+        for h in self._headers.find({"url": url},
+                                    ["uid", "timestamp", "response_code", "content", "version"])\
+                              .sort('timestamp', ASCENDING):
+            histories.setdefault(h.get("uid"), []).append(h)
+        for uid, history in histories.iteritems():
+            numbered = self._counters.find_one({"url": url, "uid": uid}) is not None
+            self._compact_history(url, uid, history, numbered, now)
+        self.stats['urls'] += 1
+
+    def _compact_history(self, url, uid, history, numbered, now):
+        policy = self.policy
+        # the last version in every bucket is kept
+        newest = {}
+        for h in history:
+            if HttpHeaderMeta._is_available(h):
+                b = policy.bucket(now - h['timestamp'], h['timestamp'])
+                if b is not None:
+                    newest[b] = h['_id']
+        full_age = policy.full_age
+        kept, released = [], []
+        previous = None
+        for i, h in enumerate(history):
+            has_version = HttpHeaderMeta._is_available(h)
+            transition = previous is None or \
+                         HttpHeaderMeta._succeeded(h) != HttpHeaderMeta._succeeded(previous)
+            previous = h
+            if has_version:
+                b = policy.bucket(now - h['timestamp'], h['timestamp'])
+                if b is None or newest[b] == h['_id']:
+                    kept.append(h)
+                    continue
+                released.append(h['content'])
+                self.stats['versions'] += 1
+            elif 'content' in h:
+                # content of failed check (should not happen), keep it
+                continue
+            thin = policy.thin_headers and full_age is not None and \
+                   now - h['timestamp'] >= full_age
+            if thin and not transition and i < len(history) - 1:
+                self._headers.remove({"_id": h["_id"]})
+                self.stats['headers'] += 1
+            elif has_version:
+                self._headers.update({"_id": h["_id"]}, {"$unset": {"content": 1, "version": 1}})
+        for content in released:
+            if isinstance(content, dict) and _release_content(self._storage, self._backend, content):
+                self.stats['contents'] += 1
+        if numbered:
+            self._renumber(url, uid, kept)
+
+    def _renumber(self, url, uid, kept):
+        """
+        Number the kept versions densely again.
+        """
+        old = [h.get('version') for h in kept]
+        if old == range(len(kept)):
+            return
+        try:
+            _renumber_history(self._headers, kept)
+        except DuplicateKeyError:
+            # a version saved by a monitor meanwhile, renumbered by the next
+            # compaction of the url
+            return
+        self._states.update({"url": url, "uid": uid, "version": old[-1]},
+                            {"$set": {"version": len(kept) - 1}})
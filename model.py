@@ -14,23 +14,222 @@ __email__ = "xhelle03@stud.fit.vutbr.cz"
 __date__  = "$23.6.2012 16:33:31$"
 
 import time
+import zlib
+import marshal
+import hashlib
+import atexit
+import weakref
+import warnings
+import threading
 import pymongo
 
+from collections import OrderedDict
+from cStringIO import StringIO
 from pymongo import Connection, ASCENDING, DESCENDING
 from bson import ObjectId
-from gridfs import GridFS
-from gridfs.grid_file import GridOut
+from gridfs.errors import NoFile
 
-from diff import PlainTextDiff, BinaryDiff, HtmlDiff
+import delta
+from diff import PlainTextDiff, BinaryDiff, HtmlDiff, HtmlTreeDiff, HtmlDiffChunk
 from errors import *
 from _http import HTTPDateTime
 
+# zstd codec is available only with python-zstandard
+try:
+    import zstandard
+    _zstd = zstandard
+except ImportError:
+    _zstd = None
+
+# default byte budget of the shared content cache (see ContentCache)
+CONTENT_CACHE_SIZE = 64 * 1024 * 1024
+# delta storage (see Storage.store_deltas()): every n-th version is a keyframe
+DELTA_KEYFRAME_INTERVAL = 16
+# versions, whose delta is larger than this part of the version, are keyframes
+DELTA_MAX_RATIO = 0.5
+# larger versions are always stored whole
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+# codec used to compress contents at rest (see Storage.use_codec())
+DEFAULT_CODEC = "zlib"
+# contents of other types (images, archives...) are usually compressed already
+COMPRESSIBLE_TYPES = ("text/", "application/xml", "application/xhtml+xml",
+                      "application/json", "application/javascript",
+                      "application/x-javascript", "application/rss+xml",
+                      "application/atom+xml")
+# size of the blocks compressed/decompressed at once
+_CODEC_CHUNK_SIZE = 256 * 1024
+# byte budget of the in-memory tier of the diff cache (see DiffCache)
+DIFF_CACHE_SIZE = 16 * 1024 * 1024
+# larger encoded diffs are cached in memory only (MongoDB document limit)
+DIFF_CACHE_RECORD_SIZE = 8 * 1024 * 1024
+# diffs cached by the backend expire after this many seconds
+DIFF_CACHE_TTL = 30 * 24 * 3600
+# write-behind of headers (see Storage.write_behind()): records per batch
+WRITE_BATCH_SIZE = 500
+# ... and the longest time (seconds) a record waits for its batch
+WRITE_BATCH_DELAY = 1.0
+
+# codec name -> (compressor factory, decompressor factory); the objects have
+# the interface of zlib compress/decompress objects
+_CODECS = {
+    "zlib": (lambda: zlib.compressobj(6), zlib.decompressobj),
+}
+if _zstd is not None:
+    _CODECS["zstd"] = (lambda: _zstd.ZstdCompressor(level=3).compressobj(),
+                       lambda: _zstd.ZstdDecompressor().decompressobj())
+
+
+class _DecodingReader(object):
+    """
+    Read-only file-like object decompressing a gridout stored by a codec.
+    Data are decompressed lazily as they are read; seeking backwards starts
+    the decompression again.
+    """
+    def __init__(self, gridout, codec):
+        if codec not in _CODECS:
+            raise ValueError("Content is stored by unknown codec '%s'." % codec)
+        self._gridout = gridout
+        self._codec = codec
+        self._rewind()
+
+    def _rewind(self):
+        self._gridout.seek(0)
+        self._decoder = _CODECS[self._codec][1]()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while not self._eof and (size < 0 or length < size):
+            raw = self._gridout.read(_CODEC_CHUNK_SIZE)
+            if raw:
+                chunk = self._decoder.decompress(raw)
+            else:
+                self._eof = True
+                flush = getattr(self._decoder, 'flush', None)
+                chunk = flush() if flush is not None else ""
+            chunks.append(chunk)
+            length += len(chunk)
+        self._buffer = "".join(chunks)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            raise IOError("Cannot seek from the end of a compressed content.")
+        if pos < self._pos:
+            self._rewind()
+        while self._pos < pos:
+            if not self.read(min(pos - self._pos, _CODEC_CHUNK_SIZE)):
+                break
+
+    def tell(self):
+        return self._pos
+
+
+def _open_content(gridout):
+    """
+    @returns: readable object with the (decompressed) data of gridout
+    """
+    codec = getattr(gridout, 'codec', None)
+    if codec is None:
+        return gridout
+    return _DecodingReader(gridout, codec)
+
+
+def _close_gridout(gridout):
+    """
+    Release resources of a gridout dropped from a cache (mapped file of
+    SQLiteBackend); GridOut of older pymongo has nothing to close.
+    """
+    close = getattr(gridout, 'close', None)
+    if close is not None:
+        close()
+
+
+def _content_length(gridout):
+    """
+    @returns: length of the (decompressed) data of gridout
+    """
+    raw_length = getattr(gridout, 'raw_length', None)
+    if raw_length is None:
+        return gridout.length
+    return raw_length
+
+
+
+def _ensure_indexes(collection, indexes):
+    """
+    Create indexes (name, keys, options), which do not exist in collection.
+    """
+    for name, keys, options in indexes:
+        collection.create_index(keys, name=name, **options)
+
+
+def _load_content(fs, cache, key, gridout):
+    """
+    Load content of gridout into the cache under key. Versions stored as
+    deltas are rebuilt from their base versions (which get cached as well).
+
+    @returns: the content
+    @rtype: Content
+    @raises: NoFile if a base version is missing, delta.DeltaError if a delta
+             is corrupted
+    """
+    base_id = getattr(gridout, 'delta_base', None)
+    if base_id is None:
+        # keyframe (or storage without deltas)
+        return cache.put(key, gridout)
+    base = cache.get(base_id)
+    if base is None:
+        base = _load_content(fs, cache, base_id, fs.get(base_id))
+    return cache.put(key, gridout, delta.apply(base.read(), _open_content(gridout).read()))
+
+
+def _missing_indexes(collection, indexes):
+    """
+    @returns: indexes (name, keys, options) missing in collection as
+              "collection.index_name" strings
+    @rtype: list
+    """
+    existing = collection.index_information()
+    return ["%s.%s" % (collection.name, name) for name, keys, options in indexes
+            if name not in existing]
+
 
 class BaseMongoModel(object):
     """
     Serves as base class, which is inherited by every model class.
+
+    Model with collection self.objects lists the indexes its queries need
+    in INDEXES as (name, keys, options) tuples.
     """
-    pass
+    INDEXES = []
+
+    def ensure_indexes(self):
+        """
+        Create indexes needed by the model, which do not exist yet.
+        """
+        _ensure_indexes(self.objects, self.INDEXES)
+
+    def missing_indexes(self):
+        """
+        @returns: indexes needed by the model, which do not exist, as
+                  "collection.index_name" strings
+        @rtype: list
+        """
+        return _missing_indexes(self.objects, self.INDEXES)
 
 
 class Storage(BaseMongoModel):
@@ -41,7 +240,9 @@ class Storage(BaseMongoModel):
     file versioning (or some workaround which implements versioning within the
     fs which does not support versioning natively).
 
-    The implementation is nowadays built on MongoDB.
+    The data are kept by a backend (see backend module): MongoDB with GridFS
+    (backend.MongoBackend, used for a pymongo.Connection) or SQLite with
+    a directory of content files (backend.SQLiteBackend).
 
     Usage:
         >>> from pymongo import Connection
@@ -60,32 +261,124 @@ class Storage(BaseMongoModel):
 
     Design pattern: Factory
     """
-
-    def __init__(self, connection, uid, database="webarchive"):
+    def __init__(self, connection, uid, database="webarchive", ensure_indexes=True,
+                 cache=None):
         """
         Initializes storage.
 
-        @param connection: database connection
-        @type connection: pymongo.Connection
+        @param connection: database connection or storage backend
+        @type connection: pymongo.Connection or backend.Backend
         @param uid: user id (see Monitor.__doc__ for more info)
         @type uid: str
         @param database: if the storage is based on database, this param
                          represents the name of database to be used within
-                         this instance.
+                         this instance (ignored for a backend).
         @type database: str
+        @param ensure_indexes: create missing indexes of the backend;
+                               indexes, which are still missing (e.g. because
+                               of insufficient privileges), are reported by
+                               a warning
+        @type ensure_indexes: bool
+        @param cache: cache of contents (the cache shared by the process
+                      by default)
+        @type cache: ContentCache
         """
-        if not isinstance(connection, Connection):
-            raise TypeError("connection must be instance of pymongo.Connection.")
-        self._connection = connection
-        self._database = database
+        # backend module builds on the models of this module
+        from backend import Backend, MongoBackend
+        if isinstance(connection, Connection):
+            connection = MongoBackend(connection, database)
+        elif not isinstance(connection, Backend):
+            raise TypeError("connection must be instance of pymongo.Connection or backend.Backend.")
+        self._backend = connection
         self._uid = uid
         # instance of HTTP header model
-        self._headermeta = HttpHeaderMeta(connection, uid, database)
+        self._headermeta = self._backend.headers(uid)
+        # re-check schedule of the resources
+        self._schedulemeta = self._backend.schedule(uid)
         # filesystem interface
-        self.filesystem = GridFS(self._connection[database], "content")
+        self.filesystem = self._backend.filesystem
 #?        print "STORAGE: FILESYSTEM: ",self.filesystem
         # flag representing possibility to save large objects into storage
         self.allow_large = False
+        # versions between keyframes (None = no deltas, every version whole)
+        self.keyframe_interval = None
+        # codec compressing new contents (None = store them raw)
+        self.codec = DEFAULT_CODEC
+        # cache of contents used by files of this storage
+        self.content_cache = cache if cache is not None else content_cache
+        # cache of diffs of contents of this storage (None = no caching)
+        self.diff_cache = DiffCache(self._backend)
+        if ensure_indexes:
+            self.ensure_indexes()
+            missing = self.check_indexes()
+            if missing:
+                warnings.warn("Missing indexes (queries will scan the collections): %s" % \
+                              ", ".join(missing), RuntimeWarning)
+
+    def ensure_indexes(self):
+        """
+        Create indexes needed by the storage, which do not exist yet.
+        """
+        self._backend.ensure_indexes()
+
+    def check_indexes(self):
+        """
+        Check that all indexes needed by the storage exist.
+
+        @returns: missing indexes as "collection.index_name" strings
+        @rtype: list
+        """
+        return self._backend.check_indexes()
+
+    def save_header(self, url, response_code, fields, content_id, error=None,
+                    changed=False, md5=None, sha1=None):
+        """
+        Save http header of a check of url (see HttpHeaderMeta.save_header()).
+
+        @returns: id of the saved header; SQLiteBackend numbers the headers
+                  as it writes them, so with write-behind enabled it returns
+                  None (the header is queued, see write_behind())
+        @rtype: bson.ObjectId, int or None
+        """
+        return self._headermeta.save_header(url, response_code, fields, content_id, error,
+                                            changed, md5, sha1)
+
+    def write_behind(self, max_size=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY):
+        """
+        Write headers in batches: by one bulk insert of max_size headers, or
+        of the headers saved within max_delay seconds. Queued headers are
+        read by this process as if they were written and they are written
+        by flush() and at exit of the interpreter. Contents are still
+        written immediately (the headers refer to them).
+
+        @param max_size: headers per batch (None switches the batches off)
+        @type max_size: int
+        @param max_delay: maximal time (seconds) a header waits for its batch
+        @type max_delay: float
+        """
+        self._headermeta.write_behind(max_size, max_delay)
+
+    def flush(self):
+        """
+        Write all queued headers (see write_behind()).
+        """
+        self._headermeta.flush()
+
+    def get_metainfo(self, url):
+        """
+        Get the latest metainfo of url with available content: etag,
+        last_modified and content record (md5, sha1, _id).
+
+        @returns: the state of url or its newest header with content; None if
+                  no content of url is stored
+        @rtype: dict
+        """
+        state = self._headermeta.get_state(url)
+        if state is not None and 'content' in state:
+            return state
+        # no content since the state is kept (or global-view mode): the newest
+        # header with stored content
+        return self._headermeta.get_by_time(url, time.time(), last_available=True)
 
     def allow_large_documents(self):
         """
@@ -93,6 +386,156 @@ class Storage(BaseMongoModel):
         """
         self.allow_large = True
 
+    def store_deltas(self, keyframe_interval=DELTA_KEYFRAME_INTERVAL):
+        """
+        Store new versions of documents as binary deltas against their
+        previous versions (see delta module). Every keyframe_interval-th
+        version, and every version whose delta would not save enough, is
+        stored whole as a keyframe, which bounds the work needed to rebuild
+        a version.
+
+        @param keyframe_interval: maximal number of versions between two
+                                  keyframes (None stores all versions whole)
+        @type keyframe_interval: int
+        """
+        if keyframe_interval is not None and keyframe_interval < 1:
+            raise ValueError("keyframe_interval has to be positive.")
+        self.keyframe_interval = keyframe_interval
+
+    def use_codec(self, codec=DEFAULT_CODEC):
+        """
+        Set codec compressing contents stored from now on: "zlib", "zstd"
+        (needs python-zstandard) or None to store them uncompressed. Only
+        contents of COMPRESSIBLE_TYPES are compressed. Contents are
+        decompressed transparently, whichever codec stored them.
+
+        @param codec: name of the codec
+        @type codec: str or None
+        """
+        if codec is not None and codec not in _CODECS:
+            raise ValueError("Unknown or unavailable codec '%s'." % codec)
+        self.codec = codec
+
+    def put_content(self, data, filename, content_type, timestamp, previous=None,
+                    sha1=None):
+        """
+        Store content of a new version of the file into the filesystem.
+
+        Contents are addressed by their SHA-1: if the same content is already
+        stored (under any filename), only its reference count is increased
+        and the stored version is shared (see release_content()).
+
+        @param data: readable object with the content
+        @type data: file-like object
+        @param filename: name of the file (URL)
+        @type filename: str
+        @param content_type: content type of the document
+        @type content_type: str
+        @param timestamp: time of the version
+        @type timestamp: float
+        @param previous: id of the previous version in the filesystem (base
+                         of the delta)
+        @type previous: ObjectId
+        @param sha1: SHA-1 hex digest of the content (no deduplication if None)
+        @type sha1: str
+        @returns: id of the stored version in the filesystem
+        @rtype: ObjectId
+        """
+        if sha1 is None:
+            return self._put_version(data, filename, content_type, timestamp, previous)
+        file_id = self._backend.acquire_blob(sha1)
+        if file_id is not None:
+            return file_id
+        file_id = self._put_version(data, filename, content_type, timestamp, previous,
+                                    sha1=sha1)
+        if not self._backend.register_blob(sha1, file_id):
+            # stored concurrently by another process: share that one
+            self.filesystem.delete(file_id)
+            return self._backend.acquire_blob(sha1)
+        return file_id
+
+    def release_content(self, sha1):
+        """
+        Drop one reference to the content with given SHA-1. The content is
+        deleted from the filesystem with its last reference, unless another
+        version is stored as a delta against it.
+
+        @param sha1: SHA-1 hex digest of the content
+        @type sha1: str
+        @returns: True if the content was deleted
+        @rtype: bool
+        """
+        blob = self._backend.release_blob(sha1)
+        deleted = False
+        while blob is not None and blob["refs"] <= 0:
+            file_id = blob["file_id"]
+            if self._backend.has_delta_dependents(file_id):
+                # still needed to rebuild other versions
+                break
+            try:
+                base = getattr(self.filesystem.get(file_id), 'delta_base', None)
+            except NoFile:
+                base = None
+            self._backend.remove_blob(blob["_id"])
+            self.filesystem.delete(file_id)
+            self.content_cache.discard(file_id)
+            deleted = True
+            # the base of the delta may have been kept only for this version
+            blob = self._backend.find_blob(base) if base is not None else None
+        return deleted
+
+    def _put_version(self, data, filename, content_type, timestamp, previous, **fields):
+        """
+        Store the version whole or as a delta (see store_deltas()).
+        """
+        options = {'filename': filename, 'content_type': content_type,
+                   'timestamp': timestamp}
+        options.update(fields)
+        if self.keyframe_interval is None or previous is None or \
+           getattr(data, 'length', 0) > DELTA_MAX_SIZE:
+            return self._write(data, options)
+        try:
+            base = self.filesystem.get(previous)
+            depth = getattr(base, 'delta_depth', 0) + 1
+            if depth >= self.keyframe_interval:
+                return self._write(data, options)
+            source = _load_content(self.filesystem, self.content_cache, previous, base).read()
+        except (NoFile, delta.DeltaError):
+            # broken chain, start a new one
+            return self._write(data, options)
+        target = data.read()
+        d = delta.encode(source, target)
+        if len(d) > DELTA_MAX_RATIO * len(target):
+            return self._write(target, options)
+        options.update(delta_base=previous, delta_depth=depth)
+        return self._write(d, options)
+
+    def _write(self, data, options):
+        """
+        Write data (str or readable object) into the filesystem, compressed
+        by the codec if the content type is compressible.
+        """
+        content_type = options.get('content_type') or ''
+        if self.codec is None or not content_type.startswith(COMPRESSIBLE_TYPES):
+            return self.filesystem.put(data, **options)
+        if isinstance(data, basestring):
+            data = StringIO(data)
+        encoder = _CODECS[self.codec][0]()
+        f = self.filesystem.new_file(codec=self.codec, **options)
+        try:
+            raw_length = 0
+            while True:
+                chunk = data.read(_CODEC_CHUNK_SIZE)
+                if not chunk:
+                    break
+                raw_length += len(chunk)
+                f.write(encoder.compress(chunk))
+            f.write(encoder.flush())
+            f.raw_length = raw_length
+        finally:
+            f.close()
+        return f._id
+
     def get(self, filename):
         """
         Get file object by filename.
@@ -104,58 +547,392 @@ class Storage(BaseMongoModel):
         @raises: DocumentNotAvailable if document doesnt exist in the storage
         """
 #?        print "In Storage.get(): resource ",filename
-        if not self.filesystem.exists(filename=filename):
+        # contents shared with other files are stored under another filename
+        state = self._headermeta.get_state(filename)
+        if (state is None or 'content' not in state) and \
+           self._headermeta.get_by_time(filename, time.time(), last_available=True) is None and \
+           not self.filesystem.exists(filename=filename):
             raise DocumentNotAvailable("File does not exist in the storage.")
-        return File(filename, self.filesystem, self._headermeta)
+        return File(filename, self.filesystem, self._headermeta, self.content_cache)
 
 
     def check_uid(self):
         return self._headermeta.check_uid()
 
 
-class _ContentCache(object):
+class ContentCache(object):
     """
-    A small app-specific key-value cache for storing readable objects.
+    Bounded cache of document contents shared by File objects. Contents are
+    cached as data blobs keyed by content id (id of the file in GridFS) and
+    the least recently used ones are evicted when the total size exceeds
+    the byte budget. Every get() returns a new Content object reading from
+    the beginning, so that more users of one cached version do not share
+    the position.
+
+    Counters of hits, misses and evictions are available by stats().
+    The cache is thread-safe.
 
-    Main feature:
-        - iterable read(): when getting the stored object from the cache,
-                           it will check if the readable object is at the end.
-                           If yes, seeks to the beginning.
-        - refreshable: calling refresh() method deletes all integer-key values
-                       from the cache.
+    Usage:
+        >>> cache = ContentCache(max_bytes=16 * 1024 * 1024)
+        >>> c = cache.get(content_id)  # None if not cached
+        >>> if c is None:
+        ...     c = cache.put(content_id, gridout)
     """
-    def __init__(self):
-        self.__contents = {}
+    def __init__(self, max_bytes=CONTENT_CACHE_SIZE):
+        """
+        @param max_bytes: maximal total size of cached contents in bytes
+        @type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        # key -> (gridout, data), the least recently used first
+        self._contents = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        @returns: cached content or None if it is not cached
+        @rtype: Content
+        """
+        with self._lock:
+            try:
+                gridout, data = self._contents.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._contents[key] = (gridout, data)
+            self.hits += 1
+        return Content(gridout, data)
+
+    def put(self, key, gridout, data=None):
+        """
+        Read the content from gridout and cache it. Contents larger than the
+        whole budget are not cached.
 
-    def __getitem__(self, key):
-        try:
-            c = self.__contents[key]
-        except KeyError:
-            raise LookupError("No such content in the cache.")
-        # if fd is at the end, seek to beginning
-        if c.tell() == c.length:
-            c.seek(0)
-        return c
+        @param data: data of the content, if it is not the data of gridout
+                     (e.g. rebuilt from a delta)
+        @type data: str
+        @returns: the content
+        @rtype: Content
+        """
+        if data is None:
+            if _content_length(gridout) > self.max_bytes:
+                return Content(gridout)
+            data = _open_content(gridout).read()
+        elif len(data) > self.max_bytes:
+            return Content(gridout, data)
+        with self._lock:
+            if key in self._contents:
+                self._drop(key)
+            self._contents[key] = (gridout, data)
+            self._size += len(data)
+            self._evict()
+        return Content(gridout, data)
+
+    def discard(self, key):
+        """
+        Remove the content from the cache (if it is cached).
+        """
+        with self._lock:
+            if key in self._contents:
+                self._drop(key)
 
-    def __setitem__(self, key, value):
-        self.__contents[key] = value
+    def resize(self, max_bytes):
+        """
+        Change the byte budget (evicts contents, which do not fit).
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def purge(self):
+        """
+        Remove all contents from the cache.
+        """
+        with self._lock:
+            for gridout, data in self._contents.itervalues():
+                _close_gridout(gridout)
+            self._contents.clear()
+            self._size = 0
+
+    def _drop(self, key):
+        # contents handed out read the cached data, not the gridout
+        gridout, data = self._contents.pop(key)
+        self._size -= len(data)
+        _close_gridout(gridout)
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            self._drop(next(iter(self._contents)))
+            self.evictions += 1
+
+    def stats(self):
+        """
+        @returns: counters of the cache: hits, misses, evictions, number of
+                  cached contents (count), their size and the budget in bytes
+        @rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'count': len(self._contents),
+                    'size': self._size, 'max_bytes': self.max_bytes}
 
     def __contains__(self, key):
-        if key in self.__contents:
-            return True
-        else:
-            return False
+        return key in self._contents
+
+    def __len__(self):
+        return len(self._contents)
+
+
+# content cache shared by all storages in the process
+content_cache = ContentCache()
+
+
+def _encode_diff(d):
+    """
+    Serialize output of a differ: text (PlainTextDiff), dict (BinaryDiff)
+    or list of HtmlDiffChunk (HtmlDiff, HtmlTreeDiff).
+    """
+    if isinstance(d, basestring):
+        value = ('text', d)
+    elif isinstance(d, dict):
+        value = ('dict', d)
+    else:
+        value = ('chunks', [tuple(chunk) for chunk in d])
+    return zlib.compress(marshal.dumps(value))
+
 
-    def __iter__(self):
-        for x in self.__contents:
-            yield x
+def _decode_diff(data):
+    kind, value = marshal.loads(zlib.decompress(data))
+    if kind == 'chunks':
+        # html differs return generators
+        return iter([HtmlDiffChunk(*chunk) for chunk in value])
+    return value
 
-    def refresh(self):
-        for version in filter(lambda x: isinstance(x, int), self.__contents.keys()):
-            del self.__contents[version]
+
+class DiffCache(object):
+    """
+    Cache of outputs of differs keyed by the pair of diffed contents (their
+    SHA-1) and the differ, so a pair of versions is diffed only once, even
+    if it is shared by more URLs (boilerplate pages). Encoded diffs are kept
+    in memory, the least recently used ones are evicted when their total
+    size exceeds the byte budget, and in the backend of the storage (if it
+    supports it), where they outlive the process for DIFF_CACHE_TTL seconds.
+
+    Counters of hits (in memory and in the backend), misses and evictions
+    are available by stats(). The cache is thread-safe.
+
+    Usage:
+        >>> key = DiffCache.key(content1.sha1, content2.sha1, HtmlDiff)
+        >>> d = cache.get(key)  # None if not cached
+        >>> if d is None:
+        ...     d = cache.put(key, HtmlDiff.diff(data1, data2))
+    """
+    def __init__(self, backend=None, max_bytes=DIFF_CACHE_SIZE):
+        """
+        @param backend: persistent tier of the cache (None = memory only)
+        @type backend: backend.Backend
+        @param max_bytes: maximal total size of encoded diffs kept in memory
+        @type max_bytes: int
+        """
+        self.backend = backend
+        self.max_bytes = max_bytes
+        # key -> encoded diff, the least recently used first
+        self._diffs = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(sha1_a, sha1_b, differ):
+        """
+        @param sha1_a: SHA-1 hex digest of the old content
+        @param sha1_b: SHA-1 hex digest of the new content
+        @param differ: differ class with its options (e.g. HtmlTreeDiff for
+                       the tree mode of HtmlDiff)
+        @type differ: subclass of diff.DocumentDiff
+        @rtype: str
+        """
+        return "%s:%s:%s" % (sha1_a, sha1_b, differ.__name__)
+
+    def get(self, key):
+        """
+        @returns: cached diff or None if it is not cached
+        """
+        with self._lock:
+            data = self._diffs.pop(key, None)
+            if data is not None:
+                self._diffs[key] = data
+                self.hits += 1
+        if data is None and self.backend is not None:
+            data = self.backend.get_diff(key)
+            if data is not None:
+                with self._lock:
+                    self.backend_hits += 1
+                    self._store(key, data)
+        if data is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return _decode_diff(data)
+
+    def put(self, key, d):
+        """
+        Cache output of a differ. Generators of chunks are read whole.
+
+        @returns: the diff (a new generator in place of a generator)
+        """
+        if not isinstance(d, (basestring, dict)):
+            d = list(d)
+        data = _encode_diff(d)
+        with self._lock:
+            self._store(key, data)
+        if self.backend is not None and len(data) <= DIFF_CACHE_RECORD_SIZE:
+            self.backend.put_diff(key, data)
+        return iter(d) if isinstance(d, list) else d
+
+    def _store(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._diffs:
+            self._size -= len(self._diffs.pop(key))
+        self._diffs[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            key, data = self._diffs.popitem(last=False)
+            self._size -= len(data)
+            self.evictions += 1
 
     def purge(self):
-        self.__contents = {}
+        """
+        Remove all diffs from the memory (the backend keeps them).
+        """
+        with self._lock:
+            self._diffs.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        @returns: counters of the cache: hits, backend_hits, misses,
+                  evictions, number of diffs in memory (count), their size
+                  and the budget in bytes
+        @rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'backend_hits': self.backend_hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'count': len(self._diffs), 'size': self._size,
+                    'max_bytes': self.max_bytes}
+
+    def __contains__(self, key):
+        return key in self._diffs
+
+    def __len__(self):
+        return len(self._diffs)
+
+
+class WriteBehindQueue(object):
+    """
+    Queue of records, which are written in batches by one call of *write*:
+    when *max_size* records are queued, *max_delay* seconds after the first
+    of them was queued (by a timer thread), on flush() and at exit of the
+    interpreter.
+
+    Records are queued under a key (url), so that readers can flush the
+    queue only when it holds records they are interested in (see pending()).
+    If the write fails, the records are kept in the queue for the next
+    flush and the exception is raised; *write* has to be idempotent, it may
+    remove the records it has written from the list before it raises.
+    """
+    def __init__(self, write, max_size=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY):
+        """
+        @param write: function writing list of records
+        @type write: callable
+        @param max_size: maximal number of queued records
+        @type max_size: int
+        @param max_delay: maximal time (seconds) a record is queued (None for
+                          no limit)
+        @type max_delay: float
+        """
+        if max_size < 1:
+            raise ValueError("max_size has to be positive.")
+        self._write = write
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._records = []
+        self._keys = set()
+        self._timer = None
+        self._lock = threading.RLock()
+        _write_queues.add(self)
+
+    def add(self, key, record):
+        """
+        Queue record (write the batch if it is full).
+        """
+        with self._lock:
+            self._records.append(record)
+            self._keys.add(key)
+            if len(self._records) >= self.max_size:
+                self.flush()
+            elif self._timer is None and self.max_delay is not None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def pending(self, key=None):
+        """
+        @returns: True if records under the key (any records if key is None)
+                  are waiting for their batch
+        @rtype: bool
+        """
+        with self._lock:
+            if key is None:
+                return bool(self._records)
+            return key in self._keys
+
+    def flush(self):
+        """
+        Write all queued records.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._records:
+                return
+            records = self._records
+            self._records = []
+            keys = self._keys
+            self._keys = set()
+            try:
+                self._write(records)
+            except:
+                # keep them for the next attempt (in the original order)
+                self._records[:0] = records
+                self._keys.update(keys)
+                raise
+
+    def __len__(self):
+        return len(self._records)
+
+
+# queues flushed at exit of the interpreter
+_write_queues = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_write_queues():
+    for queue in list(_write_queues):
+        try:
+            queue.flush()
+        except Exception as e:
+            warnings.warn("Queued records were not written: %s" % e, RuntimeWarning)
 
 
 class File(object):
@@ -166,6 +943,7 @@ class File(object):
 
     MongoDB record:
     content = {
+        _id: ObjectId of the file in GridFS
         filename: URL
         md5: str
         sha1: str
@@ -178,7 +956,7 @@ class File(object):
     """
     # Zde se jedna v podstate o obal GridFS a GridOut
     #
-    def __init__(self, filename, fs, headermeta):
+    def __init__(self, filename, fs, headermeta, cache=None):
         """
         Create new file instance.
 
@@ -188,6 +966,9 @@ class File(object):
         @type fs: GridFS
         @param headermeta: http header metadata
         @type headermeta: HttpHeaderMeta
+        @param cache: cache of contents (the cache shared by the process
+                      by default)
+        @type cache: ContentCache
 
         WARNING:
         Application developers should generally not need to instantiate this class
@@ -200,15 +981,21 @@ class File(object):
         # Collection "httpheader"
         self._headers = headermeta
 
-        # ulozeno vzdy jednak pod _id a po verzemi -1,-2,-3 pokud se uzivatel
-        # ptal  na verzi
-        self.content = _ContentCache()
+        # contents are cached under content ID in the (shared) cache
+        self.content = cache if cache is not None else content_cache
+        # version -> content ID of versions, which the user asked for
+        self._versions = {}
+        # content IDs loaded by this file
+        self._content_ids = set()
 
     def purge_cache(self):
         """
-        Cleans the whole content cache.
+        Removes contents of this file from the content cache.
         """
-        self.content.purge()
+        for content_id in self._content_ids:
+            self.content.discard(content_id)
+        self._content_ids.clear()
+        self._versions.clear()
 
     def refresh_cache(self):
         """
@@ -219,7 +1006,30 @@ class File(object):
         
         This method should be called after every check() call!
         """
-        self.content.refresh()
+        self._versions.clear()
+
+    def _cached(self, content_id):
+        if content_id is None:
+            return None
+        return self.content.get(content_id)
+
+    def _cache(self, content_id, gridout):
+        self._content_ids.add(content_id)
+        try:
+            return _load_content(self._filesystem, self.content, content_id, gridout)
+        except (NoFile, delta.DeltaError):
+            raise DocumentHistoryNotAvaliable("Content of document %s cannot be"\
+                " rebuilt, its base version is missing or corrupted." % self.filename)
+
+    def _content_id(self, header):
+        """
+        @returns: key of the content of header in the cache
+        """
+        content = header.get('content')
+        if isinstance(content, dict) and '_id' in content:
+            return content['_id']
+        # header stored before it pointed to the file
+        return (self.filename, header['timestamp'])
 
     def get_version(self, timestamp_or_version):
         """
@@ -241,8 +1051,9 @@ class File(object):
         if timestamp_or_version < 10000:
 
             # try to get content from cache by version
-            if timestamp_or_version in self.content:
-                return self.content[timestamp_or_version]
+            r = self._cached(self._versions.get(timestamp_or_version))
+            if r is not None:
+                return r
 
             h = self._headers.get_by_version(self.filename, timestamp_or_version,
                                              last_available=True)
@@ -251,15 +1062,18 @@ class File(object):
                     " not available." % (timestamp_or_version, self.filename))
 #?            print "Document: ",h
             # try to get content from cache by content ID
-            content_id = h['timestamp'] # ObjectiId
-            if content_id in self.content:
-                return self.content[content_id]
+            content_id = self._versions[timestamp_or_version] = self._content_id(h)
+            r = self._cached(content_id)
+            if r is not None:
+                return r
 #?            print "Content_id: ",h['content']
             # otherwise load content from db
-            #g = self._filesystem.get(content_id) # GridOut
-            g = self._filesystem.get_version(filename=self.filename,version=timestamp_or_version)
+            g = self._get_gridout(h)
+            if g is None:
+                # header stored before it pointed to the file
+                g = self._filesystem.get_version(filename=self.filename,version=timestamp_or_version)
             # cache it
-            r = self.content[content_id] = self.content[timestamp_or_version] = Content(g)
+            r = self._cache(content_id, g)
 
         # timestamp
         else:
@@ -272,12 +1086,17 @@ class File(object):
                 " %s is not available." % (self.filename, t.to_httpheader_format()))
             
             # try to get content from cache by content ID
-            content_id = h['timestamp'] # ObjectiId
-            if content_id in self.content:
-                return self.content[content_id]
+            content_id = self._content_id(h)
+            r = self._cached(content_id)
+            if r is not None:
+                return r
 
             # otherwise load content from db
-            # ... the right query might do the same with a single line of code
+            g = self._get_gridout(h)
+            if g is not None:
+                return self._cache(content_id, g)
+
+            # header stored before it pointed to the file: walk the versions
             i = -1
             time_shift = -1 * HTTPDateTime().to_timestamp()
             while(True):
@@ -286,11 +1105,10 @@ class File(object):
                     upload_date = HTTPDateTime().from_gridfs_upload_date(g.upload_date).to_timestamp()
 #?                    print "\nupload_date: ",upload_date+time_shift," ",g.upload_date," timestamp: ",timestamp_or_version,"\n"
                     if (upload_date+time_shift) < timestamp_or_version :   # correction for time zone!!!
-                        r = self.content[content_id] = Content(g) # cache it
-                        return r
+                        return self._cache(content_id, g)
                     else:
                         i = i - 1
-                except : # FIX fill in name of exception
+                except NoFile:
                     raise DocumentHistoryNotAvaliable("Version of document %s in time"\
                     " %s is not available." % (self.filename, 
                     HTTPDateTime().from_timestamp(timestamp_or_version).to_httpheader_format()))
@@ -298,6 +1116,25 @@ class File(object):
         # return the content, which was requested
         return r
 
+    def _get_gridout(self, header):
+        """
+        Load the file, which the header points to.
+
+        @returns: file from GridFS or None if the header does not know the id
+                  of the file
+        @rtype: GridOut
+        @raises: DocumentHistoryNotAvaliable if the file is not in GridFS
+        """
+        content = header.get('content')
+        if not isinstance(content, dict) or '_id' not in content:
+            return None
+        try:
+            return self._filesystem.get(content['_id'])
+        except NoFile:
+            raise DocumentHistoryNotAvaliable("Content of document %s stored at %s"\
+                " is missing in the storage." % (self.filename,
+                HTTPDateTime().from_timestamp(header['timestamp']).to_httpheader_format()))
+
     def get_last_version(self):
         """
         Loads the last version of the file which is available on the storage.
@@ -327,21 +1164,51 @@ class Content(Diffable):
     Implements Diffable interface to get possibility to diff contents to each
     other. Differ algorithm is choosen automatically.
 
-    Implementation detail: wrapper of GridOut instance.
+    Implementation detail: wrapper of GridOut instance. Cached contents
+    are read from the data already loaded from the GridOut, compressed
+    contents through a decompressing stream.
     """
-    def __init__(self, gridout):
+    def __init__(self, gridout, data=None):
         """
         Create new instance of content.
 
         WARNING: Do not instantiate this class by yourself, this is done by
                  File methods.
-        @param gridout: gridout instance which was retrieved by GridFS.
+        @param gridout: gridout instance which was retrieved by GridFS (or
+                        a file of other backend with the same interface).
         @type  gridout: gridfs.grid_file.GridOut
+        @param data: whole data of the gridout, if already loaded
+        @type data: str
         """
-        if not isinstance(gridout, GridOut):
+        if not hasattr(gridout, 'read') or not hasattr(gridout, 'content_type'):
             raise TypeError("gridout has to be instance of GridOut class.")
         self._gridout = gridout
+        # stream the data are read from (None = the gridout itself)
+        self._data = None
+        if data is not None:
+            self._data = StringIO(data)
+            # the gridout may hold a delta
+            self.length = len(data)
+        elif getattr(gridout, 'codec', None) is not None:
+            # decompressed lazily while reading
+            self._data = _DecodingReader(gridout, gridout.codec)
+            self.length = _content_length(gridout)
         self._differ = self._choose_diff_algorithm()
+
+    def read(self, size=-1):
+        if self._data is None:
+            return self._gridout.read(size)
+        return self._data.read(size)
+
+    def seek(self, pos, whence=0):
+        if self._data is None:
+            return self._gridout.seek(pos, whence)
+        return self._data.seek(pos, whence)
+
+    def tell(self):
+        if self._data is None:
+            return self._gridout.tell()
+        return self._data.tell()
         
     def __getattr__(self, name):
         try:
@@ -349,19 +1216,48 @@ class Content(Diffable):
         except AttributeError:
             raise AttributeError("Content object has no attribute %s" % name)
 
-    def diff_to(self, other):
+    def diff_to(self, other, tree=False, cache=None):
         """
         Creates diff of self and given Content object and returns unicode string
         representing the computed diff:
         $ diff-algo self obj
         @param other: diffed content
         @type other: Content
+        @param tree: compare html structurally (see diff.HtmlTreeDiff)
+                     instead of by lines; no effect on other contents
+        @type tree: bool
+        @param cache: cache of diffs to look the diff up in and to store it
+                      into (None = always compute it)
+        @type cache: DiffCache
         @returns: computed diff
         @rtype: unicode
         """
         if not isinstance(other, Content):
             raise TypeError("Diffed object must be an instance of Content")
-        return self._differ.diff(self.read(), other.read())
+        differ = self._differ
+        if tree and differ is HtmlDiff:
+            differ = HtmlTreeDiff
+        if cache is None:
+            return differ.diff(self.read(), other.read())
+        key = DiffCache.key(self.sha1, other.sha1, differ)
+        d = cache.get(key)
+        if d is None:
+            d = cache.put(key, differ.diff(self.read(), other.read()))
+        return d
+
+    @property
+    def sha1(self):
+        """
+        SHA-1 hex digest of the data (stored with the content by the
+        resolver, computed for older contents).
+        """
+        sha1 = getattr(self._gridout, 'sha1', None)
+        if sha1 is None:
+            pos = self.tell()
+            self.seek(0)
+            sha1 = hashlib.sha1(self.read()).hexdigest()
+            self.seek(pos)
+        return sha1
 
     def _choose_diff_algorithm(self):
         """
@@ -400,16 +1296,98 @@ class HttpHeaderMeta(BaseMongoModel):
       uid: "rrs_university"
       url+index: "http://www.cosi.cz"
       content: object_id
+      changed: True             # the check found new content
+      md5: str                  # hashes of the content found by the check
+      sha1: str
     }
 
     """
+    INDEXES = [
+        # all lookups by url (and user) sorted by time
+        ("url_uid_timestamp", [("url", ASCENDING), ("uid", ASCENDING),
+                               ("timestamp", ASCENDING)], {}),
+        # lookups of the available contents (last_available=True)
+        ("url_uid_timestamp_content", [("url", ASCENDING), ("uid", ASCENDING),
+                                       ("timestamp", DESCENDING)],
+         {"partialFilterExpression": {"content": {"$exists": True},
+                                      "response_code": {"$lt": 400}}}),
+        # point lookups of the available contents by version number; the
+        # numbers are unique, so a number taken concurrently fails the write
+        ("url_uid_version_unique", [("url", ASCENDING), ("uid", ASCENDING),
+                                    ("version", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"version": {"$exists": True}}}),
+    ]
+    COUNTER_INDEXES = [
+        ("url_uid", [("url", ASCENDING), ("uid", ASCENDING)], {"unique": True}),
+    ]
 
     def __init__(self, connection, uid, database):
         self._connection = connection
         # type pymongo.Collection
         self.objects = self._connection[database].httpheader
+        # urls (and users), whose available contents are numbered:
+        # {url: "http://www.cosi.cz", uid: "rrs_university"}
+        self.counters = self._connection[database].versioncounter
         # user id
         self.uid = uid
+        # urls known to have numbered versions (saves the counter lookup)
+        self._numbered = set()
+        # latest state of each url, updated with every saved header
+        self._state = UrlStateMeta(connection, uid, database)
+        # queue of headers written in batches (None = write immediately)
+        self._queue = None
+
+    def ensure_indexes(self):
+        BaseMongoModel.ensure_indexes(self)
+        _ensure_indexes(self.counters, self.COUNTER_INDEXES)
+        self._state.ensure_indexes()
+
+    def missing_indexes(self):
+        return BaseMongoModel.missing_indexes(self) + \
+               _missing_indexes(self.counters, self.COUNTER_INDEXES) + \
+               self._state.missing_indexes()
+
+    def write_behind(self, max_size=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY):
+        """
+        Queue saved headers and write them in batches (see WriteBehindQueue).
+        Reads of this model write the queued headers of the url first, so
+        the process always reads its own writes; other processes see them
+        after max_delay at the latest.
+
+        @param max_size: headers per batch (None writes every header
+                         immediately, as by default)
+        @type max_size: int
+        @param max_delay: maximal time (seconds) a header is queued
+        @type max_delay: float
+        """
+        self.flush()
+        if max_size is None:
+            self._queue = None
+        else:
+            self._queue = WriteBehindQueue(self._write_headers, max_size, max_delay)
+
+    def flush(self):
+        """
+        Write all queued headers.
+        """
+        if self._queue is not None:
+            self._queue.flush()
+
+    def _sync(self, url=None):
+        """
+        Write queued headers before reading headers of url (any url if None).
+        """
+        if self._queue is not None and self._queue.pending(url):
+            self._queue.flush()
+
+    def get_state(self, url):
+        """
+        Get the latest state of 'url' (see UrlStateMeta).
+        @returns: state or None if unknown (or in global-view mode)
+        @rtype: dict
+        """
+        self._sync(url)
+        return self._state.get(url)
 
     def get_by_time(self, url, timestamp, last_available=False):
         """
@@ -424,6 +1402,7 @@ class HttpHeaderMeta(BaseMongoModel):
         @returns: http header metadata of 'url'/None if not found  
         @rtype:
         """
+        self._sync(url)
         q = {"url": url, "timestamp":{"$lt": timestamp}}
         if self.uid is not None:
             q["uid"] = self.uid
@@ -437,17 +1416,36 @@ class HttpHeaderMeta(BaseMongoModel):
 
     def get_by_version(self, url, version, last_available=False):
         """
-        @TODO: docstring
         Get 'version' of 'url' from HeaderMeta database 
+
+        Records with available content carry dense version numbers (see
+        _number_headers()), so with last_available=True in user-view mode
+        the version is found by the index of the numbers. Otherwise (and for
+        histories stored before the numbering) the records are counted and
+        skipped by time.
+
         @param url: url of resource to get from db
         @type url: string
-        @param version: version number of record, ...TODO: x,-x,1,0,-1
+        @param version: version number of record: 0 is the first version,
+                        1 the second one etc.; -1 is the last version, -2
+                        the one before etc. (the same as GridFS versions)
         @type version: int
-        @param last_available:
+        @param last_available: only records with available content
         @type last_available: bool
         @returns: http header metadata of 'url'/None if not found
-        @rtype:
+        @rtype: dict
         """
+        self._sync(url)
+        if last_available and self.uid is not None and self._is_numbered(url):
+            if version >= 0:
+                return self.objects.find_one({"url": url, "uid": self.uid, "version": version})
+            q = {"url": url, "uid": self.uid, "version": {"$exists": True}}
+            try:
+                return self.objects.find(q).sort('version', DESCENDING)\
+                                   .skip(-version - 1).limit(1)[0]
+            except IndexError:
+                return None
+
         q = {"url": url}
         if self.uid is not None:
             q["uid"] = self.uid
@@ -455,34 +1453,190 @@ class HttpHeaderMeta(BaseMongoModel):
             q["response_code"] = {"$lt":400}
             q["content"] = {"$exists" : True}
         try:
-            c = self.objects.find(q).sort('timestamp', ASCENDING).count()
-            skip_ = c+version if version < 0 else c-version  #??? TODO: validate this line
+            if version < 0:
+                c = self.objects.find(q).count()
+                skip_ = c + version
+                if skip_ < 0:
+                    return None
+            else:
+                skip_ = version
             return self.objects.find(q).sort('timestamp', ASCENDING).skip(skip_).limit(1)[0]
         except (IndexError, pymongo.errors.OperationFailure): # other exception might happen
             return None
 
-    def save_header(self, url, response_code, fields, content_id):
+    def _is_numbered(self, url):
+        """
+        @returns: True if available contents of url have version numbers
+        @rtype: bool
+        """
+        if url not in self._numbered:
+            if self.counters.find_one({"url": url, "uid": self.uid}) is None:
+                return False
+            self._numbered.add(url)
+        return True
+
+    def _last_version(self, url):
+        """
+        @returns: the highest version number of url saved so far (-1 if none)
+        @rtype: int
+        """
+        q = {"url": url, "uid": self.uid, "version": {"$exists": True}}
+        try:
+            return self.objects.find(q, ["version"]).sort('version', DESCENDING)\
+                               .limit(1)[0]["version"]
+        except IndexError:
+            return -1
+
+    def _start_numbering(self, url):
+        """
+        Mark url as numbered, if it has no available content yet.
+
+        @returns: False if url has a history stored before the numbering
+                  (numbered by maintenance.number_versions(), until then
+                  new contents of url get no number)
+        @rtype: bool
+        """
+        if self.objects.find_one({"url": url, "uid": self.uid,
+                                  "response_code": {"$lt": 400},
+                                  "content": {"$exists": True}}, ["_id"]) is not None:
+            return False
+        try:
+            self.counters.insert({"url": url, "uid": self.uid}, safe=True)
+        except pymongo.errors.DuplicateKeyError:
+            # the first content saved concurrently by another process
+            pass
+        self._numbered.add(url)
+        return True
+
+    def _number_headers(self, headers):
+        """
+        Number available contents among headers, which have no number yet,
+        by the numbers following the last saved version of their urls.
+
+        Numbers are allocated just before the headers are written, so they
+        are dense: a number taken meanwhile by another process fails the
+        write (see the unique index) and it is allocated again.
+        """
+        last = {}
+        for h in headers:
+            if not self._is_available(h):
+                continue
+            url = h["url"]
+            if url not in last:
+                if self._is_numbered(url) or self._start_numbering(url):
+                    last[url] = self._last_version(url)
+                else:
+                    last[url] = None
+            if last[url] is None:
+                continue
+            if 'version' in h:
+                # numbered by a failed attempt to write the batch
+                last[url] = max(last[url], h['version'])
+            else:
+                last[url] += 1
+                h['version'] = last[url]
+
+    def save_header(self, url, response_code, fields, content_id, error=None,
+                    changed=False, md5=None, sha1=None):
         """
         Save http header into HttpHeaderMeta database
         @param url: url of checked resource
         @param response_code: response code of web server
         @param fields: fields of http response
         @param content_id: content-id field of http response
-        @returns: saved object
+        @param error: name of the error, which prevented storing the content
+                      (e.g. 'DocumentTooLarge')
+        @param changed: the check found content different from the last
+                        stored one
+        @type changed: bool
+        @param md5: MD5 hex digest of the content found by the check (if known)
+        @param sha1: SHA-1 hex digest of the content found by the check
+        @returns: id of the saved header
+        @rtype: bson.ObjectId
+        """
+        h = self._make_header(url, response_code, fields, content_id, error,
+                              changed, md5, sha1)
+        # the id is known before the header is written (the version is not)
+        h['_id'] = ObjectId()
+        if self._queue is not None:
+            self._queue.add(url, h)
+        else:
+            self._write_headers([h])
+        return h['_id']
+
+    def _write_headers(self, headers):
+        """
+        Insert headers by one bulk insert and update states of their urls.
+
+        Available contents are numbered as they are written (see
+        _number_headers()). Writing the same headers again is harmless (they
+        have their ids and states are not updated by older headers), so a
+        failed batch can be written again. On failure the headers, whose
+        states were updated, are removed from the list (see WriteBehindQueue).
+        """
+        while True:
+            self._number_headers(headers)
+            try:
+                self.objects.insert(headers, continue_on_error=True, safe=True)
+                break
+            except pymongo.errors.DuplicateKeyError:
+                # inserted by a failed attempt to write the batch, or the
+                # version was taken meanwhile: number the missing ones again
+                numbered = [h for h in headers if 'version' in h]
+                written = set(h["_id"] for h in self.objects.find(
+                    {"_id": {"$in": [h["_id"] for h in numbered]}}, ["_id"]))
+                lost = [h for h in numbered if h["_id"] not in written]
+                if not lost:
+                    break
+                for h in lost:
+                    del h['version']
+        written = set()
+        try:
+            self._state.update_all(headers, written)
+        except:
+            headers[:] = [h for h in headers if (h["url"], h["uid"]) not in written]
+            raise
+
+    def _make_header(self, url, response_code, fields, content_id, error,
+                     changed=False, md5=None, sha1=None):
+        """
+        @returns: header record (without version) to be saved
+        @rtype: dict
         """
         h = {
             "timestamp": time.time(),
             "url": url,
-            "response_code": int(response_code),
-            "uid": self.uid
+            "response_code": int(response_code) if response_code is not None else None,
+            "uid": self.uid,
+            "changed": changed
         }
         if content_id is not None:
 #?            print "save_header: content_id: ",content_id
             h['content'] = content_id
+        if error is not None:
+            h['error'] = error
+        if md5 is not None:
+            h['md5'] = md5
+        if sha1 is not None:
+            h['sha1'] = sha1
         for f in fields:
             if f.lower() in ('etag', 'last-modified'):
                 h[f.lower().replace("-", "_")] = fields[f]
-        return self.objects.save(h)
+        return h
+
+    @staticmethod
+    def _succeeded(header):
+        """
+        @returns: True if the check of the header found the resource available
+        """
+        return header.get('response_code') is not None and header['response_code'] < 400
+
+    @staticmethod
+    def _is_available(header):
+        """
+        @returns: True if the header stores available content (gets version)
+        """
+        return 'content' in header and HttpHeaderMeta._succeeded(header)
 
     def last_checked(self, url):
         """
@@ -502,12 +1656,238 @@ class HttpHeaderMeta(BaseMongoModel):
         # nemelo moc stavat, protoze vzdy je checknut na zacatku v konstruktoru
         # MonitoredResource POZOR! je ale mozne, ze se header neulozi, protoze
         # treba vyprsi timeout.
+        state = self.get_state(url)
+        if state is not None:
+            return HTTPDateTime().from_timestamp(state['last_check'])
         r = self.get_by_time(url, time.time(), last_available=False)
         if r is None:
             return None
         return HTTPDateTime().from_timestamp(r['timestamp'])
 
+    def get_checks(self, url):
+        """
+        Get history of checks of 'url' (oldest first).
+        @param url: url of checked resource
+        @type url: string
+        @returns: list of (timestamp, changed) tuples, where changed is True
+                  if new content was stored by the check, False if not and
+                  None if the check failed (e.g. timeout)
+        @rtype: list
+        """
+        self._sync(url)
+        q = {"url": url}
+        if self.uid is not None:
+            q["uid"] = self.uid
+        checks = []
+        for h in self.objects.find(q, ["timestamp", "response_code", "content"])\
+                             .sort('timestamp', ASCENDING):
+            if h.get('response_code') is None:
+                changed = None
+            else:
+                changed = 'content' in h
+            checks.append((h['timestamp'], changed))
+        return checks
+
+    def get_urls(self):
+        """
+        @returns: all urls, which have been checked (by the user)
+        @rtype: list
+        """
+        self._sync()
+        q = {}
+        if self.uid is not None:
+            q["uid"] = self.uid
+        return self.objects.find(q).distinct("url")
+
     def check_uid(self):
         assert self.uid is not None
+        self._sync()
         return self.objects.find_one({"uid": self.uid}) is not None
 
+
+class UrlStateMeta(BaseMongoModel):
+    """
+    Model for the latest state of monitored resources -- one record per url
+    and user, which is updated atomically with every saved header, so that
+    the hot-path reads do not depend on length of the history.
+
+    url_state = {
+      url: "http://www.cosi.cz"
+      uid: "rrs_university"
+      last_check: 1341161610.287    # timestamp of the last header
+      response_code: 200
+      etag: P34lkdfk32jrlkjdfpoqi3
+      last_modified: cosi
+      content: {...}                # content record of the last available content
+      content_id: object_id         # GridFS file of the last available content
+      md5: str
+      sha1: str
+      version: 12
+      last_change: 1341161610.287   # timestamp of the last available content
+      changes: [1341075210.287, 1341161610.287]  # the last two such timestamps
+      changed: True                 # the last check found new content
+    }
+    """
+    INDEXES = [
+        ("url_uid", [("url", ASCENDING), ("uid", ASCENDING)], {"unique": True}),
+    ]
+
+    def __init__(self, connection, uid, database):
+        self._connection = connection
+        # type pymongo.Collection
+        self.objects = self._connection[database].url_state
+        # user id
+        self.uid = uid
+
+    def get(self, url):
+        """
+        @returns: state of 'url' or None if unknown; None in global-view mode,
+                  where the state of all users would be needed
+        @rtype: dict
+        """
+        if self.uid is None:
+            return None
+        return self.objects.find_one({"url": url, "uid": self.uid})
+
+    def update(self, url, header):
+        """
+        Update state of 'url' by newly saved header.
+        @param header: the saved header
+        @type header: dict
+        """
+        self.update_all([header])
+
+    def update_all(self, headers, written=None):
+        """
+        Update states by newly saved headers (in the order of saving); the
+        headers of each url are merged into one update. A state is not
+        updated by headers older than its last check, so updating it by the
+        same headers again does nothing.
+        @type headers: list
+        @param written: set getting (url, uid) of every updated state
+        @type written: set
+        """
+        updates = OrderedDict()
+        for h in headers:
+            fields, changes = updates.setdefault((h["url"], h["uid"]), ({}, []))
+            fields.update(self.state_fields(h))
+            if HttpHeaderMeta._is_available(h):
+                changes.append(h["timestamp"])
+        for (url, uid), (fields, changes) in updates.iteritems():
+            update = {"$set": fields}
+            if changes:
+                update["$push"] = {"changes": {"$each": changes[-2:], "$slice": -2}}
+            try:
+                self.objects.update({"url": url, "uid": uid,
+                                     "last_check": {"$lt": fields["last_check"]}},
+                                    update, upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                # the state exists and it is newer
+                pass
+            if written is not None:
+                written.add((url, uid))
+
+    @staticmethod
+    def state_fields(header):
+        """
+        @returns: fields of the state set by newly saved header (except the
+                  list of changes, which gets the timestamp of the header if
+                  it stores new available content)
+        @rtype: dict
+        """
+        fields = {"last_check": header["timestamp"],
+                  "response_code": header["response_code"],
+                  "changed": header.get("changed", False)}
+        for f in ('etag', 'last_modified'):
+            if f in header:
+                fields[f] = header[f]
+        if HttpHeaderMeta._is_available(header):
+            # new available content (not numbered yet, if its history is not)
+            content = header['content']
+            fields.update({"content": content,
+                           "content_id": content.get('_id'),
+                           "md5": content.get('md5'),
+                           "sha1": content.get('sha1'),
+                           "version": header.get('version'),
+                           "last_change": header["timestamp"]})
+        return fields
+
+
+class ScheduleMeta(BaseMongoModel):
+    """
+    Model for re-check schedule of monitored resources (see
+    scheduler.RecheckScheduler).
+
+    schedule = {
+      url: "http://www.cosi.cz"
+      uid: "rrs_university"
+      checks: 12.4            # discounted number of observed intervals
+      changes: 3.1            # discounted number of intervals with a change
+      span: 86400.0           # discounted sum of the interval lengths
+      rate: 0.00003           # estimated changes per second
+      observed: 1341161610.287  # last successful check
+      last_check: 1341161610.287
+      next_check: 1341190410.287
+    }
+    """
+    INDEXES = [
+        ("uid_next_check", [("uid", ASCENDING), ("next_check", ASCENDING)], {}),
+        ("url_uid", [("url", ASCENDING), ("uid", ASCENDING)], {"unique": True}),
+    ]
+
+    def __init__(self, connection, uid, database):
+        self._connection = connection
+        # type pymongo.Collection
+        self.objects = self._connection[database].schedule
+        # user id
+        self.uid = uid
+
+    def get(self, url):
+        """
+        @returns: schedule of 'url' or None if it is not scheduled yet
+        @rtype: dict
+        """
+        return self.objects.find_one({"url": url, "uid": self.uid})
+
+    def save(self, url, fields):
+        """
+        Create or update schedule of 'url'.
+        @param fields: fields to be set
+        @type fields: dict
+        """
+        self.objects.update({"url": url, "uid": self.uid}, {"$set": fields},
+                            upsert=True)
+
+    def save_many(self, updates):
+        """
+        Update schedules of many resources at once.
+        @param updates: pairs (url, fields to be set)
+        @type updates: list
+        """
+        for url, fields in updates:
+            self.objects.update({"url": url, "uid": self.uid}, {"$set": fields},
+                                upsert=True)
+
+    def get_all(self):
+        """
+        @returns: schedules of all resources of the user
+        @rtype: pymongo.cursor.Cursor
+        """
+        return self.objects.find({"uid": self.uid})
+
+    def get_due(self, timestamp, limit=None):
+        """
+        Get schedules of resources, which should be checked before 'timestamp',
+        the most overdue first.
+        @param timestamp: unix timestamp
+        @type timestamp: float
+        @param limit: maximal number of records (None for all)
+        @type limit: int
+        @rtype: pymongo.cursor.Cursor
+        """
+        c = self.objects.find({"uid": self.uid, "next_check": {"$lte": timestamp}})\
+                        .sort('next_check', ASCENDING)
+        if limit is not None:
+            c = c.limit(limit)
+        return c
+
@@ -9,7 +9,49 @@ __date__ = "$25.6.2012 12:12:44$"
 from _http import HTTPDateTime
 import _http
 import hashlib
+import tempfile
 import model
+from errors import DocumentTooLarge
+
+# size of downloaded body kept in memory, larger bodies are spooled into
+# a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class _HashingSpool(object):
+    """
+    Sink for the streamed response body. Computes md5 and sha1 of the data
+    in a single pass and spools the data into a bounded memory buffer, which
+    rolls over into a temporary file, so memory stays flat regardless of the
+    document size. Readable (after rewind()) as a file by GridFS.put().
+    """
+    def __init__(self, max_size=SPOOL_MAX_SIZE):
+        self._md5 = hashlib.md5()
+        self._sha1 = hashlib.sha1()
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.length = 0
+
+    def write(self, data):
+        self._md5.update(data)
+        self._sha1.update(data)
+        self._file.write(data)
+        self.length += len(data)
+
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def sha1(self):
+        return self._sha1.hexdigest()
+
+    def rewind(self):
+        self._file.seek(0)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
 
 class Resolver(object):
     """
@@ -22,18 +64,26 @@ class Resolver(object):
     changed(HTTP:response code) -> it depends..
     changed(HTTP:last-modified) -> doesn't matter
     """
-    def __init__(self, storage, timeout = 10):
+    def __init__(self, storage, timeout = 10, http_pool = None, revalidate = False,
+                 max_size = None, scheduler = None, recheck = None):
         # Storage
         self._storage = storage
 #?        print "RESOLVER: STORAGE: ",self._storage
-        # are large documents allowed?
-        self._allow_large = self._storage.allow_large
-        # GridFS
-        self._filesystem = storage.filesystem
-        # Collection "httpheader"
-        self._headers = storage._headermeta
+        # size limit of documents in bytes (None = no limit); it is not
+        # enforced if large documents are allowed in the storage
+        self._max_size = max_size
         # Timeout for checking pages
         self._timeout = timeout
+        # Keep-alive connections shared with other resolvers (may be None)
+        self._http_pool = http_pool
+        # Revalidation mode: one conditional GET instead of HEAD and GET
+        self._revalidate = revalidate
+        # Politeness scheduler shared with other resolvers (may be None)
+        self._scheduler = scheduler
+        # Re-check scheduler recording results of the checks (may be None)
+        self._recheck = recheck
+        # the last stored check found new content (None if it failed)
+        self.changed = None
 	pass
 
     def resolve(self, url):
@@ -62,21 +112,102 @@ class Resolver(object):
         decision = self._make_decision(url)
         #print(decision)
         self._store_into_db(decision,url)
+        self._raise_for(decision, url)
+
+    def _raise_for(self, store_decision, url):
+        """
+        Raise exception for the (already stored) outcome, which is an error.
+        """
+        if store_decision[0] == 4:
+            raise DocumentTooLarge("Document '%s' is larger than %d bytes." % \
+                                   (url, self._max_size))
+
+    def _send(self, conn_proxy, method, url, *args, **kwargs):
+        """
+        Send request by the connection proxy. If there is a politeness
+        scheduler, waits for the slot of the host and reports the outcome.
+        """
+        if self._scheduler is None:
+            return conn_proxy.send_request(method, url, *args, **kwargs)
+        self._scheduler.acquire(url)
+        try:
+            result = conn_proxy.send_request(method, url, *args, **kwargs)
+        except DocumentTooLarge as e:
+            self._report(url, e)
+            raise
+        self._report(url, result)
+        return result
+
+    def _report(self, url, result):
+        """
+        Report result of a request (4-tuple, None for timeout or DocumentTooLarge)
+        to the politeness scheduler.
+        """
+        if isinstance(result, DocumentTooLarge):
+            result = result.response
+        if result is None:
+            self._scheduler.report(url, None)
+        else:
+            self._scheduler.report(url, result[0], result[1])
+
+    def _size_limit(self):
+        """
+        @returns: maximal size of the document in bytes or None for no limit
+        @rtype: int or None
+        """
+        # the flag is read every time, it can be switched on at any time
+        if self._storage.allow_large:
+            return None
+        return self._max_size
+
+    def _too_large_decision(self, response):
+        """
+        Decision for a document exceeding the size limit.
+
+        @param response: (response code, headers, body, url) of the response
+        """
+        self._too_large_info = response
+        return (4, "Document too large")
 
     def _make_decision(self, url):
         self.db_metainfo = self._get_metainfo_from_db(url)
-        conn_proxy = _http._HTTPConnectionProxy(url,self._timeout)
-        self.web_metainfo = conn_proxy.send_request("HEAD",url)
-        
+        conn_proxy = _http._HTTPConnectionProxy(url,self._timeout,self._http_pool)
+
+        headers = self._conditional_headers()
+        if headers is not None:
+            try:
+                self._web_full_info = self._send(conn_proxy,"GET",url,headers,
+                    sink=_HashingSpool(),max_size=self._size_limit())
+            except DocumentTooLarge as e:
+                return self._too_large_decision(e.response)
+            return self._decide_on_conditional()
+
+        self.web_metainfo = self._send(conn_proxy,"HEAD",url)
+
+        store_decision = self._decide_on_head()
+        if store_decision is not None:
+            return store_decision
+        return self._make_decision_2(url,conn_proxy)
+
+    def _decide_on_head(self):
+        """
+        Decide upon self.db_metainfo and the response to HEAD request stored
+        in self.web_metainfo.
+
+        @returns: store decision or None if the content has to be downloaded
+        @rtype: tuple or None
+        """
         store_decision = (0,"Store both header and content")
 
 #?        print "Resolver: _make_decision: db_metainfo",self.db_metainfo
 #?        print self.web_metainfo
 
+        if self.web_metainfo is not None and \
+                _http._declared_too_large(self.web_metainfo[1], self._size_limit()):
+            return self._too_large_decision(self.web_metainfo)
+
         if self.db_metainfo == None:
-            store_decision = (0,"Store both header and content")
-            self._make_decision_2(url,conn_proxy)
-            return store_decision
+            return None
 
         if self.web_metainfo == None:
             store_decision = (3, "Timeouted")
@@ -99,16 +230,73 @@ class Resolver(object):
         if store_decision[0] != 0:
             return store_decision
         else:
-            return self._make_decision_2(url,conn_proxy)
+            return None
     
+    def _conditional_headers(self):
+        """
+        Build request headers of the conditional GET from the validators
+        (etag, last-modified) stored in self.db_metainfo.
+
+        @returns: request headers or None if not in revalidation mode or
+                  there are no validators to revalidate with
+        @rtype: dict or None
+        """
+        if not self._revalidate or self.db_metainfo is None:
+            return None
+        headers = dict(_http._HTTPConnectionProxy.default_header)
+        if self.db_metainfo.get('etag'):
+            headers['if-none-match'] = self.db_metainfo['etag']
+        if self.db_metainfo.get('last_modified'):
+            headers['if-modified-since'] = self.db_metainfo['last_modified']
+        if len(headers) == len(_http._HTTPConnectionProxy.default_header):
+            return None
+        return headers
+
+    def _decide_on_conditional(self):
+        """
+        Decide upon the response to conditional GET stored in
+        self._web_full_info. 304 Not Modified means the content is the same
+        as the stored one, any other response is decided as downloaded content.
+
+        @returns: store decision
+        @rtype: tuple
+        """
+        if self._web_full_info is not None and self._web_full_info[0] == 304:
+            # 304 need not repeat the validators, keep them for the next check
+            fields = {}
+            if self.db_metainfo.get('etag'):
+                fields['etag'] = self.db_metainfo['etag']
+            if self.db_metainfo.get('last_modified'):
+                fields['last-modified'] = self.db_metainfo['last_modified']
+            fields.update(self._web_full_info[1])
+            self.web_metainfo = (304, fields, '', self._web_full_info[3])
+            return (1, "Store only header (based on 304 Not Modified)")
+        # the validators were ignored: if the body is the same, the header of
+        # this response is stored (not one of a previous check)
+        self.web_metainfo = self._web_full_info
+        return self._decide_on_body()
+
     def _make_decision_2(self, url, conn_proxy):
         # etag and content-md5 are the only authoritave evidents of 'it has not changed'
         # therefore, now is the time to download the content
 
-        self._web_full_info = conn_proxy.send_request("GET",url)
-        
+        try:
+            self._web_full_info = self._send(conn_proxy,"GET",url,
+                sink=_HashingSpool(),max_size=self._size_limit())
+        except DocumentTooLarge as e:
+            return self._too_large_decision(e.response)
+        return self._decide_on_body()
+
+    def _decide_on_body(self):
+        """
+        Decide upon the downloaded content stored in self._web_full_info.
+
+        @returns: store decision
+        @rtype: tuple
+        """
         if self._web_full_info == None:
-            return "Pruuser, HEAD prosel, GET uz ne"
+            # HEAD passed, but GET did not
+            return (3, "Timeouted")
 
 #?        print "header: " + self._web_full_info[1]['content-length'] + ", len(): " + str(len(self._web_full_info[2]))
 #?        print "_web_full_info[0]: ",self._web_full_info[0]
@@ -116,14 +304,12 @@ class Resolver(object):
 #?        print "_web_full_info[2]: ",self._web_full_info[2] # this is the full html code of the page
 #?        print "_web_full_info[3]: ",self._web_full_info[3]
 
-        mdfiver = hashlib.md5()
-        mdfiver.update(self._web_full_info[2])
-        self._md5 = mdfiver.hexdigest()
+        # the body was hashed (md5 and sha1 in one pass) while downloading
+        spool = self._web_full_info[2]
+        self._md5 = spool.md5()
 #?        print "md5: " + self._md5
 
-        shaoner = hashlib.sha1()
-        shaoner.update(self._web_full_info[2])
-        self._sha1 = shaoner.hexdigest()
+        self._sha1 = spool.sha1()
 #?        print "sha1: " + self._sha1
 
         if (self.db_metainfo is not None) and self._md5 == self.db_metainfo['content']['md5'] and self._sha1 == self.db_metainfo['content']['sha1']:
@@ -135,11 +321,22 @@ class Resolver(object):
 
 
     def _store_into_db(self, store_decision, url):
+        """
+        Stores metainfo (and content) in the storage and drops the spooled
+        body, even if storing failed.
+        """
+        try:
+            self._store_outcome(store_decision, url)
+        finally:
+            self._release_body()
+
+    def _store_outcome(self, store_decision, url):
         """
         Stores metainfo (and content) in the storage.
         """
        
 #?        print "In Resolver._store_into_db: store_decision: ",store_decision
+        self.changed = None
         if store_decision[0] == 0:
             content_id = {
                 'filename': url,
@@ -151,23 +348,71 @@ class Resolver(object):
             }
             # store both headers and content
             # store data in GridFS... need to be consistent with the expectations of the other modules
-            self._filesystem.put(self._web_full_info[2],filename=url,
-                content_type=self._web_full_info[1]['content-type'],
-                timestamp=HTTPDateTime().from_httpheader_format(self._web_full_info[1]['date']).to_timestamp())
+            # (the spooled body is streamed into GridFS)
+            self._web_full_info[2].rewind()
+            # the header points to the GridFS file directly (see File.get_version)
+            content_id['_id'] = self._storage.put_content(self._web_full_info[2], url,
+                self._web_full_info[1]['content-type'],
+                HTTPDateTime().from_httpheader_format(self._web_full_info[1]['date']).to_timestamp(),
+                previous=self._previous_content_id(), sha1=self._sha1)
             # save header AFTER content: enable search of content by header timestamp
-            self._headers.save_header(url,self._web_full_info[0], self._web_full_info[1], content_id)
+            # the change and the hashes are recorded with the check, so that
+            # it can be answered without the contents; the first content of
+            # the url is not a change
+            self.changed = self.db_metainfo is not None
+            self._storage.save_header(url,self._web_full_info[0], self._web_full_info[1], content_id,
+                changed=self.changed, md5=self._md5, sha1=self._sha1)
         elif store_decision[0] == 1:
-            # store headers only
-            self._headers.save_header(url,self.web_metainfo[0], self.web_metainfo[1], None)
+            # store headers only (the content is the last stored one)
+            self.changed = False
+            md5, sha1 = self._stored_hashes()
+            self._storage.save_header(url,self.web_metainfo[0], self.web_metainfo[1], None,
+                md5=md5, sha1=sha1)
         elif store_decision[0] == 3:
             # store information about the timeout
-            self._headers.save_header(url,None, 'Timeouted', None)
+            self._storage.save_header(url,None, 'Timeouted', None)
+        elif store_decision[0] == 4:
+            # store information about the document, which was not downloaded
+            self._storage.save_header(url,self._too_large_info[0], self._too_large_info[1],
+                None, error='DocumentTooLarge')
         else:
             # this NEVER happens
             print "Dafuq?"
-#?        print "self._headers:", self._headers
+        if self._recheck is not None:
+            # content stored = change observed; failed check = nothing observed
+            changed = {0: True, 1: False}.get(store_decision[0])
+            self._recheck.record(url, changed)
         return
 
+    def _stored_hashes(self):
+        """
+        @returns: md5 and sha1 of the last stored version (None if unknown)
+        """
+        content = self.db_metainfo.get('content') if self.db_metainfo is not None else None
+        if not isinstance(content, dict):
+            return None, None
+        return content.get('md5'), content.get('sha1')
+
+    def _previous_content_id(self):
+        """
+        @returns: id of the last stored version in GridFS (None if unknown)
+        """
+        if self.db_metainfo is None:
+            return None
+        content = self.db_metainfo.get('content')
+        if not isinstance(content, dict):
+            return None
+        return content.get('_id')
+
+    def _release_body(self):
+        """
+        Drop the spooled body of the last download (removes the temporary file).
+        """
+        info = getattr(self, '_web_full_info', None)
+        if info is not None and isinstance(info[2], _HashingSpool):
+            info[2].close()
+        self._web_full_info = None
+
     def _get_metainfo_from_db(self, url):
         """
         Returns last metainfo upon the given url stored in the DB.
@@ -191,15 +436,98 @@ class Resolver(object):
 #          'content': mockup_content  # object_id
 #        }
 
-        q = {'url':url}
-#?     	print "METAINFO FROM DB:",self._headers.objects.find(q)
-#?        for item in self._headers.objects.find(q):
-#?            print "get_metainfo_from_db: ",item #self._headers.objects.find(q)
-        try:
-            retval = self._headers.objects.find(q)[0]
-        except:
-            retval = None
-        return retval
+        return self._storage.get_metainfo(url)
+
+class AsyncResolver(Resolver):
+    """
+    Resolver driven by a non-blocking event loop (see changemonitor.AsyncMonitor).
+
+    The resolving is split into three steps, so that the database work can
+    be done by worker threads and only the HTTP requests run in the loop:
+        1. prepare(url) -- load metainfo from the storage (worker thread)
+        2. start(url, callback, map, defer) -- non-blocking HEAD (and GET)
+           requests
+        3. store(url, decision) -- store the result (worker thread)
+    The store decisions are made by the same code as in Resolver.
+    """
+
+    def prepare(self, url):
+        """
+        Load the last metainfo of the url from the storage.
+        """
+        self.db_metainfo = self._get_metainfo_from_db(url)
+
+    def _send_async(self, method, url, callback, map, defer, **kwargs):
+        """
+        Start non-blocking request. If there is a politeness scheduler and the
+        host is not ready, the request is postponed by defer(delay, function),
+        which has to call the function from the event loop after delay seconds.
+        """
+        if self._scheduler is None:
+            _http._AsyncHTTPRequest(method, url, callback, timeout=self._timeout,
+                                    map=map, **kwargs)
+            return
+        if not self._scheduler.acquire(url, block=False):
+            defer(self._scheduler.delay(url), lambda: \
+                  self._send_async(method, url, callback, map, defer, **kwargs))
+            return
+        def reported(result):
+            self._report(url, result)
+            callback(result)
+        _http._AsyncHTTPRequest(method, url, reported, timeout=self._timeout,
+                                map=map, **kwargs)
+
+    def start(self, url, callback, map, defer):
+        """
+        Start non-blocking requests in the asyncore map. When the decision is
+        made, callback(decision, error) is called from the event loop.
+        Requests to a host, which is not ready, are postponed by defer (see
+        _send_async()).
+        """
+        def on_head(result):
+            try:
+                self.web_metainfo = result
+                decision = self._decide_on_head()
+                if decision is None:
+                    self._send_async("GET", url, on_get, map, defer,
+                                     sink=_HashingSpool(), max_size=self._size_limit())
+                    return
+            except Exception as e:
+                callback(None, e)
+                return
+            callback(decision, None)
+
+        def on_get(result, decide=self._decide_on_body):
+            try:
+                if isinstance(result, DocumentTooLarge):
+                    decision = self._too_large_decision(result.response)
+                else:
+                    self._web_full_info = result
+                    decision = decide()
+            except Exception as e:
+                callback(None, e)
+                return
+            callback(decision, None)
+
+        def on_conditional_get(result):
+            on_get(result, self._decide_on_conditional)
+
+        headers = self._conditional_headers()
+        if headers is not None:
+            self._send_async("GET", url, on_conditional_get, map, defer, headers=headers,
+                             sink=_HashingSpool(), max_size=self._size_limit())
+            return
+        self._send_async("HEAD", url, on_head, map, defer)
+
+    def store(self, url, decision):
+        """
+        Store metainfo (and content) according to the decision.
+
+        @raises: DocumentTooLarge if the document exceeded the size limit
+        """
+        self._store_into_db(decision, url)
+        self._raise_for(decision, url)
+
 
 class Rule(object):
     """
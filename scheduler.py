@@ -0,0 +1,414 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Schedulers for changemonitor -- deciding when requests can be sent.
+
+HostScheduler keeps the crawler polite: it limits the rate of requests sent
+to every single host and backs off from hosts, which refuse or fail to
+answer.
+
+RecheckScheduler decides when every resource should be checked again: it
+estimates how often the resource changes and spends a fixed budget of checks
+where the changes are likely.
+"""
+
+__modulename__ = "scheduler"
+__date__ = "$16.10.2026 14:20:05$"
+
+import time
+import math
+import threading
+
+from urlparse import urlsplit
+
+# response codes, which mean "slow down" (plus None meaning timeout)
+BACKOFF_STATUSES = (429, 503)
+
+
+class _HostState(object):
+    """
+    Politeness state of one host (net location).
+    """
+    def __init__(self, burst, now):
+        # token bucket
+        self.tokens = float(burst)
+        self.refilled = now
+        # time of the last request sent to the host
+        self.last_request = None
+        # no request is sent before this time
+        self.backoff_until = 0.0
+        # number of failures in a row
+        self.failures = 0
+
+
+class HostScheduler(object):
+    """
+    Per-host politeness scheduler. Each host (net location) has its own token
+    bucket refilled by *rate* tokens per second up to *burst* tokens, and two
+    requests to one host are never closer than *min_delay* seconds. When the
+    host answers 429/503 or the request times out, the host is backed off
+    exponentially (backoff_base * 2^(failures-1) seconds, at most max_backoff,
+    or longer if the server sent Retry-After in seconds); a successful
+    response resets the backoff.
+
+    Hosts are independent, so all of them can be kept busy while none of
+    them gets more than its budget. The scheduler is thread-safe.
+
+    Usage:
+        >>> scheduler = HostScheduler(rate=0.5, min_delay=1.0)
+        >>> scheduler.acquire(url)  # blocks until the host of url is ready
+        >>> result = send_the_request(url)
+        >>> scheduler.report(url, status, headers)
+    """
+
+    def __init__(self, rate=1.0, burst=1, min_delay=1.0, backoff_base=30.0,
+                 max_backoff=3600.0):
+        """
+        @param rate: requests per second allowed for one host
+        @type rate: float
+        @param burst: maximum of requests sent to one host at once
+        @type burst: int
+        @param min_delay: minimal delay between two requests to one host (seconds)
+        @type min_delay: float
+        @param backoff_base: backoff after the first failure (seconds)
+        @type backoff_base: float
+        @param max_backoff: maximal backoff (seconds)
+        @type max_backoff: float
+        """
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate has to be positive and burst at least 1.")
+        self.rate = float(rate)
+        self.burst = burst
+        self.min_delay = min_delay
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _state(self, url, now):
+        netloc = urlsplit(url).netloc
+        try:
+            state = self._hosts[netloc]
+        except KeyError:
+            state = self._hosts[netloc] = _HostState(self.burst, now)
+        # refill the bucket
+        state.tokens = min(float(self.burst),
+                           state.tokens + (now - state.refilled) * self.rate)
+        state.refilled = now
+        return state
+
+    def _delay(self, state, now):
+        delay = max(0.0, state.backoff_until - now)
+        if state.last_request is not None:
+            delay = max(delay, state.last_request + self.min_delay - now)
+        if state.tokens < 1.0:
+            delay = max(delay, (1.0 - state.tokens) / self.rate)
+        return delay
+
+    def delay(self, url):
+        """
+        @returns: seconds until a request to the host of url is allowed
+                  (0 if it is allowed now)
+        @rtype: float
+        """
+        now = time.time()
+        with self._lock:
+            return self._delay(self._state(url, now), now)
+
+    def acquire(self, url, block=True):
+        """
+        Take the slot for one request to the host of url.
+
+        @param block: if True, wait until the request is allowed
+        @type block: bool
+        @returns: True if the slot was taken, False if not blocking and the
+                  request is not allowed now
+        @rtype: bool
+        """
+        while True:
+            now = time.time()
+            with self._lock:
+                state = self._state(url, now)
+                delay = self._delay(state, now)
+                if delay <= 0:
+                    state.tokens -= 1.0
+                    state.last_request = now
+                    return True
+            if not block:
+                return False
+            time.sleep(delay)
+
+    def report(self, url, status, headers=None):
+        """
+        Report outcome of the request to the host of url.
+
+        @param status: response code or None if the request timed out
+        @type status: int or None
+        @param headers: response headers (for Retry-After)
+        @type headers: dict
+        """
+        now = time.time()
+        with self._lock:
+            state = self._state(url, now)
+            if status is not None and status not in BACKOFF_STATUSES:
+                state.failures = 0
+                state.backoff_until = 0.0
+                return
+            state.failures += 1
+            backoff = min(self.max_backoff,
+                          self.backoff_base * 2 ** (state.failures - 1))
+            try:
+                backoff = max(backoff, min(self.max_backoff,
+                                           float(headers['retry-after'])))
+            except (TypeError, KeyError, ValueError):
+                # no headers or Retry-After is an HTTP date
+                pass
+            state.backoff_until = now + backoff
+
+
+class RecheckScheduler(object):
+    """
+    Adaptive re-check scheduler. Every check of a resource observes, whether
+    the resource changed since the previous check. Changes are modelled as
+    a Poisson process and its rate is estimated by the estimator of Cho and
+    Garcia-Molina
+
+        rate = -ln((n - X + 0.5) / (n + 0.5)) / (T / n)
+
+    where n is number of observed intervals, X number of intervals with
+    a change and T total length of the intervals. The counts are discounted
+    by (1 - smoothing) with every new observation (exponential moving
+    average), so the estimate follows resources, whose behaviour changes.
+
+    The budget of *budget* checks per *period* seconds is divided among the
+    resources: each one is checked with frequency scale * rate clamped into
+    [1/max_interval, 1/min_interval], where the scale is chosen so that the
+    frequencies sum up to the budget. Every check then has roughly the same
+    chance to find a change. Resources without history are checked after
+    min_interval.
+
+    The scale is found again at most once per *rebalance_interval*, when the
+    due resources are asked for (or by rebuild()), never by recording a check:
+    record() schedules the next check with the current scale.
+
+    Usage:
+        >>> recheck = RecheckScheduler(storage, budget=10000)
+        >>> recheck.rebuild()   # estimate rates from the stored history
+        >>> for result in monitor.check_multi(recheck.due()):
+        ...     pass
+    """
+
+    def __init__(self, storage, budget, period=86400.0, min_interval=3600.0,
+                 max_interval=30 * 86400.0, smoothing=0.1, rebalance_interval=3600.0):
+        """
+        @param storage: storage of the monitor
+        @type storage: model.Storage
+        @param budget: number of checks per period
+        @type budget: int
+        @param period: length of the period (seconds)
+        @type period: float
+        @param min_interval: minimal interval between two checks of a resource
+        @type min_interval: float
+        @param max_interval: maximal interval between two checks of a resource
+        @type max_interval: float
+        @param smoothing: weight of the newest observation (0..1]
+        @type smoothing: float
+        @param rebalance_interval: how often the budget is divided again
+                                   (seconds)
+        @type rebalance_interval: float
+        """
+        if budget <= 0:
+            raise ValueError("budget has to be positive.")
+        if not 0 < smoothing <= 1:
+            raise ValueError("smoothing has to be in (0, 1].")
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("min_interval has to be positive and not greater than max_interval.")
+        self._headers = storage._headermeta
+        self._schedule = storage._schedulemeta
+        self.budget = budget
+        self.period = float(period)
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.smoothing = smoothing
+        self.rebalance_interval = rebalance_interval
+        # frequency = scale * rate (None until the first rebalance)
+        self._scale = None
+        self._balanced = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate(checks, changes, span):
+        """
+        @returns: estimated changes per second or None if nothing was observed
+        @rtype: float or None
+        """
+        if checks <= 0 or span <= 0:
+            return None
+        return -math.log((checks - changes + 0.5) / (checks + 0.5)) / (span / checks)
+
+    def interval(self, rate):
+        """
+        @param rate: estimated changes per second (None if unknown)
+        @returns: interval between two checks of a resource (seconds)
+        @rtype: float
+        """
+        if rate is None:
+            return self.min_interval
+        scale = self._scale if self._scale is not None else 1.0
+        return 1.0 / self._frequency(scale, rate)
+
+    def _frequency(self, scale, rate):
+        return min(1.0 / self.min_interval, max(1.0 / self.max_interval, scale * rate))
+
+    def _observe(self, stats, interval, changed):
+        keep = 1.0 - self.smoothing
+        stats['checks'] = keep * stats['checks'] + 1.0
+        stats['changes'] = keep * stats['changes'] + (1.0 if changed else 0.0)
+        stats['span'] = keep * stats['span'] + interval
+
+    def _from_history(self, url):
+        """
+        Compute the schedule of url from the stored history of checks.
+        """
+        stats = {'checks': 0.0, 'changes': 0.0, 'span': 0.0,
+                 'observed': None, 'last_check': None}
+        for timestamp, changed in self._headers.get_checks(url):
+            stats['last_check'] = timestamp
+            if changed is None:
+                # failed check, nothing observed
+                continue
+            if stats['observed'] is not None:
+                self._observe(stats, timestamp - stats['observed'], changed)
+            stats['observed'] = timestamp
+        return stats
+
+    def _finish(self, stats):
+        stats['rate'] = self.estimate(stats['checks'], stats['changes'], stats['span'])
+        if stats['last_check'] is None:
+            stats['next_check'] = time.time()
+        else:
+            stats['next_check'] = stats['last_check'] + self.interval(stats['rate'])
+        return stats
+
+    def record(self, url, changed, timestamp=None):
+        """
+        Record the result of a check of url (called after the header was
+        saved) and schedule the next check.
+
+        @param changed: True if new content was stored, False if not and None
+                        if the check failed
+        @type changed: bool or None
+        @param timestamp: time of the check (now by default)
+        @type timestamp: float
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        doc = self._schedule.get(url)
+        if doc is None:
+            # first check since scheduling was enabled: replay the history
+            stats = self._from_history(url)
+        else:
+            stats = dict((k, doc.get(k)) for k in ('checks', 'changes', 'span',
+                                                   'observed', 'last_check'))
+            if changed is not None:
+                if stats['observed'] is not None:
+                    self._observe(stats, timestamp - stats['observed'], changed)
+                stats['observed'] = timestamp
+            stats['last_check'] = timestamp
+        self._schedule.save(url, self._finish(stats))
+
+    def rebuild(self, urls=None):
+        """
+        Estimate the change rates from the stored history of checks and
+        schedule the next checks. Useful when the scheduler is enabled for
+        resources with existing history.
+
+        @param urls: urls to be rebuilt (all checked urls by default)
+        @type urls: list
+        """
+        if urls is None:
+            urls = self._headers.get_urls()
+        self._schedule.save_many([(url, self._finish(self._from_history(url)))
+                                  for url in urls])
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        Divide the budget among all scheduled resources according to their
+        change rates and move their next checks accordingly.
+        """
+        with self._lock:
+            self._rebalance()
+
+    def _rebalance(self):
+        docs = list(self._schedule.get_all())
+        rates = [d.get('rate') for d in docs]
+        self._scale = self._find_scale(rates)
+        updates = []
+        for d, rate in zip(docs, rates):
+            # resources without a change rate do not depend on the scale
+            if rate is None or d.get('last_check') is None:
+                continue
+            next_check = d['last_check'] + self.interval(rate)
+            if next_check != d.get('next_check'):
+                updates.append((d['url'], {'next_check': next_check}))
+        # only the moved checks are written, all of them at once
+        self._schedule.save_many(updates)
+        self._balanced = time.time()
+
+    def _find_scale(self, rates):
+        """
+        Find scale, for which the frequencies of checks sum up to the budget.
+        The sum is monotonic in the scale, so bisection (in logarithmic space)
+        finds it.
+        """
+        # resources, which never changed or have no history, have fixed
+        # frequency and take their part of the budget first
+        target = self.budget / self.period
+        target -= sum(1.0 / self.max_interval for r in rates if r == 0)
+        target -= sum(1.0 / self.min_interval for r in rates if r is None)
+        rates = [r for r in rates if r]
+        if not rates:
+            return 1.0
+        lo = 1.0 / (self.max_interval * max(rates))
+        hi = 1.0 / (self.min_interval * min(rates))
+        total = lambda scale: sum(self._frequency(scale, r) for r in rates)
+        if total(hi) <= target:
+            return hi
+        if total(lo) >= target:
+            return lo
+        for _ in xrange(60):
+            mid = math.sqrt(lo * hi)
+            if total(mid) < target:
+                lo = mid
+            else:
+                hi = mid
+        return hi
+
+    def _is_stale(self):
+        return self._scale is None or time.time() - self._balanced > self.rebalance_interval
+
+    def _ensure_balanced(self):
+        if not self._is_stale():
+            return
+        with self._lock:
+            # another thread may have rebalanced while this one waited
+            if self._is_stale():
+                self._rebalance()
+
+    def due(self, limit=None, now=None):
+        """
+        Get urls, which should be checked now, the most overdue first.
+
+        @param limit: maximal number of urls (None for all)
+        @type limit: int
+        @param now: unix timestamp (now by default)
+        @type now: float
+        @returns: urls due to be checked
+        @rtype: list
+        """
+        self._ensure_balanced()
+        if now is None:
+            now = time.time()
+        return [d['url'] for d in self._schedule.get_due(now, limit)]